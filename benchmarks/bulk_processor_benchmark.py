@@ -0,0 +1,84 @@
+"""
+Documents per second buffered by BulkProcessor, with the _bulk request answered locally.
+
+Compares the original buffer (string concatenation, re-encoded on every call to check its size) with the current
+buffer of pre-encoded byte chunks.  The original is quadratic in the batch size, so it is measured over fewer
+documents.
+
+    python benchmarks/bulk_processor_benchmark.py [--documents 1000000] [--legacy-documents 20000]
+"""
+import argparse
+import json
+import logging
+import time
+
+from digital_thought_commons.elasticsearch.bulkProcessor import BulkProcessor
+
+
+class _Response:
+    status_code = 200
+
+    def __init__(self, count):
+        self.__json = {'took': 1, 'errors': False, 'items': [{'index': {'result': 'created'}}] * count}
+
+    def json(self):
+        return self.__json
+
+
+class _Session:
+    headers = {}
+
+    def post(self, url, data, headers):
+        return _Response(data.count(b'\n') // 2)
+
+
+class _LegacyBulkProcessor(BulkProcessor):
+    """The original string buffer."""
+
+    legacy_entries = ""
+
+    def process_batch(self):
+        self.chunks = [self.legacy_entries.encode('utf-8')]
+        self.legacy_entries = ""
+        super().process_batch()
+
+    def _check_for_processing(self):
+        if len(self.legacy_entries.encode('utf-8')) > self.batch_max_size_bytes:
+            self.process_batch()
+        elif self.current_batch_size >= self.batch_size:
+            self.process_batch()
+
+    def index(self, index, entry, _id=None):
+        self._check_for_processing()
+        self.legacy_entries = self.legacy_entries + json.dumps({"index": {"_index": index}}) + "\n"
+        self.legacy_entries = self.legacy_entries + json.dumps(entry) + "\n"
+        self.current_batch_size += 1
+        self._check_for_processing()
+
+
+def run(processor_class, documents):
+    # Large enough that batches are bounded by the default 5MB size limit, as for small documents
+    processor = processor_class(_Session(), 'http://localhost:9200/', batch_size=1000000,
+                                batch_max_size_bytes=5000000)
+    start = time.perf_counter()
+    for i in range(documents):
+        processor.index('benchmark', {'id': i, 'ip_address': '203.0.113.{}'.format(i % 256), 'count': i % 7})
+    processor.close()
+    return documents / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--documents', type=int, default=1000000)
+    parser.add_argument('--legacy-documents', type=int, default=20000)
+    args = parser.parse_args()
+    logging.getLogger('elastic').setLevel(logging.ERROR)
+
+    print('{:<10} {:>12} {:>14}'.format('buffer', 'documents', 'docs/sec'))
+    print('{:<10} {:>12} {:>14,.0f}'.format('string', args.legacy_documents,
+                                           run(_LegacyBulkProcessor, args.legacy_documents)))
+    print('{:<10} {:>12} {:>14,.0f}'.format('chunks', args.documents, run(BulkProcessor, args.documents)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Cost of preparing a large _bulk request body and handling its response, per batch.
+
+Request bodies: size and time to compress a batch of small documents at several gzip levels.  Responses: the
+original handling (r.json() and a walk over every item of the full response) against the current handling of the
+response trimmed by BULK_FILTER_PATH, for a response without errors and one where 1% of the items failed.
+
+    python benchmarks/bulk_response_benchmark.py [--documents 50000]
+"""
+import argparse
+import gzip
+import json
+import timeit
+
+from digital_thought_commons.elasticsearch.bulkProcessor import _count_results, _parse_response
+
+
+def build_body(documents):
+    return ''.join(json.dumps({'index': {'_index': 'benchmark'}}) + '\n' +
+                   json.dumps({'id': i, 'ip_address': '203.0.113.{}'.format(i % 256), 'domain': 'host{}.example.com'
+                              .format(i % 1000), 'count': i % 7, 'tags': ['a', 'b']}) + '\n'
+                   for i in range(documents)).encode('utf-8')
+
+
+def build_response(documents, error_every=None, filtered=False):
+    items = []
+    for i in range(documents):
+        if error_every is not None and i % error_every == 0:
+            items.append({'index': {'_index': 'benchmark', '_id': str(i), 'status': 429,
+                                    'error': {'type': 'es_rejected_execution_exception', 'reason': 'rejected'}}})
+        elif filtered:
+            # As returned with BULK_FILTER_PATH
+            items.append({'index': {'_index': 'benchmark', '_id': str(i), 'result': 'created', 'status': 201}})
+        else:
+            items.append({'index': {'_index': 'benchmark', '_id': str(i), '_version': 1, 'result': 'created',
+                                    '_shards': {'total': 2, 'successful': 1, 'failed': 0}, '_seq_no': i,
+                                    '_primary_term': 1, 'status': 201}})
+    return json.dumps({'took': 120, 'errors': error_every is not None, 'items': items},
+                      separators=(',', ':')).encode('utf-8')
+
+
+def original(content):
+    resp_json = json.loads(content)
+    stats = {'errors': 0}
+    for item in resp_json['items']:
+        if "index" in item:
+            if 'error' in item['index']:
+                stats['errors'] = stats['errors'] + 1
+            else:
+                if item['index']['result'] not in stats:
+                    stats[item['index']['result']] = 0
+                stats[item['index']['result']] = stats[item['index']['result']] + 1
+    return stats
+
+
+def current(content):
+    took, errors, items = _parse_response(content)
+    stats = {'errors': 0}
+    if items is None:
+        stats.update(_count_results(content))
+        return stats
+    for item in items:
+        result = next(iter(item.values()))
+        if 'error' in result:
+            stats['errors'] += 1
+        else:
+            stats[result['result']] = stats.get(result['result'], 0) + 1
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--documents', type=int, default=50000)
+    parser.add_argument('--number', type=int, default=10)
+    args = parser.parse_args()
+
+    body = build_body(args.documents)
+    print('Request body: {} documents, {:,} bytes'.format(args.documents, len(body)))
+    print('{:<12} {:>14} {:>10}'.format('gzip level', 'bytes', 'ms'))
+    for level in [1, 3, 6, 9]:
+        compressed = gzip.compress(body, compresslevel=level)
+        elapsed = timeit.timeit(lambda: gzip.compress(body, compresslevel=level), number=args.number) / args.number
+        print('{:<12} {:>14,} {:>10.1f}'.format(level, len(compressed), elapsed * 1000))
+
+    print()
+    print('{:<12} {:>16} {:>14} {:>16} {:>14}'.format('response', 'original bytes', 'original ms', 'current bytes',
+                                                      'current ms'))
+    for name, error_every in [('no errors', None), ('1% errors', 100)]:
+        content = build_response(args.documents, error_every)
+        filtered = build_response(args.documents, error_every, filtered=True)
+        assert original(content) == current(filtered)
+        original_time = timeit.timeit(lambda: original(content), number=args.number) / args.number
+        current_time = timeit.timeit(lambda: current(filtered), number=args.number) / args.number
+        print('{:<12} {:>16,} {:>14.1f} {:>16,} {:>14.1f}'.format(name, len(content), original_time * 1000,
+                                                                 len(filtered), current_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Size and latency of the API cache codecs.
+
+Reads every entry of an existing SQLite cache file (legacy base64 rows or codec encoded rows) and re-encodes them
+with each available serializer/compression combination, reporting the stored size and the encode/decode cost per
+entry.  Without a cache file, synthetic VirusTotal style responses are used.
+
+    python benchmarks/cache_codec_benchmark.py --cache-file ./cache/virus_total.cache
+"""
+import argparse
+import base64
+import json
+import random
+import sqlite3
+import time
+
+from digital_thought_commons.cache import codecs
+from digital_thought_commons.cache.codecs import Codec
+
+
+def _synthetic_responses(count):
+    engines = ['Engine{}'.format(n) for n in range(70)]
+    responses = []
+    for n in range(count):
+        responses.append({'data': {'id': '10.{}.{}.{}'.format(n // 65536, (n // 256) % 256, n % 256), 'type': 'ip_address',
+                                   'attributes': {'as_owner': 'Example Networks', 'asn': random.randint(1000, 60000),
+                                                  'country': random.choice(['AU', 'US', 'NZ', 'GB']),
+                                                  'last_analysis_results': {engine: {'category': 'harmless', 'engine_name': engine,
+                                                                                     'method': 'blacklist', 'result': 'clean'}
+                                                                            for engine in engines},
+                                                  'last_analysis_stats': {'harmless': 70, 'malicious': 0, 'suspicious': 0},
+                                                  'reputation': 0, 'tags': []}}})
+    return responses
+
+
+def _cache_file_responses(cache_file):
+    reader = Codec()
+    connection = sqlite3.connect(cache_file)
+    responses = [reader.loads(reader.decode(row[0])) for row in connection.execute('SELECT encoded_response FROM cache')]
+    connection.close()
+    return responses
+
+
+def _legacy(responses):
+    start = time.perf_counter()
+    payloads = [base64.b64encode(json.dumps(response).encode('utf-8')).decode('utf-8') for response in responses]
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for payload in payloads:
+        json.loads(base64.b64decode(payload).decode('utf-8'))
+    return sum(len(payload) for payload in payloads), encode_time, time.perf_counter() - start
+
+
+def _codec(codec, responses):
+    start = time.perf_counter()
+    payloads = [codec.encode(codec.dumps(response)) for response in responses]
+    encode_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for payload in payloads:
+        codec.loads(codec.decode(payload))
+    return sum(len(payload) for payload in payloads), encode_time, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache-file')
+    parser.add_argument('--entries', type=int, default=5000)
+    args = parser.parse_args()
+
+    responses = _cache_file_responses(args.cache_file) if args.cache_file else _synthetic_responses(args.entries)
+    print('Entries: {}'.format(len(responses)))
+
+    results = [('legacy base64 json', _legacy(responses))]
+    serializers = ['json'] + [name for name, module in (('orjson', codecs.orjson), ('msgpack', codecs.msgpack)) if module is not None]
+    compressions = ['none', 'zlib'] + (['zstd'] if codecs.zstandard is not None else [])
+    for serializer in serializers:
+        for compression in compressions:
+            results.append(('{}+{}'.format(serializer, compression), _codec(Codec(serializer=serializer, compression=compression), responses)))
+
+    # zstd needs a reasonable number of samples to train a dictionary
+    if codecs.zstandard is not None and len(responses) >= 1000:
+        for serializer in serializers:
+            samples = [Codec(serializer=serializer).dumps(response) for response in responses[:1000]]
+            dictionary = codecs.train_zstd_dictionary(samples)
+            results.append(('{}+zstd dictionary'.format(serializer),
+                            _codec(Codec(serializer=serializer, compression='zstd', dictionary=dictionary), responses)))
+
+    legacy_size = results[0][1][0]
+    print('{:<24} {:>12} {:>8} {:>14} {:>14}'.format('codec', 'bytes/entry', 'ratio', 'encode us/ent', 'decode us/ent'))
+    for name, (size, encode_time, decode_time) in results:
+        print('{:<24} {:>12.0f} {:>8.2f} {:>14.1f} {:>14.1f}'.format(name, size / len(responses), size / legacy_size,
+                                                                     encode_time / len(responses) * 1e6,
+                                                                     decode_time / len(responses) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""
+Cost of generating the signature of a lookup, per call.
+
+Compares the original signature (SHA-256 over key=value pairs in call order) with the canonical blake2b signature
+for the kinds of arguments the restful_lookups pass to APICache.lookup.  Each time is the best of five runs.
+
+    python benchmarks/cache_keygen_benchmark.py
+"""
+import timeit
+
+from digital_thought_commons.cache.keys import SignatureGenerator
+
+CASES = {
+    'single ip_address': {'ip_address': '203.0.113.10'},
+    'ip_address + flag': {'ip_address': '203.0.113.10', 'advanced': True},
+    'query_url': {'query_url': 'ip_addresses/203.0.113.10/relationships/communicating_files'},
+    'flat list': {'ip_addresses': ['203.0.113.10', '203.0.113.11', '203.0.113.12'], 'limit': 100},
+    'nested filters': {'query': 'domain:example.com', 'filters': {'type': ['ip', 'domain'], 'limit': 100},
+                       'fields': ('a', 'b', 'c')},
+}
+
+
+def best_of(function, number, repeat=5):
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def main(number=100000):
+    legacy = SignatureGenerator('benchmark', version=0)
+    canonical = SignatureGenerator('benchmark', version=1)
+    print('{:<20} {:>14} {:>14}'.format('arguments', 'legacy us', 'canonical us'))
+    for name, kwargs in CASES.items():
+        legacy_time = best_of(lambda: legacy.signature(kwargs), number)
+        canonical_time = best_of(lambda: canonical.signature(kwargs), number)
+        print('{:<20} {:>14.2f} {:>14.2f}'.format(name, legacy_time * 1e6, canonical_time * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Download throughput of DownloadManager against a local HTTP server, by worker count.
+
+The server serves --size-mb of data from memory, honouring byte ranges.  With --connection-mbps each connection is
+limited to that rate, as many servers limit it, which is where more workers pay off; without it the numbers show
+the overhead of the download path itself.  --slow-mbps limits only the connections reading from the start of the
+file, a single slow mirror connection, and --static turns off the splitting of segments between workers for
+comparison.  Each download is written to a temporary directory and removed.
+
+    python benchmarks/download_benchmark.py [--size-mb 256] [--workers 1 2 4 8] [--connection-mbps 0]
+                                            [--slow-mbps 0] [--static] [--chunk-kb 512] [--buffer-kb 0] [--fsync]
+"""
+import argparse
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from digital_thought_commons.internet.download_manager import DownloadManager
+
+
+def build_handler(content, connection_rate, slow_rate=0):
+    class RangeHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def __send_headers(self):
+            match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            start, end = 0, len(content) - 1
+            if match is None:
+                self.send_response(200)
+            else:
+                start = int(match.group(1))
+                end = int(match.group(2)) if match.group(2) else end
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{len(content)}')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            return start, end
+
+        def do_HEAD(self):
+            self.__send_headers()
+
+        def do_GET(self):
+            start, end = self.__send_headers()
+            rate = slow_rate if slow_rate > 0 and start == 0 else connection_rate
+            view = memoryview(content)
+            block = 1024 * 256
+            started = time.perf_counter()
+            for offset in range(start, end + 1, block):
+                self.wfile.write(view[offset:min(offset + block, end + 1)])
+                if rate > 0:
+                    # Sleep until this connection is back within its rate
+                    ahead = (offset + block - start) / rate - (time.perf_counter() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        def log_message(self, format, *args):
+            pass
+
+    return RangeHandler
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Workers close their connection early once the rest of their segment is taken by another worker
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--connection-mbps', type=float, default=0)
+    parser.add_argument('--slow-mbps', type=float, default=0)
+    parser.add_argument('--static', action='store_true')
+    parser.add_argument('--chunk-kb', type=int, default=512)
+    parser.add_argument('--buffer-kb', type=int, default=0)
+    parser.add_argument('--fsync', action='store_true')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    content = os.urandom(args.size_mb * 1024 * 1024)
+    server = QuietServer(('127.0.0.1', 0), build_handler(content, args.connection_mbps * 1024 * 1024 / 8,
+                                                                   args.slow_mbps * 1024 * 1024 / 8))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:{}/benchmark.bin'.format(server.server_address[1])
+
+    print('{} MB, chunk {} KB, buffer {} KB, fsync {}, connection limit {}, slow connection {}, {} segments'.format(
+        args.size_mb, args.chunk_kb, args.buffer_kb, 'on' if args.fsync else 'off',
+        '{} Mbit/s'.format(args.connection_mbps) if args.connection_mbps > 0 else 'none',
+        '{} Mbit/s'.format(args.slow_mbps) if args.slow_mbps > 0 else 'none', 'static' if args.static else 'dynamic'))
+    print('{:>8} {:>10} {:>10}'.format('workers', 'seconds', 'MB/s'))
+    for workers in args.workers:
+        # Static: one segment per worker, each too large a share for another worker to split it
+        segmentation = {'segments_per_worker': 1, 'min_segment_size': len(content) // workers} if args.static else {}
+        manager = DownloadManager(chunk_size=args.chunk_kb * 1024, buffer_size=args.buffer_kb * 1024,
+                                  fsync_on_checkpoint=args.fsync, **segmentation)
+        with tempfile.TemporaryDirectory() as directory:
+            started = time.perf_counter()
+            job = manager.download(url, directory, override_worker_count=workers)
+            elapsed = time.perf_counter() - started
+            assert not job.errors and os.path.getsize(job.downloaded_file()) == len(content)
+        print('{:>8} {:>10.2f} {:>10.1f}'.format(workers, elapsed, args.size_mb / elapsed))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
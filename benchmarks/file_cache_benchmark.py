@@ -0,0 +1,104 @@
+"""
+Lookup latency of the SQLite file cache with a large number of cached rows.
+
+Populates a cache file with the legacy (unindexed) schema, measures lookups against it, then opens the same file
+through FileCacheBackend, which migrates it to the indexed WAL layout, and measures again.
+
+    python benchmarks/file_cache_benchmark.py --rows 1000000
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from digital_thought_commons.cache.backends import FileCacheBackend
+
+CACHE_NAME = 'benchmark'
+
+
+def _signature(n):
+    return hashlib.sha256('{}ip_address=10.{}'.format(CACHE_NAME, n).encode('utf-8')).hexdigest()
+
+
+def _populate_legacy(cache_file, rows, timestamp):
+    connection = sqlite3.connect(cache_file)
+    connection.execute('CREATE TABLE cache (id integer PRIMARY KEY, signature_hash text, lookup_timestamp integer, '
+                       'encoded_response text, username text, cache_name text)')
+    payload = base64.b64encode(json.dumps({'country': 'AU', 'asn': 1234, 'tags': ['a', 'b']}).encode('utf-8')).decode('utf-8')
+    batch = []
+    for n in range(rows):
+        batch.append((_signature(n), timestamp, payload, 'benchmark', CACHE_NAME))
+        if len(batch) == 100000:
+            connection.executemany('INSERT INTO cache(signature_hash, lookup_timestamp, encoded_response, username, '
+                                   'cache_name) VALUES(?,?,?,?,?)', batch)
+            batch.clear()
+    connection.executemany('INSERT INTO cache(signature_hash, lookup_timestamp, encoded_response, username, cache_name) '
+                           'VALUES(?,?,?,?,?)', batch)
+    connection.commit()
+    connection.close()
+
+
+def _report(label, timings):
+    timings = sorted(timings)
+    print('{:<28} lookups: {:>6}  mean: {:>10.1f}us  p50: {:>10.1f}us  p99: {:>10.1f}us'.format(
+        label, len(timings), sum(timings) / len(timings) * 1e6, timings[len(timings) // 2] * 1e6,
+        timings[int(len(timings) * 0.99)] * 1e6))
+
+
+def _time_lookups(lookup, signatures):
+    timings = []
+    for signature in signatures:
+        start = time.perf_counter()
+        lookup(signature)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--legacy-lookups', type=int, default=20)
+    args = parser.parse_args()
+
+    timestamp = int(round(time.time() * 1000))
+    with tempfile.TemporaryDirectory() as directory:
+        cache_file = os.path.join(directory, CACHE_NAME + '.cache')
+        start = time.perf_counter()
+        _populate_legacy(cache_file, args.rows, timestamp)
+        print('Populated {} rows in {:.1f}s'.format(args.rows, time.perf_counter() - start))
+
+        hits = [_signature(random.randrange(args.rows)) for _ in range(args.lookups)]
+        misses = [_signature(args.rows + n) for n in range(args.lookups)]
+
+        legacy = sqlite3.connect(cache_file)
+
+        def legacy_lookup(signature):
+            legacy.execute('SELECT lookup_timestamp, encoded_response FROM cache WHERE signature_hash=? AND '
+                           'lookup_timestamp>=?', (signature, 0)).fetchall()
+
+        _report('legacy (full scan) hit', _time_lookups(legacy_lookup, hits[:args.legacy_lookups]))
+        legacy.close()
+
+        start = time.perf_counter()
+        backend = FileCacheBackend(CACHE_NAME, {'file': {'cache_location': directory}}, max_age=345600000)
+        print('Migrated to indexed layout in {:.1f}s'.format(time.perf_counter() - start))
+
+        _report('indexed hit', _time_lookups(lambda signature: backend.lookup(signature, 0), hits))
+        _report('indexed miss', _time_lookups(lambda signature: backend.lookup(signature, 0), misses))
+
+        start = time.perf_counter()
+        for chunk_start in range(0, len(hits), 1000):
+            backend.lookup_many(hits[chunk_start:chunk_start + 1000], 0)
+        print('{:<28} {:>10.1f}us per signature'.format('indexed lookup_many(1000)',
+                                                       (time.perf_counter() - start) / len(hits) * 1e6))
+        backend.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Hits per second read through ScrollQuery when each page takes a network round trip and each hit takes some work to
+consume, with and without reading ahead.
+
+The scroll API is answered locally after --latency-ms per request; the consumer spends --work-us of CPU per hit.
+
+    python benchmarks/scroll_prefetch_benchmark.py [--pages 100] [--page-size 1000] [--latency-ms 50] [--work-us 50]
+"""
+import argparse
+import time
+
+from digital_thought_commons.elasticsearch.scrollQuery import ScrollQuery
+
+
+class _Response:
+    status_code = 200
+
+    def __init__(self, body):
+        self.__body = body
+
+    def json(self):
+        return self.__body
+
+
+class _ScrollSession:
+
+    def __init__(self, pages, page_size, latency):
+        self.pages = pages
+        self.page_size = page_size
+        self.latency = latency
+        self.served = {}
+
+    def post(self, url, json=None):
+        time.sleep(self.latency)
+        scroll_id = json['scroll_id'] if url.endswith('_search/scroll') else 'scroll-{}'.format(len(self.served))
+        page = self.served.get(scroll_id, 0)
+        self.served[scroll_id] = page + 1
+        hits = [{'_id': str(page * self.page_size + i), '_source': {'n': i}} for i in range(self.page_size)] \
+            if page < self.pages else []
+        return _Response({'_scroll_id': scroll_id, 'hits': {'hits': hits}})
+
+    def delete(self, url, json=None):
+        return _Response({})
+
+
+def consume(hits, work):
+    count = 0
+    for _ in hits:
+        deadline = time.perf_counter() + work
+        while time.perf_counter() < deadline:
+            pass
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--work-us', type=float, default=50)
+    args = parser.parse_args()
+
+    print('{:<10} {:>10} {:>14}'.format('prefetch', 'seconds', 'hits/sec'))
+    for prefetch in [0, 1, 2, 4]:
+        session = _ScrollSession(args.pages, args.page_size, args.latency_ms / 1000)
+        scroll_query = ScrollQuery(session, 'http://localhost:9200/', page_size=args.page_size, prefetch=prefetch)
+        start = time.perf_counter()
+        count = consume(scroll_query.query('benchmark', {}), args.work_us / 1e6)
+        elapsed = time.perf_counter() - start
+        print('{:<10} {:>10.2f} {:>14,.0f}'.format(prefetch, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
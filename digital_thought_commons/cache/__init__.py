@@ -1,67 +1,34 @@
-import _sqlite3
-import base64
 import getpass
-import hashlib
-import json
 import logging
 import os
 import pathlib
+import threading
 import time
-from _sqlite3 import Error
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 
-from digital_thought_commons import elasticsearch
+from digital_thought_commons.cache import snapshots
+from digital_thought_commons.cache.backends import ElasticCacheBackend, FileCacheBackend, create_backend
+from digital_thought_commons.cache.codecs import Codec
+from digital_thought_commons.cache.keys import SignatureGenerator
+from digital_thought_commons.cache.memory_cache import MemoryCache
+from digital_thought_commons.cache import metrics
+from digital_thought_commons.cache.metrics import CacheMetrics
+from digital_thought_commons.cache.policy import CachePolicy
+from digital_thought_commons.cache.single_flight import SingleFlight
 
 cache_resource_folder = "{}/../_resources/cache".format(str(pathlib.Path(__file__).parent.absolute()))
 default_cache_configuration_file = f'{cache_resource_folder}/default_cache_config.yaml'
 system_cache_configuration_file = './config/loggingConfig.yaml'
 
 
-class QueueCache:
-
-    def __init__(self, size, name):
-        self.size = size
-        self.name = name
-        self.queue_keys = []
-        self.queue = {}
-
-    def put(self, key, obj):
-        if len(self.queue_keys) >= self.size:
-            last_index = self.queue_keys[0]
-            try:
-                self.queue.pop(last_index)
-                self.queue_keys.remove(last_index)
-                logging.debug("Queue Full. Removing key {} from QueueCache: {}".format(key, self.name))
-            except:
-                logging.debug("Error Removing Key  {} from QueueCache: {}".format(key, self.name))
-
-        self.queue_keys.append(key)
-        self.queue[key] = obj
-
-    def lookup(self, key):
-        obj = None
-        if key in self.queue_keys:
-            try:
-                obj = self.queue[key]
-                self.queue.pop(key)
-                self.queue_keys.remove(key)
-                logging.debug("Retrieved key {} from QueueCache: {}".format(key, self.name))
-            except:
-                logging.debug("Error Retrieving Key  {} from QueueCache: {}".format(key, self.name))
-
-        return obj
-
-    def items(self):
-        return self.queue
-
-    def keys(self):
-        return self.queue_keys
+QueueCache = MemoryCache
 
 
 class APICache:
 
-    def __init__(self, cache_name, custom_config_file: str = None):
+    def __init__(self, cache_name, custom_config_file: str = None, key_version: int = None):
         if custom_config_file and os.path.exists(custom_config_file):
             self.configuration_file = custom_config_file
         elif custom_config_file and not os.path.exists(custom_config_file):
@@ -74,160 +41,389 @@ class APICache:
         with open(self.configuration_file, 'r') as config_file:
             self.config = yaml.safe_load(config_file)
         self.cache_name = cache_name
-        self.memory_cache = QueueCache(self.config['memory_cache_size'], self.cache_name)
-        if self.config['cache_type'] == 'file':
-            self.__configure_file_cache()
-        elif self.config['cache_type'] == 'elastic':
-            self.__configure_elastic_cache()
-        else:
-            raise Exception("Unknown Cache Type: {}".format(self.config['cache_type']))
-
-        self.max_age = self.config['default_max_age']
+        self.policy = CachePolicy.from_config(self.config, self.cache_name)
+        self.max_age = self.policy.max_age
 
-        if self.cache_name.replace(' ', '_') + '_max_age' in self.config:
-            self.max_age = self.config[self.cache_name.replace(' ', '_') + '_max_age']
+        self.backend = create_backend(self.cache_name, self.config, self.policy.retention)
 
-    def __configure_elastic_cache(self):
-        self.elastic_connection = elasticsearch.ElasticsearchConnection(api_key=self.config['elastic']['api_key'],
-                                                                        server=self.config['elastic']['server'],
-                                                                        port=self.config['elastic']['port'])
+        self.codec = Codec.from_config(self.config, self.cache_name)
 
-    def __configure_file_cache(self):
-        self.cache_location = r'.\cache'
-        if 'cache_location' in self.config['file']:
-            self.cache_location = self.config['file']['cache_location']
+        self.signature_generator = SignatureGenerator(self.cache_name,
+                                                      self.policy.key_version if key_version is None else key_version)
 
-        if not os.path.exists(self.cache_location):
-            os.mkdir(self.cache_location)
+        self.memory_cache = MemoryCache(self.config['memory_cache_size'], self.cache_name, max_age=self.max_age,
+                                        max_bytes=self.config.get('memory_cache_max_bytes'))
+        self.__single_flight = SingleFlight()
+        self.__refresh_executor = ThreadPoolExecutor(max_workers=self.config.get('refresh_workers', 2),
+                                                     thread_name_prefix='APICacheRefresh:[{}]'.format(self.cache_name))
+        self.__refreshing = set()
+        self.__refreshing_lock = threading.Lock()
+        self.metrics = CacheMetrics.for_cache(self.cache_name)
+        self.__backend_tier = self.config['cache_type']
+        if self.config.get('metrics_emit_interval'):
+            metrics.start_emitter(self.config['metrics_emit_interval'])
 
-        self.cache_file = self.cache_location + '/' + self.cache_name.replace(' ', '_') + '.cache'
-
-        try:
-            self.connection = _sqlite3.connect(self.cache_file, check_same_thread=False)
-            self.__create_table()
-            logging.info('Initialised cache for {} located at {}'.format(self.cache_name, self.cache_file))
-        except Error as er:
-            logging.exception('Error occurred while initialising cache file {}'.format(self.cache_file), er)
-            raise er
-
-    def __create_table(self):
-        create_cache_table = """ CREATE TABLE IF NOT EXISTS cache (
-                                                id integer PRIMARY KEY,
-                                                signature_hash text,
-                                                lookup_timestamp integer,
-                                                encoded_response text,
-                                                username text,
-                                                cache_name text
-                                            ); """
-        self.connection.execute(create_cache_table)
+        if self.config.get('memory_cache_warm_entries'):
+            self.warm(self.config['memory_cache_warm_entries'])
 
     def __generate_hash(self, args):
-        signature_string = self.cache_name
-        for key, value in args.items():
-            signature_string += '{}={}'.format(key, value)
+        return self.signature_generator.signature(args)
 
-        return hashlib.sha256(bytes(signature_string, 'utf-8')).hexdigest()
+    @staticmethod
+    def __current_timestamp():
+        return int(round(time.time() * 1000))
 
-    def __lookup_file_cache(self, signature_hash, current_timestamp):
-        encoded_value = None
+    @staticmethod
+    def __is_negative(json_resp):
+        return 'error' in json_resp
+
+    def __lookup_cache(self, signature_hash, current_timestamp):
         try:
             logging.debug('Looking up signature {} in cache that is not older than {}'.
-                          format(signature_hash, str(current_timestamp - self.max_age)))
-            cursor = self.connection.cursor()
-            cursor.execute("SELECT lookup_timestamp, encoded_response FROM cache WHERE signature_hash=? "
-                           "AND lookup_timestamp>=?", (signature_hash, current_timestamp - self.max_age))
-
-            recent_timestamp = 0
-            for row in cursor.fetchall():
-                if row[0] > recent_timestamp:
-                    encoded_value = base64.b64decode(row[1]).decode("UTF-8")
-                    recent_timestamp = row[0]
-
+                          format(signature_hash, str(current_timestamp - self.policy.retention)))
+            encoded_response, lookup_timestamp = self.backend.lookup(signature_hash,
+                                                                     current_timestamp - self.policy.retention)
+            if encoded_response is not None:
+                return self.codec.decode(encoded_response), lookup_timestamp, self.codec.is_negative(encoded_response)
         except Exception as ex:
+            self.metrics.increment('cache_errors')
             logging.exception("Error encountered while looking up cache signature: {}".format(signature_hash), ex)
 
-        return encoded_value
+        return None, 0, False
 
-    def __lookup_elastic_cache(self, signature_hash, current_timestamp):
-        encoded_value = None
+    def __lookup_cache_many(self, signature_hashes, current_timestamp):
         try:
-            logging.debug('Looking up signature {} in cache that is not older than {}'.
-                          format(signature_hash, str(current_timestamp - self.max_age)))
-            query = {"size": 100, "query": {"bool": {"must": [{"term": {"signature_hash": signature_hash}},
-                                                              {"range": {"lookup_timestamp": {
-                                                                  "gte": current_timestamp - self.max_age}
-                                                              }}]}}}
-
-            recent_timestamp = 0
-            scroll_query = self.elastic_connection.get_scroller()
-            for entry in scroll_query.query("api-cache", query):
-                if entry['_source']['lookup_timestamp'] > recent_timestamp:
-                    encoded_value = base64.b64decode(entry['_source']['encoded_response']).decode("UTF-8")
-                    recent_timestamp = entry['_source']['lookup_timestamp']
-            scroll_query.clear()
+            logging.debug('Looking up {} signatures in cache that are not older than {}'.
+                          format(len(signature_hashes), str(current_timestamp - self.policy.retention)))
+            found = self.backend.lookup_many(signature_hashes, current_timestamp - self.policy.retention)
+            return {signature_hash: (self.codec.decode(encoded_response), lookup_timestamp,
+                                     self.codec.is_negative(encoded_response))
+                    for signature_hash, (encoded_response, lookup_timestamp) in found.items()}
         except Exception as ex:
-            logging.exception("Error encountered while looking up cache signature: {}".format(signature_hash), ex)
-
-        return encoded_value
-
-    def __lookup_cache(self, signature_hash, current_timestamp):
-        if self.config['cache_type'] == 'file':
-            return self.__lookup_file_cache(signature_hash=signature_hash, current_timestamp=current_timestamp)
-        elif self.config['cache_type'] == 'elastic':
-            return self.__lookup_elastic_cache(signature_hash=signature_hash, current_timestamp=current_timestamp)
+            self.metrics.increment('cache_errors')
+            logging.exception("Error encountered while looking up {} cache signatures".format(len(signature_hashes)), ex)
+
+        return {}
+
+    def __accept_cached(self, signature_hash, response, lookup_timestamp, negative, current_timestamp, lookup_method,
+                        kwargs):
+        """
+        Returns a cached response and the tier that resolved it if it is fresh, or stale but within
+        stale_while_revalidate, otherwise (None, None).
+        """
+        if negative and not self.policy.caches_errors():
+            # Stored while error responses were cached, which they no longer are
+            self.__delete_from_cache(signature_hash)
+            return None, None
+
+        age = current_timestamp - lookup_timestamp
+        entry_max_age = self.policy.entry_max_age(signature_hash, negative)
+        if self.policy.is_fresh(age, entry_max_age):
+            self.memory_cache.put(signature_hash, response, timestamp=lookup_timestamp, max_age=entry_max_age)
+            return response, self.__backend_tier
+
+        if self.policy.is_stale_servable(age, entry_max_age):
+            logging.debug('Serving stale signature {} while it is refreshed'.format(signature_hash))
+            self.__refresh_in_background(signature_hash, lookup_method, kwargs)
+            return response, 'stale'
+
+        return None, None
+
+    def __delete_from_cache(self, signature_hash):
+        try:
+            logging.debug('Deleting signature {} from cache'.format(signature_hash))
+            self.backend.delete(signature_hash)
+        except Exception as ex:
+            self.metrics.increment('cache_errors')
+            logging.exception("Error encountered while deleting cache signature: {}".format(signature_hash), ex)
 
-    def __store_to_file_cache(self, signature_hash, current_timestamp, encoded_response, username):
+    def __store_to_cache(self, signature_hash, current_timestamp, response, negative):
         try:
-            logging.debug('Storing signature {} in cache'.
-                          format(signature_hash))
-
-            cursor = self.connection.cursor()
-            cursor.execute("INSERT INTO cache(signature_hash, lookup_timestamp, encoded_response, cache_name, username)"
-                           " VALUES(?,?,?,?,?)",
-                           (signature_hash, current_timestamp, encoded_response, self.cache_name, username))
-            self.connection.commit()
+            logging.debug('Storing signature {} in cache'.format(signature_hash))
+            payload = self.codec.encode(response, negative=negative)
+            self.backend.store(signature_hash, current_timestamp, payload, getpass.getuser())
+            self.metrics.increment('stored_entries')
+            self.metrics.increment('stored_bytes', len(payload))
         except Exception as ex:
+            self.metrics.increment('cache_errors')
             logging.exception("Error encountered while storing to cache signature: {}".format(signature_hash), ex)
 
-    def __store_to_elastic_cache(self, signature_hash, current_timestamp, encoded_response, username):
+    def __store_to_cache_many(self, entries):
         try:
-            doc = {'signature_hash': signature_hash, 'encoded_response': encoded_response,
-                   'cache_name': self.cache_name, 'lookup_timestamp': current_timestamp,
-                   'username': username}
-
-            resp = self.elastic_connection.index_document(index='api-cache', document=doc)
+            logging.debug('Storing {} signatures in cache'.format(len(entries)))
+            username = getpass.getuser()
+            encoded = [(signature_hash, current_timestamp, self.codec.encode(response, negative=negative), username)
+                       for signature_hash, current_timestamp, response, negative in entries]
+            self.backend.store_many(encoded)
+            self.metrics.increment('stored_entries', len(encoded))
+            self.metrics.increment('stored_bytes', sum(len(entry[2]) for entry in encoded))
+        except Exception as ex:
+            self.metrics.increment('cache_errors')
+            logging.exception("Error encountered while storing {} signatures to cache".format(len(entries)), ex)
+
+    def __lookup_live(self, signature_hash, lookup_method, kwargs):
+        current_timestamp = self.__current_timestamp()
+        logging.debug('Looking up signature {} from live source'.format(signature_hash))
+        json_resp = lookup_method(**kwargs)
+        response = self.codec.dumps(json_resp)
+        negative = self.__is_negative(json_resp)
+        self.__record_upstream(response, negative)
+
+        if not negative or self.policy.caches_errors():
+            self.__store_to_cache(signature_hash, current_timestamp, response, negative)
+            self.memory_cache.put(signature_hash, response, timestamp=current_timestamp,
+                                  max_age=self.policy.entry_max_age(signature_hash, negative))
+
+        return response
+
+    def __record_upstream(self, response, negative, calls=1):
+        self.metrics.increment('upstream_calls', calls)
+        self.metrics.increment('upstream_bytes', len(response))
+        if negative:
+            self.metrics.increment('upstream_errors')
+
+    def __refresh(self, signature_hash, lookup_method, kwargs):
+        try:
+            current_timestamp = self.__current_timestamp()
+            json_resp = lookup_method(**kwargs)
+            self.metrics.increment('upstream_calls')
+            if self.__is_negative(json_resp):
+                self.metrics.increment('upstream_errors')
+                # Keep serving the stale entry rather than replacing it with an error
+                logging.warning('Refresh of signature {} returned an error: {}'.format(signature_hash, json_resp['error']))
+                return
+
+            response = self.codec.dumps(json_resp)
+            self.metrics.increment('upstream_bytes', len(response))
+            self.__store_to_cache(signature_hash, current_timestamp, response, False)
+            self.memory_cache.put(signature_hash, response, timestamp=current_timestamp,
+                                  max_age=self.policy.entry_max_age(signature_hash))
+        except Exception as ex:
+            logging.exception("Error encountered while refreshing cache signature: {}".format(signature_hash), ex)
+        finally:
+            with self.__refreshing_lock:
+                self.__refreshing.discard(signature_hash)
+
+    def __refresh_in_background(self, signature_hash, lookup_method, kwargs):
+        with self.__refreshing_lock:
+            if signature_hash in self.__refreshing:
+                return
+            self.__refreshing.add(signature_hash)
+        self.__refresh_executor.submit(self.__refresh, signature_hash, lookup_method, kwargs)
+
+    def __resolve(self, signature_hash, lookup_method, kwargs):
+        # Another caller may have completed the same lookup between the memory cache miss and joining the flight
+        response = self.memory_cache.lookup(signature_hash)
+        if response is not None:
+            return response, 'memory'
 
-            if resp['status_code'] != 201:
-                raise Exception('Failed to store item to Elastic cache: {}'.format(str(resp)))
+        current_timestamp = self.__current_timestamp()
+        tier = None
+        response, lookup_timestamp, negative = self.__lookup_cache(signature_hash, current_timestamp)
+        if response is not None:
+            response, tier = self.__accept_cached(signature_hash, response, lookup_timestamp, negative,
+                                                  current_timestamp, lookup_method, kwargs)
 
-        except Exception as ex:
-            logging.exception("Error encountered while storing to cache signature: {}".format(signature_hash), ex)
+        if response is None:
+            response, tier = self.__lookup_live(signature_hash, lookup_method, kwargs), 'live'
 
-    def __store_to_cache(self, signature_hash, current_timestamp, response):
-        username = getpass.getuser()
-        encoded_response = base64.b64encode(response.encode("UTF-8")).decode("UTF-8")
-        if self.config['cache_type'] == 'file':
-            self.__store_to_file_cache(signature_hash, current_timestamp, encoded_response, username)
-        elif self.config['cache_type'] == 'elastic':
-            self.__store_to_elastic_cache(signature_hash, current_timestamp, encoded_response, username)
+        return response, tier
 
     def lookup(self, lookup_method, **kwargs):
+        start = time.perf_counter()
         signature_hash = self.__generate_hash(kwargs)
-        current_timestamp = int(round(time.time() * 1000))
-
-        response = self.memory_cache.lookup(signature_hash)
 
+        response, tier = self.memory_cache.lookup(signature_hash), 'memory'
         if response is None:
-            response = self.__lookup_cache(signature_hash, current_timestamp)
-
-        if response is None:
-            logging.debug('Looking up signature {} from live source'.
-                          format(signature_hash))
-            json_resp = lookup_method(**kwargs)
-            response = json.dumps(json_resp)
-
-            if self.config['cache_error_responses'] or 'error' not in json_resp:
-                self.__store_to_cache(signature_hash, current_timestamp, response)
-
-        self.memory_cache.put(signature_hash, response)
-        return json.loads(response)
+            # Concurrent lookups of the same signature share a single cache or live source lookup
+            response, tier = self.__single_flight.do(signature_hash, self.__resolve, signature_hash, lookup_method,
+                                                     kwargs)
+
+        self.metrics.record_resolution(tier, time.perf_counter() - start)
+        return self.codec.loads(response)
+
+    def lookup_many(self, lookup_method, kwargs_list, batch_lookup_method=None):
+        """
+        Looks up many signatures at once, returning the responses in the same order as kwargs_list.
+
+        Signatures are resolved against the memory cache first, the remainder with a single batched query against the
+        file or elastic cache.  Only the signatures still missing are obtained from the live source, either one at a
+        time through lookup_method or, if provided, with a single call to batch_lookup_method, which is passed the list
+        of kwargs and must return a list of responses in the same order.  New entries are stored in one transaction
+        (file) or one bulk request (elastic).
+        """
+        start = time.perf_counter()
+        current_timestamp = self.__current_timestamp()
+        signature_hashes = [self.__generate_hash(kwargs) for kwargs in kwargs_list]
+        signature_kwargs = dict(zip(signature_hashes, kwargs_list))
+        responses = {}
+
+        for signature_hash in signature_kwargs.keys():
+            response = self.memory_cache.lookup(signature_hash)
+            if response is not None:
+                responses[signature_hash] = response
+        if len(responses) > 0:
+            self.metrics.record_resolution('memory', time.perf_counter() - start, len(responses))
+
+        missing = [signature_hash for signature_hash in signature_kwargs.keys() if signature_hash not in responses]
+        if len(missing) > 0:
+            start = time.perf_counter()
+            resolved = {}
+            cached = self.__lookup_cache_many(missing, current_timestamp)
+            for signature_hash, (response, lookup_timestamp, negative) in cached.items():
+                response, tier = self.__accept_cached(signature_hash, response, lookup_timestamp, negative,
+                                                      current_timestamp, lookup_method, signature_kwargs[signature_hash])
+                if response is not None:
+                    responses[signature_hash] = response
+                    resolved[tier] = resolved.get(tier, 0) + 1
+            elapsed = time.perf_counter() - start
+            for tier, count in resolved.items():
+                self.metrics.record_resolution(tier, elapsed, count)
+
+        live_kwargs = {signature_hash: kwargs for signature_hash, kwargs in signature_kwargs.items()
+                       if signature_hash not in responses}
+
+        if len(live_kwargs) > 0:
+            start = time.perf_counter()
+            logging.debug('Looking up {} signatures from live source'.format(len(live_kwargs)))
+            if batch_lookup_method is not None:
+                json_resps = list(batch_lookup_method(list(live_kwargs.values())))
+                if len(json_resps) != len(live_kwargs):
+                    raise ValueError('{} returned {} responses for {} lookups'.format(
+                        getattr(batch_lookup_method, '__qualname__', repr(batch_lookup_method)), len(json_resps),
+                        len(live_kwargs)))
+            else:
+                json_resps = [lookup_method(**kwargs) for kwargs in live_kwargs.values()]
+
+            new_entries = []
+            for signature_hash, json_resp in zip(live_kwargs.keys(), json_resps):
+                response = self.codec.dumps(json_resp)
+                responses[signature_hash] = response
+                negative = self.__is_negative(json_resp)
+                self.__record_upstream(response, negative, calls=0 if batch_lookup_method is not None else 1)
+                if not negative or self.policy.caches_errors():
+                    self.memory_cache.put(signature_hash, response, timestamp=current_timestamp,
+                                          max_age=self.policy.entry_max_age(signature_hash, negative))
+                    new_entries.append((signature_hash, current_timestamp, response, negative))
+
+            if batch_lookup_method is not None:
+                self.metrics.increment('upstream_calls')
+            self.metrics.record_resolution('live', time.perf_counter() - start, len(live_kwargs))
+
+            if len(new_entries) > 0:
+                self.__store_to_cache_many(new_entries)
+
+        return [self.codec.loads(responses[signature_hash]) for signature_hash in signature_hashes]
+
+    def warm(self, count=None):
+        """
+        Loads the count (default: the memory cache size) most recently stored entries that are still fresh from the
+        file or elastic cache into the memory cache, returning the number loaded.
+        """
+        if count is None:
+            count = self.memory_cache.size
+        current_timestamp = self.__current_timestamp()
+        entries = []
+        try:
+            for signature_hash, lookup_timestamp, encoded_response, _ in \
+                    self.backend.entries(current_timestamp - self.policy.retention, limit=count):
+                negative = self.codec.is_negative(encoded_response)
+                if negative and not self.policy.caches_errors():
+                    continue
+                entry_max_age = self.policy.entry_max_age(signature_hash, negative)
+                if self.policy.is_fresh(current_timestamp - lookup_timestamp, entry_max_age):
+                    entries.append((signature_hash, self.codec.decode(encoded_response), lookup_timestamp,
+                                    entry_max_age))
+        except Exception as ex:
+            logging.exception("Error encountered while warming memory cache: {}".format(self.cache_name), ex)
+
+        # Oldest first, so the newest entries are the last to be evicted
+        for signature_hash, response, lookup_timestamp, entry_max_age in reversed(entries):
+            self.memory_cache.put(signature_hash, response, timestamp=lookup_timestamp, max_age=entry_max_age)
+        logging.info('Warmed memory cache {} with {} entries'.format(self.cache_name, len(entries)))
+        return len(entries)
+
+    def __entries(self):
+        return self.backend.entries(self.__current_timestamp() - self.policy.retention)
+
+    @staticmethod
+    def __transfer(entries, backend, batch_size=1000):
+        count = 0
+        batch = []
+        for entry in entries:
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                backend.store_many(batch)
+                count += len(batch)
+                batch = []
+        if len(batch) > 0:
+            backend.store_many(batch)
+            count += len(batch)
+        backend.flush()
+        return count
+
+    def export_snapshot(self, path):
+        """
+        Writes the unexpired entries of this cache to path, as NDJSON (.ndjson or .ndjson.gz) or SQLite (.sqlite),
+        returning the number written.  Payloads are written as stored, so the snapshot keeps their codec.
+        """
+        snapshot_format = snapshots.snapshot_format(path)
+        if snapshot_format == 'ndjson':
+            count = snapshots.write_ndjson(path, self.cache_name, self.signature_generator.version, self.__entries())
+        else:
+            count = snapshots.write_sqlite(path, self.cache_name, self.__entries())
+        logging.info('Exported {} entries of cache {} to {}'.format(count, self.cache_name, path))
+        return count
+
+    def import_snapshot(self, path):
+        """
+        Stores the entries of a snapshot written by export_snapshot in the file or elastic cache, returning the number
+        imported.  Existing entries are only replaced by newer ones.
+        """
+        if snapshots.snapshot_format(path) == 'ndjson':
+            header, entries = snapshots.read_ndjson(path)
+            if header.get('cache_name') != self.cache_name or \
+                    header.get('key_version') != self.signature_generator.version:
+                logging.warning('Snapshot {} was exported from cache {} (key version {}), its entries will not be found '
+                                'by cache {} (key version {})'.format(path, header.get('cache_name'),
+                                                                     header.get('key_version'), self.cache_name,
+                                                                     self.signature_generator.version))
+        else:
+            entries = snapshots.read_sqlite(path, self.cache_name)
+
+        count = self.__transfer(entries, self.backend)
+        logging.info('Imported {} entries from {} into cache {}'.format(count, path, self.cache_name))
+        return count
+
+    def migrate_to(self, target_config_file):
+        """
+        Copies the unexpired entries of this cache to the backend configured in target_config_file, e.g. from the
+        file cache to the elastic cache, returning the number copied.
+        """
+        with open(target_config_file, 'r') as config_file:
+            target_config = yaml.safe_load(config_file)
+        target_backend = create_backend(self.cache_name, target_config, self.policy.retention)
+        try:
+            count = self.__transfer(self.__entries(), target_backend)
+        finally:
+            target_backend.close()
+        logging.info('Migrated {} entries of cache {} to the {} cache'.format(count, self.cache_name,
+                                                                         target_config['cache_type']))
+        return count
+
+    def stats(self):
+        """Returns the lookup metrics of this cache_name, together with the statistics of the memory cache."""
+        stats = self.metrics.snapshot()
+        stats['memory_cache'] = self.memory_cache.stats()
+        return stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        """Waits for background refreshes and writes the entries still queued by the file or elastic cache."""
+        self.__refresh_executor.shutdown(wait=True)
+        self.backend.close()
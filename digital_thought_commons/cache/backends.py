@@ -0,0 +1,439 @@
+import _sqlite3
+import atexit
+import base64
+import logging
+import os
+import threading
+import time
+import weakref
+from _sqlite3 import Error
+
+from digital_thought_commons import elasticsearch
+
+# SQLite limits the number of host parameters in a single statement (999 on older builds)
+SQLITE_MAX_PARAMETERS = 900
+ELASTIC_MAX_TERMS = 1000
+
+
+def _chunks(values, chunk_size):
+    for i in range(0, len(values), chunk_size):
+        yield values[i:i + chunk_size]
+
+
+def _close_at_exit(backend):
+    """
+    Registers the close of backend to run when the interpreter exits, so that entries still queued by its background
+    writer are not lost.  Only a weak reference is held, so the registration does not keep the backend alive.  Returns
+    the registered function, for the backend to unregister once closed.
+    """
+    reference = weakref.ref(backend)
+
+    def close():
+        backend = reference()
+        if backend is not None:
+            backend.close()
+
+    atexit.register(close)
+    return close
+
+
+def create_backend(cache_name, config, max_age):
+    """Returns the backend named by config['cache_type'] for cache_name."""
+    if config['cache_type'] == 'file':
+        return FileCacheBackend(cache_name, config, max_age)
+    elif config['cache_type'] == 'elastic':
+        return ElasticCacheBackend(cache_name, config, max_age)
+    raise Exception("Unknown Cache Type: {}".format(config['cache_type']))
+
+
+class FileCacheBackend:
+    """
+    SQLite backed cache store.
+
+    Only the newest entry per (cache_name, signature_hash) is kept, enforced by a unique index and upserts.  Writes
+    are queued and committed as a group once write_batch_size entries are pending or write_flush_interval seconds have
+    passed, and a background pass deletes entries older than max_age every compaction_interval seconds.  Queued entries
+    are committed by close, which is also called when the interpreter exits.
+    """
+
+    def __init__(self, cache_name, config, max_age):
+        self.cache_name = cache_name
+        self.max_age = max_age
+        self.cache_location = r'.\cache'
+        if 'cache_location' in config['file']:
+            self.cache_location = config['file']['cache_location']
+
+        self.write_batch_size = config['file'].get('write_batch_size', 100)
+        self.write_flush_interval = config['file'].get('write_flush_interval', 5)
+        self.compaction_interval = config['file'].get('compaction_interval', 3600)
+
+        os.makedirs(self.cache_location, exist_ok=True)
+
+        self.cache_file = self.cache_location + '/' + self.cache_name.replace(' ', '_') + '.cache'
+        self.__lock = threading.RLock()
+        self.__pending = {}
+        self.__closed = threading.Event()
+
+        try:
+            self.connection = _sqlite3.connect(self.cache_file, check_same_thread=False)
+            self.connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.__create_table()
+            logging.info('Initialised cache for {} located at {}'.format(self.cache_name, self.cache_file))
+        except Error as er:
+            logging.exception('Error occurred while initialising cache file {}'.format(self.cache_file), er)
+            raise er
+
+        self.__maintenance_thread = threading.Thread(target=self.__maintenance, daemon=True,
+                                                     name='FileCacheMaintenance:[{}]'.format(self.cache_name))
+        self.__maintenance_thread.start()
+        self.__close_at_exit = _close_at_exit(self)
+
+    def __create_table(self):
+        create_cache_table = """ CREATE TABLE IF NOT EXISTS cache (
+                                                id integer PRIMARY KEY,
+                                                signature_hash text,
+                                                lookup_timestamp integer,
+                                                encoded_response text,
+                                                username text,
+                                                cache_name text
+                                            ); """
+        self.connection.execute(create_cache_table)
+
+        index_exists = self.connection.execute("SELECT name FROM sqlite_master WHERE type='index' AND "
+                                               "name='cache_signature'").fetchone()
+        if index_exists is None:
+            # Cache files created before the unique index may hold several rows per signature, keep the newest
+            deleted = self.connection.execute("DELETE FROM cache WHERE id NOT IN (SELECT id FROM (SELECT id, "
+                                              "MAX(lookup_timestamp) FROM cache GROUP BY cache_name, signature_hash))"
+                                              ).rowcount
+            if deleted > 0:
+                logging.info('Removed {} superseded entries from cache file {}'.format(deleted, self.cache_file))
+            self.connection.execute('CREATE UNIQUE INDEX cache_signature ON cache(cache_name, signature_hash)')
+            self.connection.commit()
+            # auto_vacuum only applies to files created with it, older ones are rebuilt once so compact() can free pages
+            if self.connection.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                self.connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+                self.connection.execute('VACUUM')
+
+    def __maintenance(self):
+        last_compaction = time.time()
+        while not self.__closed.wait(self.write_flush_interval):
+            try:
+                self.flush()
+                if 0 < self.compaction_interval <= time.time() - last_compaction:
+                    last_compaction = time.time()
+                    self.compact()
+            except Exception as ex:
+                logging.exception('Error encountered during maintenance of cache file {}'.format(self.cache_file), ex)
+
+    def lookup(self, signature_hash, oldest_timestamp):
+        return self.lookup_many([signature_hash], oldest_timestamp).get(signature_hash, (None, 0))
+
+    def lookup_many(self, signature_hashes, oldest_timestamp):
+        found = {}
+        with self.__lock:
+            remaining = []
+            for signature_hash in signature_hashes:
+                pending = self.__pending.get(signature_hash)
+                if pending is not None and pending[0] >= oldest_timestamp:
+                    found[signature_hash] = (pending[1], pending[0])
+                else:
+                    remaining.append(signature_hash)
+
+            cursor = self.connection.cursor()
+            for chunk in _chunks(remaining, SQLITE_MAX_PARAMETERS):
+                cursor.execute("SELECT signature_hash, lookup_timestamp, encoded_response FROM cache WHERE cache_name=? "
+                               "AND signature_hash IN ({}) AND lookup_timestamp>=?".format(','.join('?' * len(chunk))),
+                               (self.cache_name, *chunk, oldest_timestamp))
+
+                for row in cursor.fetchall():
+                    found[row[0]] = (row[2], row[1])
+
+        return found
+
+    def entries(self, oldest_timestamp, limit=None):
+        """
+        Yields (signature_hash, lookup_timestamp, encoded_response, username) for the entries not older than
+        oldest_timestamp, newest first.  Entries are read through a separate connection, so stores are not blocked.
+        """
+        self.flush()
+        connection = _sqlite3.connect(self.cache_file)
+        try:
+            cursor = connection.execute("SELECT signature_hash, lookup_timestamp, encoded_response, username FROM cache "
+                                        "WHERE cache_name=? AND lookup_timestamp>=? ORDER BY lookup_timestamp DESC, id DESC "
+                                        "LIMIT ?", (self.cache_name, oldest_timestamp, -1 if limit is None else limit))
+            while True:
+                rows = cursor.fetchmany(1000)
+                if len(rows) == 0:
+                    break
+                yield from rows
+        finally:
+            connection.close()
+
+    def store(self, signature_hash, lookup_timestamp, encoded_response, username):
+        with self.__lock:
+            self.__queue(signature_hash, lookup_timestamp, encoded_response, username)
+            if len(self.__pending) >= self.write_batch_size:
+                self.flush()
+
+    def store_many(self, entries):
+        with self.__lock:
+            for entry in entries:
+                self.__queue(*entry)
+            self.flush()
+
+    def __queue(self, signature_hash, lookup_timestamp, encoded_response, username):
+        pending = self.__pending.get(signature_hash)
+        if pending is None or pending[0] <= lookup_timestamp:
+            self.__pending[signature_hash] = (lookup_timestamp, encoded_response, username)
+
+    def flush(self):
+        with self.__lock:
+            if len(self.__pending) == 0:
+                return
+
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT INTO cache(signature_hash, lookup_timestamp, encoded_response, cache_name, username) "
+                    "VALUES(?,?,?,?,?) ON CONFLICT(cache_name, signature_hash) DO UPDATE SET "
+                    "lookup_timestamp=excluded.lookup_timestamp, encoded_response=excluded.encoded_response, "
+                    "username=excluded.username WHERE excluded.lookup_timestamp>=cache.lookup_timestamp",
+                    [(signature_hash, lookup_timestamp, encoded_response, self.cache_name, username)
+                     for signature_hash, (lookup_timestamp, encoded_response, username) in self.__pending.items()])
+            logging.debug('Committed {} entries to cache file {}'.format(len(self.__pending), self.cache_file))
+            self.__pending.clear()
+
+    def delete(self, signature_hash):
+        with self.__lock:
+            self.__pending.pop(signature_hash, None)
+            with self.connection:
+                self.connection.execute("DELETE FROM cache WHERE cache_name=? AND signature_hash=?",
+                                        (self.cache_name, signature_hash))
+
+    def compact(self):
+        """Deletes entries older than max_age and returns the freed pages to the file system."""
+        oldest_timestamp = int(round(time.time() * 1000)) - self.max_age
+        with self.__lock:
+            with self.connection:
+                deleted = self.connection.execute("DELETE FROM cache WHERE lookup_timestamp<?",
+                                                  (oldest_timestamp,)).rowcount
+            self.connection.execute('PRAGMA incremental_vacuum')
+            self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        logging.info('Removed {} expired entries from cache file {}'.format(deleted, self.cache_file))
+        return deleted
+
+    def close(self):
+        if self.__closed.is_set():
+            return
+        self.__closed.set()
+        atexit.unregister(self.__close_at_exit)
+        self.__maintenance_thread.join()
+        with self.__lock:
+            self.flush()
+            self.connection.close()
+
+
+class ElasticCacheBackend:
+    """
+    Elasticsearch backed cache store.
+
+    Writes are queued and sent through a BulkProcessor by a background thread once write_batch_size entries are
+    pending or write_flush_interval seconds have passed; pending entries remain visible to lookups.  Documents are
+    indexed with the signature as their _id, so a signature is held once per backing index.  If elastic.local_cache is
+    configured, lookups read through a local FileCacheBackend before querying the cluster.  Queued entries are sent by
+    close, which is also called when the interpreter exits.
+    """
+    index = 'api-cache'
+
+    def __init__(self, cache_name, config, max_age):
+        self.cache_name = cache_name
+        self.max_age = max_age
+        self.write_batch_size = config['elastic'].get('write_batch_size', 500)
+        self.write_flush_interval = config['elastic'].get('write_flush_interval', 2)
+        self.elastic_connection = elasticsearch.get_connection(api_key=config['elastic']['api_key'],
+                                                               server=config['elastic']['server'],
+                                                               port=config['elastic']['port'])
+        self.local_backend = None
+        if config['elastic'].get('local_cache'):
+            self.local_backend = FileCacheBackend(cache_name, {'file': config['elastic']['local_cache']}, max_age)
+
+        self.__lock = threading.RLock()
+        self.__pending = {}
+        self.__flush_requested = threading.Event()
+        self.__closed = False
+        self.__flusher_thread = threading.Thread(target=self.__flusher, daemon=True,
+                                                 name='ElasticCacheFlusher:[{}]'.format(self.cache_name))
+        self.__flusher_thread.start()
+        self.__close_at_exit = _close_at_exit(self)
+
+    def __flusher(self):
+        while not self.__closed:
+            self.__flush_requested.wait(self.write_flush_interval)
+            self.__flush_requested.clear()
+            try:
+                self.flush()
+            except Exception as ex:
+                logging.exception('Error encountered while writing to Elastic cache: {}'.format(self.cache_name), ex)
+
+    def __search_cluster(self, signature_hashes, oldest_timestamp):
+        found = {}
+        for chunk in _chunks(signature_hashes, ELASTIC_MAX_TERMS):
+            query = {"size": 1 if len(chunk) == 1 else 10000,
+                     "sort": [{"lookup_timestamp": {"order": "desc"}}],
+                     "query": {"bool": {"filter": [{"terms": {"signature_hash": chunk}},
+                                                   {"range": {"lookup_timestamp": {"gte": oldest_timestamp}}}]}}}
+            response = self.elastic_connection.search(self.index, query)
+
+            if len(chunk) > 1 and response['hits']['total']['value'] > len(response['hits']['hits']):
+                # More matches than a single search can return, fall back to scrolling through all of them
+                del query['sort']
+                query['size'] = 1000
+                scroll_query = self.elastic_connection.get_scroller()
+                hits = list(scroll_query.query(self.index, query))
+                scroll_query.clear()
+            else:
+                hits = response['hits']['hits']
+
+            for entry in hits:
+                signature_hash = entry['_source']['signature_hash']
+                lookup_timestamp = entry['_source']['lookup_timestamp']
+                if signature_hash not in found or lookup_timestamp > found[signature_hash][1]:
+                    found[signature_hash] = (entry['_source']['encoded_response'], lookup_timestamp)
+
+        return found
+
+    def lookup(self, signature_hash, oldest_timestamp):
+        return self.lookup_many([signature_hash], oldest_timestamp).get(signature_hash, (None, 0))
+
+    def lookup_many(self, signature_hashes, oldest_timestamp):
+        found = {}
+        remaining = []
+        with self.__lock:
+            for signature_hash in signature_hashes:
+                pending = self.__pending.get(signature_hash)
+                if pending is not None and pending[0] >= oldest_timestamp:
+                    found[signature_hash] = (pending[1], pending[0])
+                else:
+                    remaining.append(signature_hash)
+
+        if self.local_backend is not None and len(remaining) > 0:
+            found.update(self.local_backend.lookup_many(remaining, oldest_timestamp))
+            remaining = [signature_hash for signature_hash in remaining if signature_hash not in found]
+
+        if len(remaining) > 0:
+            from_cluster = self.__search_cluster(remaining, oldest_timestamp)
+            if self.local_backend is not None and len(from_cluster) > 0:
+                self.local_backend.store_many([(signature_hash, lookup_timestamp, encoded_response, None)
+                                               for signature_hash, (encoded_response, lookup_timestamp)
+                                               in from_cluster.items()])
+            found.update(from_cluster)
+
+        return found
+
+    def entries(self, oldest_timestamp, limit=None):
+        """
+        Yields (signature_hash, lookup_timestamp, encoded_response, username) for the entries of this cache not older
+        than oldest_timestamp.  With a limit, the newest limit entries are returned newest first, otherwise all of them
+        are scrolled through in no particular order.
+        """
+        self.flush()
+        query = {"query": {"bool": {"filter": [{"term": {"cache_name": self.cache_name}},
+                                               {"range": {"lookup_timestamp": {"gte": oldest_timestamp}}}]}}}
+        if limit is not None and limit <= 10000:
+            query.update({"size": limit, "sort": [{"lookup_timestamp": {"order": "desc"}}]})
+            hits = self.elastic_connection.search(self.index, query)['hits']['hits']
+            scroll_query = None
+        else:
+            query['size'] = 1000
+            scroll_query = self.elastic_connection.get_scroller()
+            hits = scroll_query.query(self.index, query)
+
+        try:
+            for count, entry in enumerate(hits):
+                if limit is not None and count >= limit:
+                    break
+                yield (entry['_source']['signature_hash'], entry['_source']['lookup_timestamp'],
+                       entry['_source']['encoded_response'], entry['_source'].get('username'))
+        finally:
+            if scroll_query is not None:
+                scroll_query.clear()
+
+    def __document(self, signature_hash, lookup_timestamp, encoded_response, username):
+        # Documents can only carry text, binary payloads are stored base64 encoded
+        if isinstance(encoded_response, bytes):
+            encoded_response = base64.b64encode(encoded_response).decode('utf-8')
+        return {'signature_hash': signature_hash, 'encoded_response': encoded_response,
+                'cache_name': self.cache_name, 'lookup_timestamp': lookup_timestamp,
+                'username': username}
+
+    def __queue(self, signature_hash, lookup_timestamp, encoded_response, username):
+        pending = self.__pending.get(signature_hash)
+        if pending is None or pending[0] <= lookup_timestamp:
+            self.__pending[signature_hash] = (lookup_timestamp, encoded_response, username)
+
+    def store(self, signature_hash, lookup_timestamp, encoded_response, username):
+        if self.local_backend is not None:
+            self.local_backend.store(signature_hash, lookup_timestamp, encoded_response, username)
+        with self.__lock:
+            self.__queue(signature_hash, lookup_timestamp, encoded_response, username)
+            if len(self.__pending) >= self.write_batch_size:
+                self.__flush_requested.set()
+
+    def store_many(self, entries):
+        if self.local_backend is not None:
+            self.local_backend.store_many(entries)
+        with self.__lock:
+            for entry in entries:
+                self.__queue(*entry)
+        self.__flush_requested.set()
+
+    def delete(self, signature_hash):
+        with self.__lock:
+            self.__pending.pop(signature_hash, None)
+        if self.local_backend is not None:
+            self.local_backend.delete(signature_hash)
+        response = self.elastic_connection.request_session.delete(
+            self.elastic_connection.root_url + self.index + '/_doc/' + signature_hash)
+        # A signature that was never sent to the cluster is as good as deleted
+        if response.status_code not in (200, 404):
+            raise Exception(response.text)
+
+    def flush(self):
+        with self.__lock:
+            if len(self.__pending) == 0:
+                return
+            pending = self.__pending
+            self.__pending = {}
+
+        failed = []
+        try:
+            with self.elastic_connection.bulk_processor(
+                    batch_size=len(pending) + 1,
+                    failure_callback=lambda entry: failed.append(entry['action']['index']['_id'])) as bulk_processor:
+                for signature_hash, (lookup_timestamp, encoded_response, username) in pending.items():
+                    bulk_processor.index(index=self.index, _id=signature_hash, entry=self.__document(
+                        signature_hash, lookup_timestamp, encoded_response, username))
+        except Exception:
+            # Return the entries to the queue so they are retried with the next flush
+            self.__requeue(pending, pending.keys())
+            raise
+        self.__requeue(pending, failed)
+
+    def __requeue(self, pending, signature_hashes):
+        with self.__lock:
+            for signature_hash in signature_hashes:
+                self.__queue(signature_hash, *pending[signature_hash])
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        atexit.unregister(self.__close_at_exit)
+        self.__flush_requested.set()
+        self.__flusher_thread.join()
+        self.flush()
+        if self.local_backend is not None:
+            self.local_backend.close()
+        self.elastic_connection.close()
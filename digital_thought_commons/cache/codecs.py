@@ -0,0 +1,175 @@
+import base64
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encoded payloads start with a NUL byte followed by the serializer and compression identifiers.  Entries written
+# before codecs were introduced are base64 encoded JSON text, which never starts with a NUL byte.
+PAYLOAD_MARKER = b'\x00'
+HEADER_LENGTH = 3
+# Set on the serializer identifier of error (negative) responses
+NEGATIVE_FLAG = 0x80
+
+SERIALIZERS = {'json': 1, 'orjson': 2, 'msgpack': 3}
+COMPRESSIONS = {'none': 0, 'zlib': 1, 'zstd': 2, 'zstd_dictionary': 3}
+
+
+class CodecException(Exception):
+    pass
+
+
+def _require(module, name):
+    if module is None:
+        raise CodecException('The {} package is required by the configured cache codec but is not installed'.format(name))
+    return module
+
+
+def _json_dumps(obj):
+    return json.dumps(obj).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    return _require(orjson, 'orjson').dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _orjson_loads(data):
+    return _require(orjson, 'orjson').loads(data)
+
+
+def _msgpack_dumps(obj):
+    return _require(msgpack, 'msgpack').packb(obj, use_bin_type=True)
+
+
+def _msgpack_loads(data):
+    return _require(msgpack, 'msgpack').unpackb(data, raw=False, strict_map_key=False)
+
+
+_DUMPS = {1: _json_dumps, 2: _orjson_dumps, 3: _msgpack_dumps}
+_LOADS = {1: json.loads, 2: _orjson_loads, 3: _msgpack_loads}
+
+
+def train_zstd_dictionary(samples, dictionary_size=112640):
+    """Trains a zstd dictionary from a list of encoded responses (bytes), e.g. taken from an existing cache."""
+    return _require(zstandard, 'zstandard').train_dictionary(dictionary_size, samples).as_bytes()
+
+
+class Codec:
+    """
+    Converts lookup responses to and from the payload stored by the file and elastic cache backends.
+
+    Responses are held in the memory cache in their serialized form (bytes), so that hits only pay for the
+    deserialization.  Stored payloads carry a short header naming the serializer and compression used, so changing the
+    configuration does not invalidate existing entries, and entries written as base64 encoded JSON are still read.
+    """
+
+    def __init__(self, serializer='json', compression='none', compression_level=None, dictionary=None):
+        if serializer not in SERIALIZERS:
+            raise CodecException('Unknown cache serializer: {}'.format(serializer))
+        if compression not in ('none', 'zlib', 'zstd'):
+            raise CodecException('Unknown cache compression: {}'.format(compression))
+
+        self.serializer = SERIALIZERS[serializer]
+        self.compression = COMPRESSIONS[compression]
+        self.compression_level = compression_level
+        self.__zstd_compressor = None
+        self.__zstd_decompressor = zstandard.ZstdDecompressor() if zstandard is not None else None
+        self.__zstd_dictionary_decompressor = None
+
+        if serializer == 'orjson':
+            _require(orjson, 'orjson')
+        elif serializer == 'msgpack':
+            _require(msgpack, 'msgpack')
+
+        if compression == 'zstd':
+            _require(zstandard, 'zstandard')
+            zstd_dictionary = None
+            if dictionary is not None:
+                self.compression = COMPRESSIONS['zstd_dictionary']
+                zstd_dictionary = zstandard.ZstdCompressionDict(dictionary)
+                self.__zstd_dictionary_decompressor = zstandard.ZstdDecompressor(dict_data=zstd_dictionary)
+            self.__zstd_compressor = zstandard.ZstdCompressor(level=3 if compression_level is None else compression_level,
+                                                              dict_data=zstd_dictionary)
+
+        self.__header = PAYLOAD_MARKER + bytes([self.serializer, self.compression])
+        self.__negative_header = PAYLOAD_MARKER + bytes([self.serializer | NEGATIVE_FLAG, self.compression])
+
+    @classmethod
+    def from_config(cls, config, cache_name):
+        codec_config = config.get('codec', {})
+        dictionary = None
+        dictionary_file = codec_config.get('zstd_dictionaries', {}).get(cache_name.replace(' ', '_'))
+        if dictionary_file is not None:
+            with open(dictionary_file, 'rb') as in_file:
+                dictionary = in_file.read()
+
+        return cls(serializer=codec_config.get('serializer', 'json'),
+                   compression=codec_config.get('compression', 'zlib'),
+                   compression_level=codec_config.get('compression_level'), dictionary=dictionary)
+
+    def dumps(self, obj):
+        return _DUMPS[self.serializer](obj)
+
+    def loads(self, serialized):
+        return _LOADS[self.serializer](serialized)
+
+    def __compress(self, data):
+        if self.compression == COMPRESSIONS['zlib']:
+            return zlib.compress(data, -1 if self.compression_level is None else self.compression_level)
+        elif self.compression != COMPRESSIONS['none']:
+            return self.__zstd_compressor.compress(data)
+        return data
+
+    def __decompress(self, data, compression):
+        if compression == COMPRESSIONS['none']:
+            return data
+        elif compression == COMPRESSIONS['zlib']:
+            return zlib.decompress(data)
+        elif compression == COMPRESSIONS['zstd']:
+            _require(zstandard, 'zstandard')
+            return self.__zstd_decompressor.decompress(data)
+        elif compression == COMPRESSIONS['zstd_dictionary']:
+            if self.__zstd_dictionary_decompressor is None:
+                raise CodecException('Cache entry was compressed with a zstd dictionary, but none is configured')
+            return self.__zstd_dictionary_decompressor.decompress(data)
+        raise CodecException('Unknown compression identifier in cache entry: {}'.format(compression))
+
+    def encode(self, serialized, negative=False):
+        """Returns the payload to store for a serialized response.  negative marks error responses."""
+        return (self.__negative_header if negative else self.__header) + self.__compress(serialized)
+
+    @staticmethod
+    def is_negative(payload):
+        if isinstance(payload, str):
+            # The first four base64 characters hold the three byte header
+            payload = base64.b64decode(payload[:4])
+        return payload.startswith(PAYLOAD_MARKER) and bool(payload[1] & NEGATIVE_FLAG)
+
+    def decode(self, payload):
+        """Returns the serialized response for a stored payload."""
+        if isinstance(payload, str):
+            payload = base64.b64decode(payload)
+
+        if not payload.startswith(PAYLOAD_MARKER):
+            serializer, data = SERIALIZERS['json'], bytes(payload)
+        else:
+            serializer = payload[1] & ~NEGATIVE_FLAG
+            data = self.__decompress(payload[HEADER_LENGTH:], payload[2])
+
+        # orjson produces standard JSON, so json and orjson payloads can be used by either
+        if serializer == self.serializer or {serializer, self.serializer} == {SERIALIZERS['json'], SERIALIZERS['orjson']}:
+            return data
+        return self.dumps(_LOADS[serializer](data))
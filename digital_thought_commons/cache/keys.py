@@ -0,0 +1,141 @@
+import base64
+import datetime
+import hashlib
+import json
+
+LEGACY_KEY_VERSION = 0
+
+# Tags of the argument types that are serialized directly, without going through json
+_SCALAR_TAGS = {str: 's', int: 'i', float: 'f', bool: 'b', type(None): 'n'}
+
+# A single encoder, as json.dumps builds a new one for every call with non default options
+_encode = json.JSONEncoder(sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode
+
+
+def _json_float(value):
+    if value != value:
+        return 'NaN'
+    elif value in (float('inf'), float('-inf')):
+        return 'Infinity' if value > 0 else '-Infinity'
+    return float.__repr__(value)
+
+
+# The JSON text of each scalar type, as the encoder writes it
+_JSON_SCALARS = {str: json.encoder.encode_basestring, int: int.__repr__, float: _json_float,
+                 bool: lambda value: 'true' if value else 'false', type(None): lambda value: 'null'}
+
+
+def _canonical(value):
+    """
+    Converts a lookup argument to a JSON compatible structure that is independent of dict and set ordering.  Types
+    JSON cannot tell apart (tuples, sets, bytes, dates and other objects) are tagged with their type name.
+    """
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    elif isinstance(value, dict):
+        if all(isinstance(key, str) for key in value.keys()):
+            return {key: _canonical(item) for key, item in value.items()}
+        return {'__dict__': sorted(([_canonical(key), _canonical(item)] for key, item in value.items()), key=_dumps)}
+    elif isinstance(value, list):
+        return [_canonical(item) for item in value]
+    elif isinstance(value, tuple):
+        return {'__tuple__': [_canonical(item) for item in value]}
+    elif isinstance(value, (set, frozenset)):
+        return {'__set__': sorted((_canonical(item) for item in value), key=_dumps)}
+    elif isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode('utf-8')}
+    elif isinstance(value, (datetime.date, datetime.time)):
+        return {'__{}__'.format(type(value).__name__): value.isoformat()}
+    return {'__{}__'.format(type(value).__name__): repr(value)}
+
+
+def _dumps(value):
+    return _encode(value)
+
+
+def _first(pair):
+    return pair[0]
+
+
+def _plain_dumps(value):
+    """
+    Serializes str, int, float, bool, None, and lists, tuples and str keyed dicts of them, to the same text as
+    _dumps(_canonical(value)) without going through the encoder, so that flat arguments are not walked twice.  Returns
+    None for any other value.
+    """
+    to_json = _JSON_SCALARS.get(type(value))
+    if to_json is not None:
+        return to_json(value)
+
+    value_type = type(value)
+    parts = []
+    if value_type is list or value_type is tuple:
+        for item in value:
+            to_json = _JSON_SCALARS.get(type(item))
+            text = to_json(item) if to_json is not None else _plain_dumps(item)
+            if text is None:
+                return None
+            parts.append(text)
+        text = '[' + ','.join(parts) + ']'
+        return text if value_type is list else '{"__tuple__":' + text + '}'
+    elif value_type is dict:
+        for key, item in value.items():
+            if type(key) is not str:
+                return None
+            to_json = _JSON_SCALARS.get(type(item))
+            text = to_json(item) if to_json is not None else _plain_dumps(item)
+            if text is None:
+                return None
+            parts.append((key, text))
+        parts.sort(key=_first)
+        return '{' + ','.join(json.encoder.encode_basestring(key) + ':' + text for key, text in parts) + '}'
+    return None
+
+
+class SignatureGenerator:
+    """
+    Generates the signature_hash of a lookup from its keyword arguments.
+
+    The arguments are serialized canonically (sorted keys, type aware), prefixed with the cache name and key version,
+    and hashed with a 128 bit blake2b.  Scalar arguments, the common case, are serialized without going through json,
+    and lists, tuples and str keyed dicts of them in a single pass, without the json encoder.
+
+    Raising the key version of a cache gives all of its lookups new signatures, so entries stored under an older
+    schema are no longer found and age out of the file or elastic cache.  Version 0 keeps the original signatures
+    (SHA-256 of the arguments in call order) so existing entries remain usable.
+    """
+
+    def __init__(self, cache_name, version=1):
+        self.cache_name = cache_name
+        self.version = version
+        self.__prefix = '{}\x00{}\x00'.format(cache_name, version).encode('utf-8')
+
+    def canonical(self, kwargs):
+        parts = []
+        for key, value in sorted(kwargs.items()) if len(kwargs) > 1 else kwargs.items():
+            value_type = type(value)
+            if value_type is str:
+                parts.append(f'{key}\x1fs{len(value)}:{value}')
+                continue
+
+            tag = _SCALAR_TAGS.get(value_type)
+            if tag is None:
+                tag, text = 'j', _plain_dumps(value)
+                if text is None:
+                    text = _dumps(_canonical(value))
+            else:
+                text = repr(value)
+            parts.append(f'{key}\x1f{tag}{len(text)}:{text}')
+        return self.__prefix + '\x1e'.join(parts).encode('utf-8')
+
+    def signature(self, kwargs):
+        if self.version == LEGACY_KEY_VERSION:
+            return self.__legacy_signature(kwargs)
+        return hashlib.blake2b(self.canonical(kwargs), digest_size=16).hexdigest()
+
+    def __legacy_signature(self, kwargs):
+        signature_string = self.cache_name
+        for key, value in kwargs.items():
+            signature_string += '{}={}'.format(key, value)
+
+        return hashlib.sha256(bytes(signature_string, 'utf-8')).hexdigest()
@@ -0,0 +1,133 @@
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+def _current_timestamp():
+    return int(round(time.time() * 1000))
+
+
+def _size_of(obj):
+    if isinstance(obj, (str, bytes, bytearray)):
+        return len(obj)
+    return sys.getsizeof(obj)
+
+
+class MemoryCache:
+    """
+    In-process LRU cache with a per entry time to live.
+
+    Entries are held in an OrderedDict so that hits, inserts and evictions are all O(1).  The cache is bounded by
+    both the number of entries (size) and, optionally, the total size of the stored values in bytes (max_bytes).
+    Timestamps and ages are expressed in milliseconds, matching the rest of the cache module.  All operations are
+    thread safe.
+    """
+
+    def __init__(self, size, name, max_age=None, max_bytes=None):
+        self.size = size
+        self.name = name
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.queue = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.queue
+
+    def __remove(self, key):
+        obj, _, obj_size = self.queue.pop(key)
+        self.current_bytes -= obj_size
+        return obj
+
+    def __evict(self):
+        while len(self.queue) > 0 and (len(self.queue) > self.size or
+                                       (self.max_bytes is not None and self.current_bytes > self.max_bytes)):
+            key, (_, _, obj_size) = self.queue.popitem(last=False)
+            self.current_bytes -= obj_size
+            self.evictions += 1
+            logging.debug("Queue Full. Removing key {} from QueueCache: {}".format(key, self.name))
+
+    def put(self, key, obj, timestamp=None, max_age=None):
+        """
+        Adds or replaces an entry.  The entry expires max_age milliseconds after timestamp, where timestamp is when the
+        value was originally obtained (defaults to now) and max_age defaults to the max_age of the cache.
+        """
+        if self.size <= 0:
+            return
+
+        if max_age is None:
+            max_age = self.max_age
+        expires = None
+        if max_age is not None:
+            expires = (_current_timestamp() if timestamp is None else timestamp) + max_age
+            if expires <= _current_timestamp():
+                return
+
+        obj_size = _size_of(obj)
+        if self.max_bytes is not None and obj_size > self.max_bytes:
+            logging.debug("Entry {} is larger than the QueueCache: {} byte limit.  Not cached.".format(key, self.name))
+            return
+
+        with self.__lock:
+            if key in self.queue:
+                self.__remove(key)
+
+            self.queue[key] = (obj, expires, obj_size)
+            self.current_bytes += obj_size
+            self.__evict()
+
+    def lookup(self, key):
+        with self.__lock:
+            entry = self.queue.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            obj, expires, _ = entry
+            if expires is not None and expires <= _current_timestamp():
+                self.__remove(key)
+                self.expirations += 1
+                self.misses += 1
+                logging.debug("Key {} has expired in QueueCache: {}".format(key, self.name))
+                return None
+
+            self.queue.move_to_end(key)
+            self.hits += 1
+        logging.debug("Retrieved key {} from QueueCache: {}".format(key, self.name))
+        return obj
+
+    def remove(self, key):
+        with self.__lock:
+            if key in self.queue:
+                self.__remove(key)
+
+    def clear(self):
+        with self.__lock:
+            self.queue.clear()
+            self.current_bytes = 0
+
+    def items(self):
+        with self.__lock:
+            return {key: entry[0] for key, entry in self.queue.items()}
+
+    def keys(self):
+        with self.__lock:
+            return list(self.queue.keys())
+
+    def stats(self):
+        with self.__lock:
+            lookups = self.hits + self.misses
+            return {'name': self.name, 'entries': len(self.queue), 'size': self.size, 'bytes': self.current_bytes,
+                    'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'expirations': self.expirations, 'hit_rate': self.hits / lookups if lookups > 0 else 0.0}
@@ -0,0 +1,212 @@
+import bisect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds, in milliseconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+TIERS = ('memory', 'stale', 'file', 'elastic', 'live')
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class LatencyHistogram:
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, milliseconds):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+
+    def percentile(self, percentile):
+        """Upper bound of the bucket holding the given percentile (0 to 100)."""
+        if self.count == 0:
+            return 0.0
+        threshold = self.count * percentile / 100
+        running = 0
+        for i, count in enumerate(self.counts):
+            running += count
+            if running >= threshold:
+                return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'mean_ms': self.total / self.count if self.count > 0 else 0.0,
+                'p50_ms': self.percentile(50), 'p95_ms': self.percentile(95), 'p99_ms': self.percentile(99),
+                'max_ms': self.max,
+                'buckets': {('le_{}'.format(bound) if i < len(LATENCY_BUCKETS) else 'le_inf'): count
+                            for i, (bound, count) in enumerate(zip(LATENCY_BUCKETS + (None,), self.counts))}}
+
+
+class CacheMetrics:
+    """
+    Counters and latency histograms of the lookups made through the APICache instances of one cache_name.
+
+    Each lookup is counted against the tier that resolved it: memory, stale (served while being refreshed), the file
+    or elastic cache, or live (the upstream API).  Live lookups also count upstream calls, errors and response bytes.
+    """
+
+    def __init__(self, cache_name):
+        self.cache_name = cache_name
+        self.__lock = threading.Lock()
+        self.reset()
+
+    @classmethod
+    def for_cache(cls, cache_name):
+        """Returns the shared metrics of cache_name, creating them if needed."""
+        with _registry_lock:
+            if cache_name not in _registry:
+                _registry[cache_name] = cls(cache_name)
+            return _registry[cache_name]
+
+    def reset(self):
+        with self.__lock:
+            self.resolutions = {tier: 0 for tier in TIERS}
+            self.latencies = {tier: LatencyHistogram() for tier in TIERS}
+            self.counters = {'upstream_calls': 0, 'upstream_errors': 0, 'upstream_bytes': 0, 'stored_entries': 0,
+                             'stored_bytes': 0, 'cache_errors': 0}
+
+    def record_resolution(self, tier, seconds, count=1):
+        with self.__lock:
+            self.resolutions[tier] += count
+            self.latencies[tier].record(seconds * 1000 / count)
+
+    def increment(self, counter, amount=1):
+        with self.__lock:
+            self.counters[counter] += amount
+
+    @contextmanager
+    def time_resolution(self, tier):
+        start = time.perf_counter()
+        yield
+        self.record_resolution(tier, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.__lock:
+            lookups = sum(self.resolutions.values())
+            return {'cache_name': self.cache_name, 'lookups': lookups,
+                    'resolutions': dict(self.resolutions),
+                    'hit_rates': {tier: count / lookups if lookups > 0 else 0.0
+                                  for tier, count in self.resolutions.items()},
+                    'latency': {tier: histogram.snapshot() for tier, histogram in self.latencies.items()},
+                    **self.counters}
+
+
+def snapshot():
+    """Returns the metrics of every cache, keyed by cache_name."""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return {cache_metrics.cache_name: cache_metrics.snapshot() for cache_metrics in metrics}
+
+
+def _difference(after, before):
+    if isinstance(after, dict):
+        return {key: _difference(value, before.get(key, 0) if isinstance(before, dict) else 0)
+                for key, value in after.items() if key not in ('hit_rates', 'latency', 'cache_name')}
+    elif isinstance(after, (int, float)) and not isinstance(after, bool):
+        return after - before
+    return after
+
+
+class Profile:
+
+    def __init__(self, name):
+        self.name = name
+        self.elapsed_seconds = None
+        self.caches = {}
+
+    def as_dict(self):
+        return {'name': self.name, 'elapsed_seconds': self.elapsed_seconds, 'caches': self.caches}
+
+
+@contextmanager
+def profile(name='profile', log_level=logging.INFO):
+    """
+    Profiles a block of enrichment work.  On exit the returned Profile holds, per cache, the lookups resolved by each
+    tier and the upstream calls and bytes made within the block, which are also logged.
+
+        with metrics.profile('audit report enrichment') as result:
+            ...
+        print(result.as_dict())
+    """
+    result = Profile(name)
+    before = snapshot()
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        result.elapsed_seconds = time.perf_counter() - start
+        for cache_name, after in snapshot().items():
+            difference = _difference(after, before.get(cache_name, {}))
+            if difference.get('lookups', 0) > 0:
+                result.caches[cache_name] = difference
+        logging.getLogger('cache.metrics').log(log_level, 'Profile {}: {}'.format(name, json.dumps(result.as_dict())))
+
+
+class MetricsEmitter(threading.Thread):
+    """
+    Periodically emits the snapshot of every cache, either to the logging package (logger cache.metrics) or, when an
+    ElasticsearchConnection and index are given, as documents indexed through its bulk processor.
+    """
+
+    def __init__(self, interval=60, elastic_connection=None, index=None, log_level=logging.INFO) -> None:
+        threading.Thread.__init__(self, name='CacheMetricsEmitter', daemon=True)
+        self.interval = interval
+        self.elastic_connection = elastic_connection
+        self.index = index
+        self.log_level = log_level
+        self.__stopped = threading.Event()
+
+    def emit(self):
+        timestamp = int(round(time.time() * 1000))
+        snapshots = snapshot()
+        if self.elastic_connection is not None and self.index is not None:
+            with self.elastic_connection.bulk_processor(batch_size=len(snapshots) + 1) as bulk_processor:
+                for cache_snapshot in snapshots.values():
+                    bulk_processor.index(index=self.index, entry=dict(cache_snapshot, metrics_timestamp=timestamp))
+        else:
+            for cache_snapshot in snapshots.values():
+                logging.getLogger('cache.metrics').log(self.log_level, json.dumps(cache_snapshot))
+
+    def run(self) -> None:
+        while not self.__stopped.wait(self.interval):
+            try:
+                self.emit()
+            except Exception as ex:
+                logging.exception('Error encountered while emitting cache metrics: {}'.format(str(ex)))
+
+    def stop(self):
+        self.__stopped.set()
+        self.join()
+        self.emit()
+
+
+_emitter = None
+
+
+def start_emitter(interval=60, elastic_connection=None, index=None, log_level=logging.INFO):
+    """Starts the process wide MetricsEmitter, if it is not already running, and returns it."""
+    global _emitter
+    with _registry_lock:
+        if _emitter is None:
+            _emitter = MetricsEmitter(interval, elastic_connection=elastic_connection, index=index, log_level=log_level)
+            _emitter.start()
+        return _emitter
+
+
+def stop_emitter():
+    global _emitter
+    with _registry_lock:
+        emitter, _emitter = _emitter, None
+    if emitter is not None:
+        emitter.stop()
@@ -0,0 +1,62 @@
+class CachePolicy:
+    """
+    Expiry rules of a cache, read from the cache configuration.
+
+    Values can be set per cache under cache_policies, falling back to the top level value of the same name.  All ages
+    are in milliseconds.
+    - max_age: age after which an entry is no longer fresh.  <cache_name>_max_age and default_max_age still apply
+    - stale_while_revalidate: how long past its max age an entry may still be served while it is refreshed
+    - error_max_age: max age of error responses.  Defaults to max_age when cache_error_responses is true, otherwise
+      error responses are not cached
+    - expiry_jitter: fraction of the max age by which the expiry of each entry is brought forward.  The amount is
+      derived from the signature, so entries stored together do not all expire together
+    - key_version: version of the lookup signatures, see keys.SignatureGenerator.  Defaults to 0, the signatures of
+      releases before key versions, so that existing entries are still found
+    """
+
+    def __init__(self, max_age, stale_while_revalidate=0, error_max_age=None, expiry_jitter=0.0, key_version=0):
+        self.max_age = max_age
+        self.stale_while_revalidate = stale_while_revalidate
+        self.error_max_age = error_max_age
+        self.expiry_jitter = expiry_jitter
+        self.key_version = key_version
+
+    @classmethod
+    def from_config(cls, config, cache_name):
+        name = cache_name.replace(' ', '_')
+        policy_config = (config.get('cache_policies') or {}).get(name) or {}
+
+        max_age = config['default_max_age']
+        if name + '_max_age' in config:
+            max_age = config[name + '_max_age']
+        max_age = policy_config.get('max_age', max_age)
+
+        error_max_age = policy_config.get('error_max_age', config.get('error_max_age'))
+        if error_max_age is None and config.get('cache_error_responses', False):
+            error_max_age = max_age
+
+        return cls(max_age=max_age,
+                   stale_while_revalidate=policy_config.get('stale_while_revalidate', config.get('stale_while_revalidate', 0)),
+                   error_max_age=error_max_age,
+                   expiry_jitter=policy_config.get('expiry_jitter', config.get('expiry_jitter', 0.0)),
+                   key_version=policy_config.get('key_version', config.get('key_version', 0)))
+
+    @property
+    def retention(self):
+        """How long an entry remains of any use, fresh or stale."""
+        return max(self.max_age, self.error_max_age or 0) + self.stale_while_revalidate
+
+    def caches_errors(self):
+        return self.error_max_age is not None and self.error_max_age > 0
+
+    def entry_max_age(self, signature_hash, negative=False):
+        max_age = self.error_max_age if negative else self.max_age
+        if self.expiry_jitter > 0:
+            max_age -= int(max_age * self.expiry_jitter * (int(signature_hash[:8], 16) / 0xffffffff))
+        return max_age
+
+    def is_fresh(self, age, entry_max_age):
+        return age <= entry_max_age
+
+    def is_stale_servable(self, age, entry_max_age):
+        return entry_max_age < age <= entry_max_age + self.stale_while_revalidate
@@ -0,0 +1,52 @@
+import threading
+
+
+class _Call:
+
+    def __init__(self):
+        self.complete = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key.
+
+    The first caller for a key runs the function, callers arriving while it is in flight wait for and share its result
+    (or exception) instead of running the function again.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls = {}
+
+    def in_flight(self):
+        with self.__lock:
+            return len(self.__calls)
+
+    def do(self, key, function, *args, **kwargs):
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.__calls[key] = call
+
+        if not leader:
+            call.complete.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+        except BaseException as ex:
+            call.error = ex
+            raise
+        finally:
+            with self.__lock:
+                self.__calls.pop(key)
+            call.complete.set()
+
+        return call.result
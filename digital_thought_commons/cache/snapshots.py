@@ -0,0 +1,109 @@
+import _sqlite3
+import base64
+import gzip
+import json
+
+SNAPSHOT_VERSION = 1
+
+
+class SnapshotException(Exception):
+    pass
+
+
+def snapshot_format(path):
+    """Returns the snapshot format implied by the extension of path: ndjson (optionally .gz) or sqlite."""
+    name = path.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    if name.endswith('.ndjson') or name.endswith('.jsonl'):
+        return 'ndjson'
+    elif name.endswith('.sqlite') or name.endswith('.db') or name.endswith('.cache'):
+        return 'sqlite'
+    raise SnapshotException('Unable to determine the cache snapshot format of {}, use .ndjson[.gz] or .sqlite'
+                            .format(path))
+
+
+def _open_text(path, mode):
+    if path.lower().endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def write_ndjson(path, cache_name, key_version, entries):
+    """
+    Writes entries (signature_hash, lookup_timestamp, encoded_response, username) as one JSON document per line,
+    following a header line naming the cache.  Payloads are written base64 encoded.  Returns the number written.
+    """
+    count = 0
+    with _open_text(path, 'w') as out_file:
+        out_file.write(json.dumps({'snapshot_version': SNAPSHOT_VERSION, 'cache_name': cache_name,
+                                   'key_version': key_version}) + '\n')
+        for signature_hash, lookup_timestamp, encoded_response, username in entries:
+            if isinstance(encoded_response, (bytes, bytearray)):
+                encoded_response = base64.b64encode(encoded_response).decode('utf-8')
+            out_file.write(json.dumps({'signature_hash': signature_hash, 'lookup_timestamp': lookup_timestamp,
+                                       'encoded_response': encoded_response, 'username': username}) + '\n')
+            count += 1
+    return count
+
+
+def read_ndjson(path):
+    """Returns the header of an NDJSON snapshot and a generator of its entries."""
+    in_file = _open_text(path, 'r')
+    header = json.loads(in_file.readline() or '{}')
+    if header.get('snapshot_version') != SNAPSHOT_VERSION:
+        in_file.close()
+        raise SnapshotException('{} is not a cache snapshot of version {}'.format(path, SNAPSHOT_VERSION))
+
+    def entries():
+        with in_file:
+            for line in in_file:
+                if len(line.strip()) > 0:
+                    entry = json.loads(line)
+                    yield (entry['signature_hash'], entry['lookup_timestamp'],
+                           base64.b64decode(entry['encoded_response']), entry.get('username'))
+
+    return header, entries()
+
+
+def write_sqlite(path, cache_name, entries):
+    """
+    Writes entries to a SQLite file using the table layout of FileCacheBackend, replacing any entries of cache_name
+    already in it.  Returns the number written.
+    """
+    connection = _sqlite3.connect(path)
+    try:
+        connection.execute(""" CREATE TABLE IF NOT EXISTS cache (
+                                        id integer PRIMARY KEY,
+                                        signature_hash text,
+                                        lookup_timestamp integer,
+                                        encoded_response text,
+                                        username text,
+                                        cache_name text
+                                    ); """)
+        connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS cache_signature ON cache(cache_name, signature_hash)')
+        with connection:
+            connection.execute('DELETE FROM cache WHERE cache_name=?', (cache_name,))
+            count = connection.executemany(
+                "INSERT OR REPLACE INTO cache(signature_hash, lookup_timestamp, encoded_response, cache_name, username) "
+                "VALUES(?,?,?,?,?)", ((signature_hash, lookup_timestamp, encoded_response, cache_name, username)
+                                      for signature_hash, lookup_timestamp, encoded_response, username in entries)
+            ).rowcount
+    finally:
+        connection.close()
+    return count
+
+
+def read_sqlite(path, cache_name):
+    """Returns a generator of the entries of cache_name held in a SQLite snapshot or cache file."""
+    connection = _sqlite3.connect(path)
+    try:
+        cursor = connection.execute("SELECT signature_hash, lookup_timestamp, encoded_response, username FROM cache "
+                                    "WHERE cache_name=?", (cache_name,))
+        while True:
+            rows = cursor.fetchmany(1000)
+            if len(rows) == 0:
+                break
+            yield from rows
+    finally:
+        connection.close()
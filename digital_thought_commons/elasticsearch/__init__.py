@@ -1,8 +1,13 @@
+import contextlib
+import copy
+import functools
 import glob
 import json
 import logging
+import os
 import pathlib
 import re
+import threading
 
 from .. import internet
 from .bulkProcessor import BulkProcessor
@@ -12,20 +17,97 @@ from elasticsearch import Elasticsearch
 import base64
 
 
+# Sized for the threads that share a connection: bulk flushers, scroll slices and cache workers
+DEFAULT_POOL_MAXSIZE = min(32, (os.cpu_count() or 1) + 4)
+
+# Upper bounds of a single batched request, larger inputs are split into several requests
+MGET_CHUNK_SIZE = 1000
+IDS_QUERY_CHUNK_SIZE = 5000
+MSEARCH_CHUNK_SIZE = 200
+MSEARCH_CHUNK_BYTES = 5000000
+
+_connections = {}
+_connections_lock = threading.RLock()
+
+
+def get_connection(server, port, api_key, pool_maxsize=None):
+    """
+    Returns the connection of this process to the cluster at server:port for api_key, connecting on first use.  The
+    connection, its HTTP connection pool and its health check are shared by every caller; each caller closes it once
+    and it is only closed when the last one does.
+    """
+    key = (server, str(port), api_key)
+    with _connections_lock:
+        connection = _connections.get(key)
+        if connection is not None:
+            connection._references += 1
+            return connection
+
+    # Connected without holding the lock, so a cluster that is slow to answer its health check only holds up its own
+    # callers
+    created = ElasticsearchConnection(server, port, api_key, pool_maxsize=pool_maxsize)
+    with _connections_lock:
+        connection = _connections.get(key)
+        if connection is None:
+            created._registry_key = key
+            _connections[key] = connection = created
+            created = None
+        connection._references += 1
+
+    if created is not None:
+        # Another caller connected to the same cluster first
+        created.close()
+    return connection
+
+
+def _release(connection):
+    """Drops a reference to a shared connection, returning True when the connection should now be closed."""
+    key = connection._registry_key
+    if key is None:
+        return True
+    with _connections_lock:
+        connection._references -= 1
+        if connection._references > 0:
+            return False
+        if _connections.get(key) is connection:
+            del _connections[key]
+        return True
+
+
+@functools.lru_cache(maxsize=None)
+def _default_resources(directory):
+    """Parses the JSON resources of directory once per process, keyed by file name without extension."""
+    resources = {}
+    for resource_file in sorted(glob.glob(directory + '/*.json')):
+        with open(resource_file) as resource_json_file:
+            resources[pathlib.Path(resource_file).stem] = json.load(resource_json_file)
+    return resources
+
+
 class ElasticsearchConnection:
 
-    def __init__(self, server, port, api_key):
+    def __init__(self, server, port, api_key, pool_maxsize=None):
+        self.server = server
+        self.port = port
         self.api_key = api_key
         self.root_url = 'https://{}:{}/'.format(server, port)
         self.root_directory = str(pathlib.Path(__file__).parent.absolute()) + '/../_resources/elasticsearch'
+        self.pool_maxsize = pool_maxsize or DEFAULT_POOL_MAXSIZE
         self.request_session = internet.retry_request_session(
-            headers={'Authorization': 'ApiKey {}'.format(self.api_key)})
-        self.api_key_id = base64.b64decode(api_key.encode(encoding='utf-8')).split(':')[0]
-        self.api_key_instance = base64.b64decode(api_key.encode(encoding='utf-8')).split(':')[1]
-        self.elasticsearch_client = Elasticsearch(hosts=[f'{server}:{port}'], api_key=(self.api_key_id, self.api_key_instance))
-
-        response = self.request_session.get(self.root_url)
-        if response.status_code != 200 or not self.is_cluster_healthy():
+            headers={'Authorization': 'ApiKey {}'.format(self.api_key)}, pool_connections=1,
+            pool_maxsize=self.pool_maxsize)
+        self.api_key_id = base64.b64decode(api_key.encode(encoding='utf-8')).decode('utf-8').split(':')[0]
+        self.api_key_instance = base64.b64decode(api_key.encode(encoding='utf-8')).decode('utf-8').split(':')[1]
+        self.__elasticsearch_client = None
+        self.__client_lock = threading.Lock()
+        # Held for a whole install pass, so that passes on threads sharing the connection do not interleave
+        self.__install_lock = threading.RLock()
+        self.__metadata = {}
+        self.__install_depth = 0
+        self._registry_key = None
+        self._references = 0
+
+        if not self.is_cluster_healthy():
             raise Exception(
                 "Failed to connect to Elasticsearch server or cluster status is not healthy: {}".format(self.root_url))
 
@@ -34,9 +116,25 @@ class ElasticsearchConnection:
     def __enter__(self):
         return self
 
+    @property
+    def elasticsearch_client(self) -> Elasticsearch:
+        # Created on first use, most callers only need the request session
+        with self.__client_lock:
+            if self.__elasticsearch_client is None:
+                self.__elasticsearch_client = Elasticsearch(hosts=[f'{self.server}:{self.port}'],
+                                                            api_key=(self.api_key_id, self.api_key_instance),
+                                                            connections_per_node=self.pool_maxsize)
+            return self.__elasticsearch_client
+
     def close(self):
+        """Closes the connection, or for a connection from get_connection releases it until its last user closes it."""
+        if not _release(self):
+            return
         self.request_session.close()
-        self.elasticsearch_client.close()
+        with self.__client_lock:
+            if self.__elasticsearch_client is not None:
+                self.__elasticsearch_client.close()
+                self.__elasticsearch_client = None
 
     def __exit__(self, type, value, traceback):
         self.close()
@@ -47,39 +145,75 @@ class ElasticsearchConnection:
     def delete_by_id(self, index: str, _id: str):
         return self.elasticsearch_client.delete(index=index, id=_id)
 
-    def install_component_template(self, template_name, template, description=None, version=None, requires_prefix=None):
-        if template_name not in self.loaded_component_templates():
-            if '_meta' not in template and (description is None or version is None or requires_prefix is None):
-                raise Exception("Template does not contain all required _meta fields [description, version, requires_prefix]")
-            elif '_meta' not in template:
-                template['_meta'] = {'description': description, 'version': version, 'requires_prefix': requires_prefix}
-
-            logging.getLogger('elastic').info('Creating Component Template: {}'.format(template_name))
-            resp = self.request_session.put(self.root_url + '_component_template/' + template_name, json=template).json()
-            if not resp['acknowledged']:
-                logging.getLogger('elastic').error(
-                    'Failed to create Component Template {}.  Error: {}'.format(template_name, str(resp)))
-                raise Exception(
-                    'Failed to create Component Template {}.  Error: {}'.format(template_name, str(resp)))
+    @contextlib.contextmanager
+    def install_pass(self):
+        """
+        Groups installs so that the component templates, index templates and lifecycle policies present on the server
+        are fetched once for the whole pass rather than on every check.  Each install method runs in its own pass when
+        called outside of one.  The lists are fetched again at the start of the next pass, or after
+        invalidate_metadata().  A pass runs on one thread at a time.
+        """
+        with self.__install_lock:
+            if self.__install_depth == 0:
+                self.invalidate_metadata()
+            self.__install_depth += 1
+            try:
+                yield self
+            finally:
+                self.__install_depth -= 1
+
+    def invalidate_metadata(self):
+        with self.__install_lock:
+            self.__metadata.clear()
+
+    def __loaded(self, kind, fetch):
+        with self.__install_lock:
+            if self.__install_depth == 0 or kind not in self.__metadata:
+                self.__metadata[kind] = dict.fromkeys(fetch())
+            return list(self.__metadata[kind])
+
+    def __installed(self, kind, name):
+        with self.__install_lock:
+            if kind in self.__metadata:
+                self.__metadata[kind][name] = None
 
-            return {'status': 'created'}
-        return {'status': 'already_present'}
+    def install_component_template(self, template_name, template, description=None, version=None, requires_prefix=None):
+        with self.install_pass():
+            if template_name not in self.loaded_component_templates():
+                if '_meta' not in template and (description is None or version is None or requires_prefix is None):
+                    raise Exception("Template does not contain all required _meta fields [description, version, requires_prefix]")
+                elif '_meta' not in template:
+                    template['_meta'] = {'description': description, 'version': version, 'requires_prefix': requires_prefix}
+
+                logging.getLogger('elastic').info('Creating Component Template: {}'.format(template_name))
+                resp = self.request_session.put(self.root_url + '_component_template/' + template_name, json=template).json()
+                if not resp['acknowledged']:
+                    logging.getLogger('elastic').error(
+                        'Failed to create Component Template {}.  Error: {}'.format(template_name, str(resp)))
+                    raise Exception(
+                        'Failed to create Component Template {}.  Error: {}'.format(template_name, str(resp)))
+
+                self.__installed('component_templates', template_name)
+                return {'status': 'created'}
+            return {'status': 'already_present'}
 
     def install_lifecycle_policy(self, policy_name, policy, description=None, version=None, requires_prefix=None):
-        if policy_name not in self.loaded_lifecycle_policies():
-            if '_meta' not in policy and (description is None or version is None or requires_prefix is None):
-                raise Exception("Policy does not contain all required _meta fields [description, version, requires_prefix]")
-            elif '_meta' not in policy:
-                policy['_meta'] = {'description': description, 'version': version, 'requires_prefix': requires_prefix}
-
-            logging.getLogger('elastic').info('Creating Lifecycle Policy: {}'.format(policy_name))
-            resp = self.request_session.put(self.root_url + '_ilm/policy/' + policy_name, json=policy).json()
-            if not resp['acknowledged']:
-                logging.getLogger('elastic').error('Failed to create ILM Policy {}.  Error: {}'.format(policy_name, str(resp)))
-                raise Exception('Failed to create ILM Policy {}.  Error: {}'.format(policy_name, str(resp)))
-
-            return {'status': 'created'}
-        return {'status': 'already_present'}
+        with self.install_pass():
+            if policy_name not in self.loaded_lifecycle_policies():
+                if '_meta' not in policy and (description is None or version is None or requires_prefix is None):
+                    raise Exception("Policy does not contain all required _meta fields [description, version, requires_prefix]")
+                elif '_meta' not in policy:
+                    policy['_meta'] = {'description': description, 'version': version, 'requires_prefix': requires_prefix}
+
+                logging.getLogger('elastic').info('Creating Lifecycle Policy: {}'.format(policy_name))
+                resp = self.request_session.put(self.root_url + '_ilm/policy/' + policy_name, json=policy).json()
+                if not resp['acknowledged']:
+                    logging.getLogger('elastic').error('Failed to create ILM Policy {}.  Error: {}'.format(policy_name, str(resp)))
+                    raise Exception('Failed to create ILM Policy {}.  Error: {}'.format(policy_name, str(resp)))
+
+                self.__installed('lifecycle_policies', policy_name)
+                return {'status': 'created'}
+            return {'status': 'already_present'}
 
     def install_index_template(self, template_name, template, prefix=None, description=None, version=None, requires_prefix=None):
         if '_meta' not in template and (description is None or version is None or requires_prefix is None):
@@ -103,32 +237,38 @@ class ElasticsearchConnection:
             template['index_patterns'] = index_patterns
             template['template']['settings']['index.lifecycle.rollover_alias'] = template['template']['settings']['index.lifecycle.rollover_alias'].replace('<prefix>', prefix)
 
-        if template_name not in self.loaded_index_templates():
-            missing_components = []
+        with self.install_pass():
+            if template_name in self.loaded_index_templates():
+                return {'status': 'already_present'}
+
             if 'composed_of' in template:
-                for component in template['composed_of']:
-                    if component not in self.loaded_component_templates() and component not in self.default_component_templates():
-                        missing_components.append(component)
+                loaded_components = self.loaded_component_templates()
+                default_components = _default_resources(self.root_directory + '/component_templates')
+                missing_components = [component for component in template['composed_of']
+                                      if component not in loaded_components and component not in default_components]
                 if len(missing_components) > 0:
                     logging.getLogger('elastic').error('Missing required template component: {}'.format(str(missing_components)))
                     raise Exception('Missing required template component: {}'.format(str(missing_components)))
 
                 for component in template['composed_of']:
-                    if component not in self.loaded_component_templates():
-                        self.install_component_template(component, self.default_component_templates()[component])
+                    if component not in loaded_components:
+                        self.install_component_template(component, copy.deepcopy(default_components[component]))
 
             if 'index.lifecycle.name' in template['template']['settings']:
                 required_lcp = template['template']['settings']['index.lifecycle.name']
-                if required_lcp not in self.loaded_lifecycle_policies() and required_lcp not in self.default_lifecycle_policies():
-                    logging.getLogger('elastic').error('Missing required Lifecycle Policy: {}'.format(required_lcp))
-                    raise Exception('Missing required Lifecycle Policy: {}'.format(required_lcp))
+                if required_lcp not in self.loaded_lifecycle_policies():
+                    default_policies = _default_resources(self.root_directory + '/lifecycles')
+                    if required_lcp not in default_policies:
+                        logging.getLogger('elastic').error('Missing required Lifecycle Policy: {}'.format(required_lcp))
+                        raise Exception('Missing required Lifecycle Policy: {}'.format(required_lcp))
 
-                self.install_lifecycle_policy(required_lcp, self.default_lifecycle_policies()[required_lcp])
+                    self.install_lifecycle_policy(required_lcp, copy.deepcopy(default_policies[required_lcp]))
 
             resp = self.request_session.put(self.root_url + '_index_template/' + template_name, json=template).json()
             if not resp['acknowledged']:
                 logging.getLogger('elastic').error('Failed to create Template {}.  Error: {}'.format(template_name, str(resp)))
                 raise Exception('Failed to create Template {}.  Error: {}'.format(template_name, str(resp)))
+            self.__installed('index_templates', template_name)
 
             alias_name = template['template']['settings']['index.lifecycle.rollover_alias']
             create_index_json = {'aliases': {alias_name: {'is_write_index': True}}}
@@ -138,55 +278,43 @@ class ElasticsearchConnection:
 
             return {'status': 'created'}
 
-        return {'status': 'already_present'}
+    def ensure_templates(self, templates, prefix=None):
+        """
+        Installs many index templates, with the components and lifecycle policies they need, in one install pass: the
+        server side lists are fetched once and each missing resource is created once.  templates holds names of
+        default index templates or (name, template) pairs.  Returns the status of each template by name.
+        """
+        statuses = {}
+        with self.install_pass():
+            for entry in templates:
+                if isinstance(entry, str):
+                    template_name = entry
+                    template = copy.deepcopy(_default_resources(self.root_directory + '/index_templates')[entry])
+                else:
+                    template_name, template = entry
+                statuses[template_name] = self.install_index_template(template_name, template, prefix=prefix)
+        return statuses
 
     def default_component_templates(self):
-        component_templates = {}
-        for template_file in glob.glob(self.root_directory + "/component_templates/*.json"):
-            template_name = template_file.replace('.json', '').replace(self.root_directory, '') \
-                .replace('\\', '').replace('/', '').replace('component_templates', '')
-            with open(template_file) as template_json_file:
-                template_json = json.load(template_json_file)
-            component_templates[template_name] = template_json
-        return component_templates
+        return copy.deepcopy(_default_resources(self.root_directory + '/component_templates'))
 
     def default_index_templates(self):
-        index_templates = {}
-        for template_file in glob.glob(self.root_directory + "/index_templates/*.json"):
-            template_name = template_file.replace('.json', '').replace(self.root_directory, '') \
-                .replace('\\', '').replace('/', '').replace('index_templates', '')
-            with open(template_file) as template_json_file:
-                template_json = json.load(template_json_file)
-            index_templates[template_name] = template_json
-        return index_templates
+        return copy.deepcopy(_default_resources(self.root_directory + '/index_templates'))
 
     def default_lifecycle_policies(self):
-        lifecycle_policies = {}
-        for ilm_file in glob.glob(self.root_directory + "/lifecycles/*.json"):
-            ilm_name = ilm_file.replace('.json', '').replace(self.root_directory, '') \
-                .replace('\\', '').replace('/', '').replace('lifecycles', '')
-            with open(ilm_file) as ilm_json_file:
-                _json = json.load(ilm_json_file)
-            lifecycle_policies[ilm_name] = _json
-        return lifecycle_policies
+        return copy.deepcopy(_default_resources(self.root_directory + '/lifecycles'))
 
     def loaded_component_templates(self):
-        component_templates = []
-        for c_temp in self.request_session.get(self.root_url + '_component_template').json()['component_templates']:
-            component_templates.append(c_temp['name'])
-        return component_templates
+        return self.__loaded('component_templates', lambda: [c_temp['name'] for c_temp in self.request_session.get(
+            self.root_url + '_component_template').json()['component_templates']])
 
     def loaded_index_templates(self):
-        index_templates = []
-        for i_temp in self.request_session.get(self.root_url + '_index_template').json()['index_templates']:
-            index_templates.append(i_temp['name'])
-        return index_templates
+        return self.__loaded('index_templates', lambda: [i_temp['name'] for i_temp in self.request_session.get(
+            self.root_url + '_index_template').json()['index_templates']])
 
     def loaded_lifecycle_policies(self):
-        lifecycle_policies = []
-        for lc_temp in self.request_session.get(self.root_url + '_ilm/policy').json():
-            lifecycle_policies.append(lc_temp)
-        return lifecycle_policies
+        return self.__loaded('lifecycle_policies', lambda: list(self.request_session.get(
+            self.root_url + '_ilm/policy').json()))
 
     def get_cluster_health(self):
         return self.request_session.get(self.root_url + '_cluster/health').json()
@@ -198,12 +326,17 @@ class ElasticsearchConnection:
                 logging.getLogger('elastic').warning("Cluster is healthy.  However, it is in a YELLOW state. Recommend a check of the cluster.")
             return json['status'] != 'red'
         except Exception as ex:
-            logging.getLogger('elastic').exception()
-            logging.getLogger("elastic").exception()
+            logging.getLogger('elastic').exception('Failed to read the health of cluster: {}'.format(self.root_url))
             return False
 
-    def bulk_processor(self, batch_size=1000, batch_max_size_bytes=5000000):
-        return BulkProcessor(request_session=self.request_session, root_url=self.root_url, batch_size=batch_size, batch_max_size_bytes=batch_max_size_bytes)
+    def bulk_processor(self, batch_size=1000, batch_max_size_bytes=5000000, concurrent_requests=0, queue_size=None,
+                       flush_interval=None, max_retries=3, failure_callback=None, adaptive=False,
+                       compression_level=None):
+        return BulkProcessor(request_session=self.request_session, root_url=self.root_url, batch_size=batch_size,
+                             batch_max_size_bytes=batch_max_size_bytes, concurrent_requests=concurrent_requests,
+                             queue_size=queue_size, flush_interval=flush_interval, max_retries=max_retries,
+                             failure_callback=failure_callback, adaptive=adaptive,
+                             compression_level=compression_level)
 
     def index_document(self, index, document, _id=None):
         if _id is None:
@@ -214,6 +347,13 @@ class ElasticsearchConnection:
         index_resp = {'status_code': response.status_code, 'elastic': response.json()}
         return index_resp
 
+    def search(self, index, query):
+        response = self.request_session.get(self.root_url + '{}/_search'.format(index), json=query)
+        if response.status_code != 200:
+            raise Exception(response.text)
+
+        return response.json()
+
     def find_by_term(self, index, term, value):
         query = {'query': {'terms': {term: value}}}
         response = self.request_session.get(self.root_url + '{}/_search'.format(index), json=query)
@@ -233,8 +373,119 @@ class ElasticsearchConnection:
             else:
                 return {'_index': response['hits']['hits'][0]['_index'], '_type': '_doc', '_id': _id, 'found': True, '_source': response['hits']['hits'][0]['_source']}
 
-    def get_scroller(self):
-        return ScrollQuery(request_session=self.request_session, root_url=self.root_url)
+    def find_by_ids(self, index, ids, alias_index=True):
+        """
+        Batched find_by_id, returning the result for each of ids in the same order and shape.  Concrete indices are
+        read with _mget; aliases, which may span several indices, with ids queries.
+        """
+        ids = list(ids)
+        found = {}
+        if not alias_index:
+            for start in range(0, len(ids), MGET_CHUNK_SIZE):
+                response = self.request_session.post('{}{}/_mget'.format(self.root_url, index),
+                                                     json={'ids': ids[start:start + MGET_CHUNK_SIZE]})
+                if response.status_code != 200:
+                    raise Exception(response.text)
+                for doc in response.json()['docs']:
+                    found[doc['_id']] = doc
+            return [found[_id] for _id in ids]
+
+        unique_ids = list(dict.fromkeys(ids))
+        for start in range(0, len(unique_ids), IDS_QUERY_CHUNK_SIZE):
+            chunk = unique_ids[start:start + IDS_QUERY_CHUNK_SIZE]
+            # Room for duplicates so that an ID held by several indices is reported as find_by_id does
+            query = {"size": min(10000, len(chunk) * 2), "track_total_hits": True,
+                     "query": {"bool": {"filter": {"ids": {"values": chunk}}}}}
+            response = self.search(index, query)
+            counts = {}
+            for hit in response['hits']['hits']:
+                counts[hit['_id']] = counts.get(hit['_id'], 0) + 1
+                found[hit['_id']] = {'_index': hit['_index'], '_type': '_doc', '_id': hit['_id'], 'found': True,
+                                     '_source': hit['_source']}
+            duplicated = [_id for _id, count in counts.items() if count > 1]
+            if len(duplicated) > 0:
+                raise Exception(f'IDs: {duplicated} have returned more than 1 result.  Expected only 1 or 0 entries.')
+            if response['hits']['total']['value'] > len(response['hits']['hits']):
+                raise Exception(f"Only {len(response['hits']['hits'])} of {response['hits']['total']['value']} results "
+                                f"were returned for {len(chunk)} IDs in {index}, so IDs may have more than 1 result.")
+
+        return [found.get(_id, {'_index': index, '_type': '_doc', '_id': _id, 'found': False}) for _id in ids]
+
+    def __msearch_chunks(self, index, queries):
+        lines = []
+        size = 0
+        for query in queries:
+            line = json.dumps({'index': index}) + '\n' + json.dumps(query) + '\n'
+            if len(lines) > 0 and (len(lines) >= MSEARCH_CHUNK_SIZE or size + len(line) > MSEARCH_CHUNK_BYTES):
+                yield lines
+                lines = []
+                size = 0
+            lines.append(line)
+            size += len(line)
+        if len(lines) > 0:
+            yield lines
+
+    def raw_msearch(self, index, queries):
+        """
+        Runs queries against index with _msearch, in as many requests as MSEARCH_CHUNK_SIZE and MSEARCH_CHUNK_BYTES
+        require, and returns every response in the order of queries.  Failed searches are returned as their error
+        response, with its status.
+        """
+        responses = []
+        for lines in self.__msearch_chunks(index, queries):
+            response = self.request_session.post(self.root_url + '_msearch', data=''.join(lines).encode('utf-8'),
+                                                 headers={'Content-Type': 'application/x-ndjson'})
+            if response.status_code != 200:
+                raise Exception(response.text)
+            responses.extend(response.json()['responses'])
+        return responses
+
+    def msearch(self, index, queries):
+        """Batched search, returning the response of each of queries in order.  Raises if any of the searches failed."""
+        responses = self.raw_msearch(index, queries)
+        for response in responses:
+            if 'error' in response:
+                raise Exception(json.dumps(response))
+        return responses
+
+    def find_by_term_many(self, index, term, values):
+        """Batched find_by_term, returning the result for each entry of values in the same order and shape."""
+        return [{'status_code': response.get('status', 200), 'elastic': response}
+                for response in self.raw_msearch(index, [{'query': {'terms': {term: value}}} for value in values])]
+
+    def get_scroller(self, keepalive="1m", page_size=None, prefetch=0):
+        return ScrollQuery(request_session=self.request_session, root_url=self.root_url, keepalive=keepalive,
+                           page_size=page_size, prefetch=prefetch)
+
+    def query_batches(self, index, query, fields, output='pandas', batch_size=10000, memory_budget=None,
+                      use_docvalues=False, include_id=False, page_size=5000, slices=1, prefetch=1):
+        """
+        Streams the hits of query into columnar batches of the given fields: pandas DataFrames, dicts of NumPy arrays
+        or Arrow RecordBatches (output).  Only the fields are fetched, from _source or, with use_docvalues, from the
+        docvalue fields.  See columnar.column_batches for batch_size and memory_budget.
+        """
+        # Imported here so that numpy and pandas are only loaded by callers of the columnar helpers
+        from . import columnar
+
+        scroll_query = self.get_scroller(page_size=page_size, prefetch=prefetch)
+        if use_docvalues:
+            hits = scroll_query.query(index, query, source=False, docvalue_fields=list(fields), slices=slices)
+        else:
+            hits = scroll_query.query(index, query, source=list(fields), slices=slices)
+
+        try:
+            for columns in columnar.column_batches(hits, fields, batch_size=batch_size, memory_budget=memory_budget,
+                                                   use_docvalues=use_docvalues, include_id=include_id):
+                yield columnar.convert(columns, output)
+        finally:
+            hits.close()
+            scroll_query.clear()
+
+    def query_dataframe(self, index, query, fields, **kwargs):
+        """Returns the hits of query as a single pandas DataFrame of the given fields, built batch by batch."""
+        from . import columnar
+
+        return columnar.concat(self.query_batches(index, query, fields, output='pandas', **kwargs))
 
     def aggregation(self, index, query, aggregation_name):
         json_data = self.raw_aggregation(index, query)
@@ -243,6 +494,16 @@ class ElasticsearchConnection:
 
         return []
 
+    def aggregation_many(self, index, queries, aggregation_name):
+        """Batched aggregation, returning the buckets of aggregation_name for each of queries in order."""
+        results = []
+        for json_data in self.msearch(index, queries):
+            if "aggregations" in json_data and aggregation_name in json_data['aggregations']:
+                results.append(json_data['aggregations'][aggregation_name]['buckets'])
+            else:
+                results.append([])
+        return results
+
     def raw_aggregation(self, index, query):
         response = self.request_session.get(self.root_url + '{}/_search'.format(index), json=query)
         if response.status_code != 200:
@@ -1,119 +1,360 @@
+import gzip
 import json
 import logging
+import queue
+import re
+import threading
+import time
+
+import requests
+
+# Item and response statuses that are worth retrying: too many requests and server side failures
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+# Elasticsearch writes took and errors ahead of the items of a _bulk response
+_RESPONSE_HEAD = re.compile(rb'\s*\{\s*"took"\s*:\s*(\d+)\s*,\s*"errors"\s*:\s*(true|false)\s*,')
+# Only the parts of each item the processor uses are returned, which keeps large responses small
+BULK_FILTER_PATH = 'took,errors,items.*._id,items.*._index,items.*.status,items.*.result,items.*.error'
+_RESULT = re.compile(rb'"result"\s*:\s*"(\w+)"')
+
+
+class BulkRequestRejected(Exception):
+
+    def __init__(self, message, status_code=None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _parse_response(content):
+    """
+    Returns took, errors and the items of a _bulk response.  When errors is false the items are not parsed and None
+    is returned in their place.
+    """
+    head = _RESPONSE_HEAD.match(content)
+    if head is not None and head.group(2) == b'false':
+        return int(head.group(1)), False, None
+
+    resp_json = json.loads(content)
+    if not resp_json['errors']:
+        return resp_json['took'], False, None
+    return resp_json['took'], True, resp_json['items']
+
+
+def _count_results(content):
+    """Counts the results of a _bulk response without errors, without parsing its items."""
+    counts = {}
+    for result in _RESULT.findall(content):
+        result = result.decode('utf-8')
+        counts[result] = counts.get(result, 0) + 1
+    return counts
 
 
 class BulkProcessor:
+    """
+    Buffers bulk actions and sends them to the _bulk API once batch_size actions or batch_max_size_bytes bytes are
+    pending.  Actions are encoded once when added and held as a list of byte chunks with a running byte count, which
+    are joined a single time when the batch is sent.
 
-    def __init__(self, request_session, root_url, batch_size, batch_max_size_bytes) -> None:
+    By default batches are sent on the calling thread.  With concurrent_requests > 0 they are handed to that many
+    flusher threads through a queue of at most queue_size batches, so up to concurrent_requests _bulk requests are in
+    flight while new actions are buffered; callers block when the queue is full.  flush_interval (seconds) sends a
+    partially filled batch once it has been pending that long.  close() waits for every batch to be sent and returns
+    the aggregated results, or raises the first error of a batch sent in the background.
+
+    With compression_level set (1 to 9), request bodies are sent gzip compressed at that level.
+
+    Items rejected with a 429 or 5xx status, or whole batches that fail that way, are resent up to max_retries times
+    with exponential backoff (initial_backoff doubling to max_backoff seconds); only the failed items are resent.
+    Items that still fail, or fail with any other error, are added to results['error_entries'] and passed to
+    failure_callback.  If a batch still fails as a whole after its retries, or with any other status such as 413, each
+    of its items is reported the same way and the exception is raised.
+
+    With adaptive=True, batch_size and batch_max_size_bytes are halved when items are rejected or a request takes
+    longer than target_latency seconds, and grown by a quarter when requests complete in under half of it, within
+    a sixteenth and four times of the configured values.
+    """
+
+    def __init__(self, request_session, root_url, batch_size, batch_max_size_bytes, concurrent_requests=0,
+                 queue_size=None, flush_interval=None, max_retries=3, initial_backoff=0.5, max_backoff=30,
+                 failure_callback=None, adaptive=False, target_latency=2.0, compression_level=None) -> None:
         super().__init__()
         self.request_session = request_session
-        self.entries = ""
+        self.chunks = []
+        self.current_batch_bytes = 0
         self.batch_size = batch_size
         self.batch_max_size_bytes = batch_max_size_bytes
         self.root_url = root_url
         self.current_batch_size = 0
         self.results = {"created": 0, "updated": 0, "errors": 0, "error_entries": []}
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.failure_callback = failure_callback
+        self.adaptive = adaptive
+        self.target_latency = target_latency
+        self.compression_level = compression_level
+        self.__batch_size_bounds = (max(1, batch_size // 16), batch_size * 4)
+        self.__batch_bytes_bounds = (max(1, batch_max_size_bytes // 16), batch_max_size_bytes * 4)
+        self.__lock = threading.RLock()
+        self.__results_lock = threading.Lock()
+        self.__batch_started = None
+        self.__closed = threading.Event()
+        self.__flusher_exception = None
+
+        self.__queue = None
+        self.__flushers = []
+        if concurrent_requests > 0:
+            self.__queue = queue.Queue(maxsize=queue_size if queue_size is not None else concurrent_requests * 2)
+            for i in range(concurrent_requests):
+                flusher = threading.Thread(target=self.__flusher, daemon=True, name='BulkFlusher:[{}]'.format(i))
+                flusher.start()
+                self.__flushers.append(flusher)
+
+        self.__timer = None
+        if flush_interval is not None:
+            self.__timer = threading.Thread(target=self.__flush_timer, daemon=True, name='BulkFlushTimer')
+            self.__timer.start()
 
     def __enter__(self):
         return self
 
+    def __flusher(self):
+        while True:
+            batch = self.__queue.get()
+            try:
+                if batch is None:
+                    return
+                self.__send(batch)
+            except Exception as ex:
+                if self.__flusher_exception is None:
+                    self.__flusher_exception = ex
+            finally:
+                self.__queue.task_done()
+
+    def __flush_timer(self):
+        while not self.__closed.wait(min(self.flush_interval, 1)):
+            try:
+                with self.__lock:
+                    if self.__batch_started is not None and time.time() - self.__batch_started >= self.flush_interval:
+                        self.process_batch()
+            except Exception as ex:
+                # Kept, as for the flushers, to be raised by close().  The timer carries on with the next batch
+                logging.getLogger('elastic').exception('Error sending bulk batch on flush interval: {}'.format(str(ex)))
+                if self.__flusher_exception is None:
+                    self.__flusher_exception = ex
+
     def process_batch(self):
-        if self.current_batch_size == 0:
-            logging.getLogger('elastic').warning("Request to process batch was made.  But batch is currently empty.")
-            return
+        with self.__lock:
+            if self.current_batch_size == 0:
+                logging.getLogger('elastic').warning("Request to process batch was made.  But batch is currently empty.")
+                return
 
-        logging.getLogger('elastic').info("Processing Bulk Index Batch. Size: {}".format(str(self.current_batch_size)))
-        headers = self.request_session.headers
-        headers['Content-Type'] = 'application/x-ndjson'
-        r = self.request_session.post(self.root_url + "/_bulk", data=self.entries, headers=headers)
-        if r.status_code >= 400:
-            logging.getLogger('elastic').error("Bulk index returned Error Code: {} [{}]".format(str(r.status_code), r.content))
+            chunks = self.chunks
+            self.chunks = []
+            self.current_batch_bytes = 0
+            self.current_batch_size = 0
+            self.__batch_started = None
 
-        self.entries = ""
-        self.current_batch_size = 0
+            if self.__queue is not None:
+                # Blocks while the queue is full, holding back new actions until a flusher catches up
+                self.__queue.put(chunks)
+                return
+
+        self.__send(chunks)
+
+    def __send(self, chunks):
+        attempt = 0
+        while True:
+            try:
+                chunks = self.__send_batch(chunks, final=attempt >= self.max_retries)
+                if len(chunks) == 0:
+                    return
+                logging.getLogger('elastic').warning('{} bulk items were rejected, retrying'.format(len(chunks)))
+            except (BulkRequestRejected, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+                retryable = not isinstance(ex, BulkRequestRejected) or ex.status_code in RETRYABLE_STATUSES
+                if attempt >= self.max_retries or not retryable:
+                    self.__batch_failed(chunks, ex)
+                    raise
+                logging.getLogger('elastic').warning('Bulk request failed, retrying {} items'.format(len(chunks)))
+
+            time.sleep(min(self.initial_backoff * (2 ** attempt), self.max_backoff))
+            attempt += 1
+
+    def __send_batch(self, chunks, final):
+        """Sends a batch of chunks, returning the chunks of the items to retry."""
+        logging.getLogger('elastic').info("Processing Bulk Index Batch. Size: {}".format(str(len(chunks))))
+        headers = {'Content-Type': 'application/x-ndjson'}
+        payload = b''.join(chunks)
+        if self.compression_level is not None:
+            payload = gzip.compress(payload, compresslevel=self.compression_level)
+            headers['Content-Encoding'] = 'gzip'
+        start = time.time()
+        r = self.request_session.post(self.root_url + "/_bulk?filter_path=" + BULK_FILTER_PATH, data=payload,
+                                      headers=headers)
+        latency = time.time() - start
+        if not 200 <= r.status_code < 300:
+            logging.getLogger('elastic').error("Bulk index returned Error Code: {} [{}]".format(str(r.status_code), r.content))
+            if r.status_code in RETRYABLE_STATUSES:
+                self.__adapt(latency, rejected=True)
+                raise BulkRequestRejected("Bulk index returned Error Code: {}".format(str(r.status_code)),
+                                          status_code=r.status_code)
+            # The whole request was refused, e.g. a malformed (400) or too large (413) body, there are no items
+            raise BulkRequestRejected("Bulk index returned Error Code: {}: {}".format(
+                str(r.status_code), r.content[:1000].decode('utf-8', errors='replace')), status_code=r.status_code)
 
         try:
-            resp_json = r.json()
-            took = resp_json['took']
-            errors = resp_json['errors']
+            took, errors, items = _parse_response(r.content)
             stats = {'errors': 0}
+            retry = []
 
             if errors:
                 logging.getLogger('elastic').error('An Error occurred while performing the bulk index')
+            elif items is None:
+                stats.update(_count_results(r.content))
+
+            for chunk, item in zip(chunks, items or ()):
+                action, result = next(iter(item.items()))
+                if 'error' in result:
+                    if result.get('status') in RETRYABLE_STATUSES and not final:
+                        retry.append(chunk)
+                        continue
+                    stats['errors'] = stats['errors'] + 1
+                    error_msg = "Error of Type: {}.  Caused by: {}. For Document ID: {}, in Index: {}" \
+                        .format(result['error']['type'], result['error']['reason'], result.get('_id'),
+                                result.get('_index'))
+                    logging.getLogger('elastic').error(error_msg)
+                    self.__failed(chunk, result)
+                else:
+                    if result['result'] not in stats:
+                        stats[result['result']] = 0
 
-            for item in resp_json['items']:
-                if "index" in item:
-                    if 'error' in item['index']:
-                        stats['errors'] = stats['errors'] + 1
-                        error_msg = "Error of Type: {}.  Caused by: {}. For Document ID: {}, in Index: {}" \
-                            .format(item['index']['error']['type'], item['index']['error']['reason']
-                                    , item['index']['_id'], item['index']['_index'])
-                        logging.getLogger('elastic').error(error_msg)
-                    else:
-                        if item['index']['result'] not in stats:
-                            stats[item['index']['result']] = 0
-
-                        stats[item['index']['result']] = stats[item['index']['result']] + 1
-
-            msg = ''
-            for key, value in stats.items():
-                if len(msg) > 0:
-                    msg = msg + ',\t'
-                msg = msg + key + ': ' + str(value)
+                    stats[result['result']] = stats[result['result']] + 1
+
+            with self.__results_lock:
+                for key, value in stats.items():
+                    self.results[key] = self.results.get(key, 0) + value
+
+            msg = ',\t'.join('{}: {}'.format(key, value) for key, value in stats.items())
             logging.getLogger('elastic').info("Bulk index took: {}, with the following results: {}".format(str(took), msg))
 
         except Exception as ex:
-            logging.getLogger('elastic').exception("Error: {}.  Response: {}".format(str(ex), str(r.json)))
+            logging.getLogger('elastic').exception("Error: {}.  Response: {}".format(str(ex), str(r.content[:1000])))
             raise ex
 
+        self.__adapt(max(latency, took / 1000), rejected=len(retry) > 0)
+        return retry
+
+    def __failed(self, chunk, result):
+        lines = chunk.decode('utf-8').splitlines()
+        entry = {'action': json.loads(lines[0]), 'document': json.loads(lines[1]) if len(lines) > 1 else None,
+                 'status': result.get('status'), 'error': result['error']}
+        with self.__results_lock:
+            self.results['error_entries'].append(entry)
+        if self.failure_callback is not None:
+            try:
+                self.failure_callback(entry)
+            except Exception as ex:
+                logging.getLogger('elastic').exception('Error in bulk failure callback: {}'.format(str(ex)))
+
+    def __batch_failed(self, chunks, ex):
+        logging.getLogger('elastic').error('Bulk request failed, {} items were not sent: {}'
+                                           .format(len(chunks), str(ex)))
+        result = {'status': getattr(ex, 'status_code', None), 'error': {'type': type(ex).__name__, 'reason': str(ex)}}
+        with self.__results_lock:
+            self.results['errors'] = self.results['errors'] + len(chunks)
+        for chunk in chunks:
+            self.__failed(chunk, result)
+
+    def __adapt(self, latency, rejected):
+        if not self.adaptive:
+            return
+        if rejected or latency > self.target_latency:
+            factor = 0.5
+        elif latency < self.target_latency / 2:
+            factor = 1.25
+        else:
+            return
+
+        batch_size = min(max(int(self.batch_size * factor), self.__batch_size_bounds[0]), self.__batch_size_bounds[1])
+        batch_max_size_bytes = min(max(int(self.batch_max_size_bytes * factor), self.__batch_bytes_bounds[0]),
+                                   self.__batch_bytes_bounds[1])
+        if batch_size != self.batch_size or batch_max_size_bytes != self.batch_max_size_bytes:
+            logging.getLogger('elastic').debug('Adjusting bulk batch size to {} actions, {} bytes'
+                                               .format(batch_size, batch_max_size_bytes))
+            self.batch_size = batch_size
+            self.batch_max_size_bytes = batch_max_size_bytes
+
+    @property
+    def entries(self):
+        """The pending NDJSON payload as text."""
+        return b''.join(self.chunks).decode('utf-8')
+
     def _check_for_processing(self):
-        if len(self.entries.encode('utf-8')) > self.batch_max_size_bytes:
+        if self.current_batch_bytes > self.batch_max_size_bytes:
             logging.getLogger('elastic').warning("Length of entries exceeds {} bytes.  Processing current batch before adding new entry.".format(self.batch_max_size_bytes))
             self.process_batch()
         elif self.current_batch_size >= self.batch_size:
-            if len(self.entries) <= 5:
+            if self.current_batch_bytes <= 5:
                 logging.getLogger('elastic').warning("Batch size is {}, but length of content is {}. Content: {}"
-                                .format(str(self.batch_size), str(len(self.entries)), self.entries))
+                                .format(str(self.batch_size), str(self.current_batch_bytes), self.entries))
             self.process_batch()
 
+    def _append(self, action, document=None):
+        chunk = json.dumps(action) + "\n"
+        if document is not None:
+            chunk = chunk + json.dumps(document) + "\n"
+        chunk = chunk.encode('utf-8')
+        with self.__lock:
+            self._check_for_processing()
+            self.chunks.append(chunk)
+            self.current_batch_bytes += len(chunk)
+            self.current_batch_size += 1
+            if self.__batch_started is None:
+                self.__batch_started = time.time()
+            self._check_for_processing()
+
     def delete(self, index, _id):
-        self._check_for_processing()
-        self.entries = self.entries + json.dumps({"delete": {"_index": index, "_id": _id}}) + "\n"
-        self.current_batch_size += 1
-        self._check_for_processing()
+        self._append({"delete": {"_index": index, "_id": _id}})
 
     def update(self, index, entry, _id):
-        self._check_for_processing()
-        self.entries = self.entries + json.dumps({"update": {"_index": index, "_id": _id}}) + "\n"
-        self.entries = self.entries + json.dumps({"doc": entry}) + "\n"
-        self.current_batch_size += 1
-        self._check_for_processing()
+        self._append({"update": {"_index": index, "_id": _id}}, {"doc": entry})
 
     def index(self, index, entry, _id=None):
-        self._check_for_processing()
-
         if _id is not None:
-            self.entries = self.entries + json.dumps({"index": {"_index": index, "_id": _id}}) + "\n"
+            self._append({"index": {"_index": index, "_id": _id}}, entry)
         else:
-            self.entries = self.entries + json.dumps({"index": {"_index": index}}) + "\n"
-        self.entries = self.entries + json.dumps(entry) + "\n"
-        self.current_batch_size += 1
-        self._check_for_processing()
+            self._append({"index": {"_index": index}}, entry)
 
     def create(self, index, entry, _id=None):
-        self._check_for_processing()
-
         if _id is not None:
-            self.entries = self.entries + json.dumps({"create": {"_index": index, "_id": _id}}) + "\n"
+            self._append({"create": {"_index": index, "_id": _id}}, entry)
         else:
-            self.entries = self.entries + json.dumps({"create": {"_index": index}}) + "\n"
-        self.entries = self.entries + json.dumps(entry) + "\n"
-        self.current_batch_size += 1
-        self._check_for_processing()
+            self._append({"create": {"_index": index}}, entry)
 
     def close(self):
-        self.process_batch()
+        if not self.__closed.is_set():
+            self.__closed.set()
+            if self.__timer is not None:
+                self.__timer.join()
+            if self.current_batch_size > 0 or self.__queue is None:
+                self.process_batch()
+            if self.__queue is not None:
+                for _ in self.__flushers:
+                    self.__queue.put(None)
+                for flusher in self.__flushers:
+                    flusher.join()
+            if self.__flusher_exception is not None:
+                raise self.__flusher_exception
         return self.results
 
     def __exit__(self, type, value, traceback):
-        self.process_batch()
+        if type is None:
+            self.close()
+            return
+        try:
+            self.close()
+        except Exception as ex:
+            # The error of the "with" block is the one raised, that of the batches sent on closing is only logged
+            logging.getLogger('elastic').exception('Error while closing bulk processor: {}'.format(str(ex)))
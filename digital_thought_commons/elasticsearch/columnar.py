@@ -0,0 +1,94 @@
+import sys
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+OUTPUTS = ('numpy', 'pandas', 'arrow')
+
+
+def _field_getter(field, use_docvalues):
+    if use_docvalues:
+        def get_docvalue(hit):
+            values = hit.get('fields', {}).get(field)
+            return values[0] if values else None
+        return get_docvalue
+
+    path = field.split('.')
+    if len(path) == 1:
+        return lambda hit: hit['_source'].get(field)
+
+    def get_nested(hit):
+        value = hit['_source']
+        for key in path:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+    return get_nested
+
+
+def _row_size(columns, row):
+    return sum(sys.getsizeof(column[row]) for column in columns.values()) + 8 * len(columns)
+
+
+def column_batches(hits, fields, batch_size=10000, memory_budget=None, use_docvalues=False, include_id=False):
+    """
+    Collects the given fields of hits into columns, yielding a dict of field name to list of values every batch_size
+    hits.  Hits are not retained, so at most one batch is held at a time.  memory_budget (bytes) lowers the rows per
+    batch so that the values of a batch take no more than about that much memory, estimated from the first 100 hits
+    of each batch.
+    Dotted fields are read from nested objects of _source, or from the docvalue fields when use_docvalues is set.
+    """
+    names = (['_id'] if include_id else []) + list(fields)
+    getters = ([lambda hit: hit['_id']] if include_id else []) + [_field_getter(field, use_docvalues)
+                                                                  for field in fields]
+    columns = {name: [] for name in names}
+    appenders = [columns[name].append for name in names]
+    rows = 0
+    sampled_bytes = 0
+    limit = batch_size
+
+    for hit in hits:
+        for append, getter in zip(appenders, getters):
+            append(getter(hit))
+        rows += 1
+
+        if memory_budget is not None and rows <= 100:
+            sampled_bytes += _row_size(columns, rows - 1)
+            limit = max(1, min(batch_size, int(memory_budget // (sampled_bytes / rows))))
+
+        if rows >= limit:
+            yield columns
+            columns = {name: [] for name in names}
+            appenders = [columns[name].append for name in names]
+            rows = 0
+            sampled_bytes = 0
+
+    if rows > 0:
+        yield columns
+
+
+def convert(columns, output='pandas'):
+    """Converts a batch of columns to a dict of NumPy arrays, a pandas DataFrame or an Arrow RecordBatch."""
+    if output == 'pandas':
+        return pd.DataFrame(columns, copy=False)
+    elif output == 'numpy':
+        return {name: np.asarray(values) for name, values in columns.items()}
+    elif output == 'arrow':
+        if pyarrow is None:
+            raise Exception('The pyarrow package is required for Arrow output but is not installed')
+        return pyarrow.RecordBatch.from_pydict(columns)
+    raise Exception('Unknown columnar output: {}.  Expected one of {}'.format(output, ', '.join(OUTPUTS)))
+
+
+def concat(frames):
+    """Concatenates DataFrame batches into a single DataFrame."""
+    frames = list(frames)
+    if len(frames) == 0:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
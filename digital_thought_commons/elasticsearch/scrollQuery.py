@@ -1,36 +1,254 @@
+import heapq
+import queue
+import threading
+
+_DONE = object()
+
+
 class ScrollQuery:
+    """
+    Reads every hit of a query, either with the scroll API (query) or with a point in time and search_after
+    (search_after).
 
-    def __init__(self, request_session, root_url) -> None:
+    Both can split the read into slices that are fetched in parallel by one thread each.  The hits of the slices are
+    yielded as they arrive (ordered=False), or merged on their sort values (ordered=True), which requires the query
+    to be sorted.  page_size sets the hits per request, keepalive how long Elasticsearch keeps the scroll or point in
+    time between requests, and source / docvalue_fields limit the fields returned.
+
+    With prefetch > 0, up to prefetch pages per slice are read ahead on background threads while the current page is
+    being consumed.  The scroll contexts and point in time of a read are cleared as soon as it is exhausted, or when
+    the generator is closed early.
+    """
+
+    def __init__(self, request_session, root_url, keepalive="1m", page_size=None, prefetch=0) -> None:
         super().__init__()
         self.request_session = request_session
         self.root_url = root_url
+        self.keepalive = keepalive
+        self.page_size = page_size
+        self.prefetch = prefetch
         self.scroll_ids = []
+        self.pit_ids = []
+        self.__lock = threading.Lock()
+
+    def __clear(self, scroll_ids, pit_ids):
+        scroll_ids, pit_ids = list(dict.fromkeys(scroll_ids)), list(dict.fromkeys(pit_ids))
+        with self.__lock:
+            for scroll_id in scroll_ids:
+                while scroll_id in self.scroll_ids:
+                    self.scroll_ids.remove(scroll_id)
+            for pit_id in pit_ids:
+                while pit_id in self.pit_ids:
+                    self.pit_ids.remove(pit_id)
+
+        if len(scroll_ids) > 0:
+            self.request_session.delete(self.root_url + "_search/scroll", json={"scroll_id": scroll_ids})
+        for pit_id in pit_ids:
+            self.request_session.delete(self.root_url + "_pit", json={"id": pit_id})
 
     def close(self):
-        body = {"scroll_id": self.scroll_ids}
-        r = self.request_session.delete(self.root_url + "_search/scroll", json=body)
-        self.scroll_ids.clear()
+        self.__clear(list(self.scroll_ids), list(self.pit_ids))
 
     def clear(self):
         self.close()
 
-    def query(self, index, query):
-        scroll = "1m"
-        body = query
+    def __post(self, url, body=None):
+        r = self.request_session.post(url, json=body)
+        if r.status_code != 200:
+            raise Exception("Search request failed with status {}: {}".format(str(r.status_code), r.text))
+        return r.json()
+
+    def __body(self, query, page_size, source, docvalue_fields):
+        body = dict(query)
+        if page_size is not None:
+            body['size'] = page_size
+        if source is not None:
+            body['_source'] = source
+        if docvalue_fields is not None:
+            body['docvalue_fields'] = docvalue_fields
+        return body
 
-        r = self.request_session.post(self.root_url + index + "/_search?scroll=1m", json=body)
+    def __opened(self, contexts, scroll_id=None, pit_id=None):
+        with self.__lock:
+            if scroll_id is not None:
+                contexts['scroll_ids'].append(scroll_id)
+                self.scroll_ids.append(scroll_id)
+            if pit_id is not None:
+                contexts['pit_ids'].append(pit_id)
+                self.pit_ids.append(pit_id)
 
-        scroll_id = r.json()['_scroll_id']
-        self.scroll_ids.append(scroll_id)
-        hits = r.json()['hits']['hits']
-        scroll_query = {"scroll": scroll, "scroll_id": scroll_id}
+    def __scroll_pages(self, index, body, keepalive, stopped, contexts):
+        response = self.__post(self.root_url + index + "/_search?scroll=" + keepalive, body)
+        scroll_id = response['_scroll_id']
+        self.__opened(contexts, scroll_id=scroll_id)
+        hits = response['hits']['hits']
 
         while len(hits) > 0:
-            for hit in hits:
-                yield hit
+            yield hits
+            if stopped.is_set():
+                return
+
+            response = self.__post(self.root_url + "_search/scroll", {"scroll": keepalive, "scroll_id": scroll_id})
+            if response['_scroll_id'] != scroll_id:
+                scroll_id = response['_scroll_id']
+                self.__opened(contexts, scroll_id=scroll_id)
+            hits = response['hits']['hits']
+
+    def __pit_pages(self, pit_id, body, keepalive, stopped, contexts):
+        body = dict(body)
+        while True:
+            body['pit'] = {"id": pit_id, "keep_alive": keepalive}
+            response = self.__post(self.root_url + "_search", body)
+            if response.get('pit_id', pit_id) != pit_id:
+                pit_id = response['pit_id']
+                self.__opened(contexts, pit_id=pit_id)
+            hits = response['hits']['hits']
+            if len(hits) == 0:
+                return
+
+            yield hits
+            if stopped.is_set() or len(hits) < body['size']:
+                return
+            body['search_after'] = hits[-1]['sort']
+
+    @staticmethod
+    def __produce(pages, output, stopped):
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    output.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for hits in pages:
+                if not put(hits):
+                    return
+        except Exception as ex:
+            put(ex)
+        finally:
+            put(_DONE)
+
+    @staticmethod
+    def __drain(output):
+        while True:
+            item = output.get()
+            if item is _DONE:
+                return
+            elif isinstance(item, Exception):
+                raise item
+            yield from item
+
+    @staticmethod
+    def __descending(sort):
+        """Returns whether the sort of a query is descending, which must be the same for every sort field."""
+        directions = set()
+        for field in sort if isinstance(sort, list) else [sort]:
+            if isinstance(field, str):
+                directions.add('desc' if field == '_score' else 'asc')
+                continue
+            for name, order in field.items():
+                if isinstance(order, dict):
+                    order = order.get('order', 'desc' if name == '_score' else 'asc')
+                directions.add(str(order).lower())
+        if len(directions) > 1:
+            raise Exception("An ordered sliced read requires every sort field in the same direction: {}".format(sort))
+        return directions == {'desc'}
+
+    @staticmethod
+    def __sort_values(hit):
+        if hit.get('sort') is None or None in hit['sort']:
+            raise Exception("Hit {} has no sort value to merge the slices on, sort on a field every document "
+                            "has or give it a missing value".format(hit.get('_id')))
+        return hit['sort']
+
+    def __read(self, slice_pages, ordered, prefetch, stopped, contexts, descending=False):
+        """Yields the hits of the page generators of each slice, then clears the contexts they opened."""
+        producers = []
+        try:
+            if len(slice_pages) == 1 and prefetch <= 0:
+                for hits in slice_pages[0]:
+                    yield from hits
+                return
+
+            # One queue per slice to merge them in order, otherwise a single queue shared by every slice
+            depth = max(prefetch, 1)
+            if ordered:
+                outputs = [queue.Queue(maxsize=depth) for _ in slice_pages]
+            else:
+                outputs = [queue.Queue(maxsize=depth * len(slice_pages))]
+            for i, pages in enumerate(slice_pages):
+                producer = threading.Thread(target=self.__produce, args=(pages, outputs[i if ordered else 0], stopped),
+                                            daemon=True, name='ScrollSlice:[{}]'.format(i))
+                producer.start()
+                producers.append(producer)
+
+            if ordered and len(slice_pages) > 1:
+                yield from heapq.merge(*[self.__drain(output) for output in outputs], key=self.__sort_values,
+                                       reverse=descending)
+            else:
+                remaining = len(slice_pages)
+                while remaining > 0:
+                    item = outputs[0].get()
+                    if item is _DONE:
+                        remaining -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield from item
+        finally:
+            stopped.set()
+            for producer in producers:
+                # A producer may be waiting on a request, the contexts it opens are only known once it returns
+                producer.join(timeout=60)
+            self.__clear(contexts['scroll_ids'], contexts['pit_ids'])
+
+    def query(self, index, query, keepalive=None, page_size=None, source=None, docvalue_fields=None, slices=1,
+              ordered=False, prefetch=None):
+        """Yields the hits of query using the scroll API, across slices parallel scrolls when slices > 1."""
+        keepalive = keepalive or self.keepalive
+        body = self.__body(query, page_size or self.page_size, source, docvalue_fields)
+        if ordered and slices > 1 and 'sort' not in body:
+            raise Exception("An ordered sliced scroll requires a sorted query")
+        descending = ordered and slices > 1 and self.__descending(body['sort'])
+
+        stopped = threading.Event()
+        contexts = {'scroll_ids': [], 'pit_ids': []}
+        if slices <= 1:
+            slice_pages = [self.__scroll_pages(index, body, keepalive, stopped, contexts)]
+        else:
+            slice_pages = [self.__scroll_pages(index, dict(body, slice={"id": i, "max": slices}), keepalive,
+                                               stopped, contexts) for i in range(slices)]
+        return self.__read(slice_pages, ordered, self.prefetch if prefetch is None else prefetch, stopped, contexts,
+                           descending)
+
+    def search_after(self, index, query, keepalive=None, page_size=None, source=None, docvalue_fields=None, slices=1,
+                     ordered=True, prefetch=None):
+        """
+        Yields the hits of query using a point in time and search_after, across slices parallel readers when
+        slices > 1.  Queries without a sort are sorted on _shard_doc, the cheapest order to page through.
+        """
+        keepalive = keepalive or self.keepalive
+        body = self.__body(query, page_size or self.page_size or 1000, source, docvalue_fields)
+        body.setdefault('sort', [{"_shard_doc": "asc"}])
+        descending = ordered and slices > 1 and self.__descending(body['sort'])
+        return self.__search_after(index, body, keepalive, slices, ordered,
+                                   self.prefetch if prefetch is None else prefetch, descending)
+
+    def __search_after(self, index, body, keepalive, slices, ordered, prefetch, descending):
+        stopped = threading.Event()
+        contexts = {'scroll_ids': [], 'pit_ids': []}
+        pit_id = self.__post(self.root_url + index + "/_pit?keep_alive=" + keepalive)['id']
+        self.__opened(contexts, pit_id=pit_id)
 
-            r = self.request_session.post(self.root_url + "_search/scroll", json=scroll_query)
-            hits = r.json()['hits']['hits']
+        if slices <= 1:
+            slice_pages = [self.__pit_pages(pit_id, body, keepalive, stopped, contexts)]
+        else:
+            slice_pages = [self.__pit_pages(pit_id, dict(body, slice={"id": i, "max": slices}), keepalive,
+                                            stopped, contexts) for i in range(slices)]
+        yield from self.__read(slice_pages, ordered, prefetch, stopped, contexts, descending)
 
     def __enter__(self):
         """Return self object to use with "with" statement."""
@@ -3,7 +3,6 @@ import logging
 import random
 
 import numpy as np
-import pandas as pd
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.linear_model import LogisticRegression
 from sklearn.model_selection import train_test_split
@@ -15,8 +14,7 @@ class UrlAnalyser:
     index_name = "malicious-urls"
 
     def __init__(self, elastic_server, elastic_port, elastic_api_key):
-        self.elastic = es.ElasticsearchConnection(server=elastic_server, port=elastic_port,
-                                  api_key=elastic_api_key)
+        self.elastic = es.get_connection(server=elastic_server, port=elastic_port, api_key=elastic_api_key)
 
     def learn(self):
         self.vectorizer, self.lgs = self.tl()
@@ -52,14 +50,9 @@ class UrlAnalyser:
 
     def tl(self):
         logging.info("Reading base data")
-        data = []
-        scroll_query = self.elastic.get_scroller()
-        for entry in scroll_query.query(self.index_name, {"size": 1000}):
-            data.append({'url': entry['_source']['url'], 'status': entry['_source']['status']})
-        scroll_query.clear()
+        url_data = self.elastic.query_dataframe(self.index_name, {}, ['url', 'status'], slices=4)
 
         logging.info("Building Vectors")
-        url_data = pd.DataFrame(data)
         url_data = np.array(url_data)
         random.shuffle(url_data)
 
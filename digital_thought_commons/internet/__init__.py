@@ -23,14 +23,15 @@ class DownloadException(Exception):
     pass
 
 
-def new_requester(tor_proxy=None, internet_proxy=None):
+def new_requester(tor_proxy=None, internet_proxy=None, pool_maxsize=10):
     if tor_proxy is None:
         tor_proxy = {"http": 'socks5h://127.0.0.1:9150'}
-    return requester.RequesterSession(tor_proxy=tor_proxy, internet_proxy=internet_proxy)
+    return requester.RequesterSession(tor_proxy=tor_proxy, internet_proxy=internet_proxy, pool_maxsize=pool_maxsize)
 
 
 def retry_request_session(retries=3, backoff_factor=0.3, status_forcelist=(400, 500, 502, 504), timeout=60,
-                          user_agent='Mozilla/5.0 (Windows NT 10.0; rv:78.0) Gecko/20100101 Firefox/78.0', headers={}, proxy=None):
+                          user_agent='Mozilla/5.0 (Windows NT 10.0; rv:78.0) Gecko/20100101 Firefox/78.0', headers={}, proxy=None,
+                          pool_connections=10, pool_maxsize=10):
     base_headers = {'User-Agent': user_agent}
     base_headers.update(headers)
     request_session = requests.Session()
@@ -49,7 +50,7 @@ def retry_request_session(retries=3, backoff_factor=0.3, status_forcelist=(400,
         status_forcelist=status_forcelist,
     )
 
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
     request_session.mount('http://', adapter)
     request_session.mount('https://', adapter)
 
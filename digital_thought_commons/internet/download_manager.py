@@ -1,3 +1,4 @@
+import contextlib
 import json
 import logging
 import multiprocessing
@@ -6,16 +7,111 @@ import pathlib
 import sys
 import threading
 import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlparse
 
 from digital_thought_commons import internet
 from digital_thought_commons.utils import bytes
 
 
+def _write_at(out_file, data, offset):
+    """Writes all of data at offset of out_file without moving a position shared with other writers."""
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while len(view) > 0:
+            written = os.pwrite(out_file.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+    else:
+        out_file.seek(offset)
+        out_file.write(data)
+
+
+def _preallocate(file_name, file_length):
+    """Creates file_name, keeping any existing content, with file_length bytes reserved on disk where supported."""
+    with open(file_name, 'ab') as out_file:
+        if file_length <= 0 or pathlib.Path(file_name).stat().st_size >= file_length:
+            return
+        try:
+            os.posix_fallocate(out_file.fileno(), 0, file_length)
+        except (AttributeError, OSError):
+            # Not available on this platform or filesystem, a sparse file still avoids a merge
+            out_file.truncate(file_length)
+
+
+class TokenBucket:
+    """
+    Limits the bytes read by every worker sharing it to rate bytes per second, allowing bursts of up to capacity bytes.
+    A read larger than the tokens available is allowed and paid back by waiting, so chunks of any size can be used.
+    """
+
+    def __init__(self, rate, capacity=None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.__tokens = self.capacity
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def consume(self, size_bytes):
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+            self.__updated = now
+            self.__tokens -= size_bytes
+            wait = -self.__tokens / self.rate if self.__tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ConnectionLimiter:
+    """Limits the connections open at once across every download sharing it, in total and to each host."""
+
+    def __init__(self, max_connections=None, max_connections_per_host=None) -> None:
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.__connections = threading.BoundedSemaphore(max_connections) if max_connections else None
+        self.__hosts = {}
+        self.__lock = threading.Lock()
+
+    def __host_semaphore(self, url):
+        if not self.max_connections_per_host:
+            return None
+        host = urlparse(url).netloc.lower()
+        with self.__lock:
+            if host not in self.__hosts:
+                self.__hosts[host] = threading.BoundedSemaphore(self.max_connections_per_host)
+            return self.__hosts[host]
+
+    @staticmethod
+    def __acquire(semaphore, cancelled):
+        while not semaphore.acquire(timeout=0.5):
+            if cancelled():
+                return False
+        return True
+
+    @contextlib.contextmanager
+    def connection(self, url, cancelled=lambda: False):
+        """Waits for a connection to url to be allowed, yielding False if cancelled() became true while waiting."""
+        acquired = []
+        try:
+            for semaphore in [self.__host_semaphore(url), self.__connections]:
+                if semaphore is not None:
+                    if not self.__acquire(semaphore, cancelled):
+                        yield False
+                        return
+                    acquired.append(semaphore)
+            yield True
+        finally:
+            for semaphore in reversed(acquired):
+                semaphore.release()
+
+
 class DownloadConfig:
 
     def __init__(self, source_url=None, worker_count=None, source_name=None, file_length=None, supports_range=None,
-                 segments=None, dest_dir=None, full_destination_name=None, partial_name=None) -> None:
+                 segments=None, dest_dir=None, full_destination_name=None, partial_name=None, segment_progress=None) -> None:
         self.source_url = source_url
         self.worker_count = worker_count
         self.source_name = source_name
@@ -25,37 +121,53 @@ class DownloadConfig:
         self.dest_dir = dest_dir
         self.full_destination_name = full_destination_name
         self.partial_name = partial_name
+        # Bytes of each segment written to the partial file, from the start of the segment
+        self.segment_progress = segment_progress if segment_progress is not None else [0] * len(segments or [])
+
+    @property
+    def state_name(self):
+        return f'{self.partial_name}.state'
+
+    def segment(self, segment_number):
+        """Returns the size, start offset and end offset ('' when open ended) of a segment."""
+        parts = self.segments[segment_number].split(':')
+        return int(parts[0]), int(parts[1]) if len(parts) > 1 else 0, parts[2] if len(parts) > 2 else ''
 
     def as_json(self):
         return {'source_url': self.source_url, 'worker_count': self.worker_count, 'source_name': self.source_name, 'file_length': self.file_length,
                 'supports_range': self.supports_range, 'segments': self.segments, 'dest_dir': self.dest_dir, 'full_destination_name': self.full_destination_name,
-                'partial_name': self.partial_name}
+                'partial_name': self.partial_name, 'segment_progress': self.segment_progress}
 
-    def write_to(self, file):
-        with open(file, 'w', encoding='utf-8') as partial_file:
+    def write_to(self, file, fsync=False):
+        # Replaced in one step so that an interruption never leaves a truncated state file
+        with open(f'{file}.tmp', 'w', encoding='utf-8') as partial_file:
             json.dump(self.as_json(), partial_file, indent=4)
+            if fsync:
+                partial_file.flush()
+                os.fsync(partial_file.fileno())
+        os.replace(f'{file}.tmp', file)
 
     @classmethod
     def load_from(cls, file):
         with open(file, 'r', encoding='utf-8') as partial_file:
             config = json.load(partial_file)
 
-            cls.source_url = config['source_url']
-            cls.worker_count = config['worker_count']
-            cls.source_name = config['source_name']
-            cls.file_length = config['file_length']
-            cls.supports_range = config['supports_range']
-            cls.segments = config['segments']
-            cls.dest_dir = config['dest_dir']
-            cls.full_destination_name = config['full_destination_name']
-            cls.partial_name = config['partial_name']
-
-            return cls
+        return cls(source_url=config['source_url'], worker_count=config['worker_count'], source_name=config['source_name'],
+                   file_length=config['file_length'], supports_range=config['supports_range'], segments=config['segments'],
+                   dest_dir=config['dest_dir'], full_destination_name=config['full_destination_name'],
+                   partial_name=config['partial_name'], segment_progress=config.get('segment_progress'))
 
 
 class DownloadProgress:
-
-    def __init__(self, config: DownloadConfig, log_every=5) -> None:
+    """
+    Progress of a download.  Workers only count the bytes they write, a sampler thread adds up those counts every
+    sample_interval seconds to log progress, and saves the high-water marks of the segments to the state file every
+    checkpoint_interval seconds.  With fsync_on_checkpoint the partial file is synced to disk before its high-water
+    marks are saved, so that a saved state never refers to data lost by a crash of the system.
+    """
+
+    def __init__(self, config: DownloadConfig, log_every=5, checkpoint_interval=5, sample_interval=1,
+                 fsync_on_checkpoint=False) -> None:
         self.source_url = None
         self.config = config
         self.__start_time = datetime.now().timestamp()
@@ -67,6 +179,15 @@ class DownloadProgress:
         self.__prior_perc = 0
         self.__max_download_rate = None
         self.__min_download_rate = None
+        self.__checkpoint_interval = checkpoint_interval
+        self.__last_checkpoint = self.__start_time
+        self.__sample_interval = sample_interval
+        self.__fsync_on_checkpoint = fsync_on_checkpoint
+        self.__sampled_amount = 0
+        self.__workers = []
+        self.__scheduler = None
+        self.__sampler = None
+        self.__sampler_stopped = threading.Event()
         self.__lock = threading.Lock()
 
     def __time_remaining(self, download_rate):
@@ -91,7 +212,8 @@ class DownloadProgress:
 
         progress_details = self.progress()
 
-        if force or (progress_details['percentage_complete'] % self.__log_every == 0 and 0 < progress_details['percentage_complete'] != self.__prior_perc and progress_details[
+        # Sampled rather than updated on every chunk, so log whenever a multiple of log_every has been passed
+        if force or (progress_details['percentage_complete'] // self.__log_every > self.__prior_perc // self.__log_every and progress_details[
             'percentage_complete'] != 100) or (self.config.file_length <= 0 and (datetime.now().timestamp() - self.__last_update) >= self.__log_every * 60):
             self.__prior_perc = progress_details['percentage_complete']
             self.__last_update = datetime.now().timestamp()
@@ -132,14 +254,58 @@ class DownloadProgress:
         finally:
             self.__lock.release()
 
-    def update_amount_downloaded(self, size_bytes: int):
+    def sample(self):
+        """Adds up the counters of the workers, logs progress and saves the state when a checkpoint is due."""
         self.__lock.acquire()
         try:
-            self.__amount_downloaded += size_bytes
+            sampled_amount = sum(worker.downloaded for worker in self.__workers)
+            self.__amount_downloaded += sampled_amount - self.__sampled_amount
+            self.__sampled_amount = sampled_amount
+            if datetime.now().timestamp() - self.__last_checkpoint >= self.__checkpoint_interval:
+                self.__checkpoint()
             self.log_progress()
         finally:
             self.__lock.release()
 
+    def __sample(self):
+        while not self.__sampler_stopped.wait(self.__sample_interval):
+            try:
+                self.sample()
+            except Exception as ex:
+                logging.exception(f'Failed to sample the progress of {self.config.source_url}: {str(ex)}')
+
+    def start_sampler(self, workers, scheduler=None):
+        self.__workers = workers
+        self.__scheduler = scheduler
+        self.__sampler_stopped.clear()
+        self.__sampler = threading.Thread(target=self.__sample, daemon=True, name=f'DownloadProgress:[{self.config.partial_name}]')
+        self.__sampler.start()
+
+    def stop_sampler(self):
+        """Stops the sampler, taking a last sample and saving the state of the segments."""
+        self.__sampler_stopped.set()
+        if self.__sampler is not None:
+            self.__sampler.join()
+        self.sample()
+        self.checkpoint()
+
+    def checkpoint(self):
+        self.__lock.acquire()
+        try:
+            self.__checkpoint()
+        finally:
+            self.__lock.release()
+
+    def __checkpoint(self):
+        # Read the marks before syncing: everything below them has already been written to the partial file
+        if self.__scheduler is not None:
+            self.__scheduler.update_config()
+        if self.__fsync_on_checkpoint and os.path.exists(self.config.partial_name):
+            with open(self.config.partial_name, 'rb') as partial_file:
+                os.fsync(partial_file.fileno())
+        self.config.write_to(self.config.state_name, fsync=self.__fsync_on_checkpoint)
+        self.__last_checkpoint = datetime.now().timestamp()
+
     def increment_restarts_after_interruption(self):
         self.__lock.acquire()
         try:
@@ -148,107 +314,308 @@ class DownloadProgress:
             self.__lock.release()
 
 
-class DownloadWorker(threading.Thread):
+class ThroughputTracker:
+    """Smoothed bytes per second of one connection, updated by a single worker at most every window seconds."""
+
+    def __init__(self, window=0.5, smoothing=0.3) -> None:
+        self.rate = 0.0
+        self.__window = window
+        self.__smoothing = smoothing
+        self.__bytes = 0
+        self.__since = time.monotonic()
+
+    def start(self):
+        self.__bytes = 0
+        self.__since = time.monotonic()
+
+    def record(self, size_bytes):
+        self.__bytes += size_bytes
+        elapsed = time.monotonic() - self.__since
+        if elapsed >= self.__window:
+            rate = self.__bytes / elapsed
+            self.rate = rate if self.rate == 0 else self.__smoothing * rate + (1 - self.__smoothing) * self.rate
+            self.start()
+
+
+class DownloadSegment:
+    """
+    The byte range of size limit from start of the download.  Its owner reserves the bytes of each chunk before writing
+    them, and the limit is lowered when the rest of the range is split off for another worker.  A limit of -1 is used
+    when the length of the download is unknown.
+    """
+
+    def __init__(self, start, limit, high_water_mark=0, ranged=True) -> None:
+        self.start = start
+        self.limit = limit
+        self.high_water_mark = high_water_mark
+        self.reserved = high_water_mark
+        self.ranged = ranged
+        self.owner = None
+        self.__lock = threading.Lock()
 
-    def __init__(self, source_url, partial_name, segment_range, worker_number, tor_proxy, internet_proxy, continue_retrying_on_interruption, range_supported,
-                 download_progress: DownloadProgress) -> None:
-        threading.Thread.__init__(self, name=f'DownloadWorker:{str(worker_number)}:[{partial_name}]')
-        self.name = f'DownloadWorker:{str(worker_number)}:[{partial_name}]'
-        self.source_url = source_url
-        self.partial_name = partial_name
-        self.segment_range = segment_range
-        self.range_supported = range_supported
+    def remaining(self):
+        return self.limit - self.reserved if self.limit >= 0 else sys.maxsize
+
+    def is_complete(self):
+        return 0 <= self.limit == self.high_water_mark
+
+    def reserve(self, size_bytes):
+        """Reserves up to size_bytes to be written next, returning how many may be written."""
+        with self.__lock:
+            if self.limit >= 0:
+                size_bytes = min(size_bytes, self.limit - self.reserved)
+            self.reserved += size_bytes
+            return size_bytes
+
+    def restart(self):
+        self.high_water_mark = 0
+        self.reserved = 0
+
+    def split(self, keep):
+        """Keeps keep of the bytes not yet reserved, returning the start and size of the rest or None."""
+        with self.__lock:
+            split = self.reserved + keep
+            if self.limit < 0 or split >= self.limit:
+                return None
+            rest = (self.start + split, self.limit - split)
+            self.limit = split
+            return rest
+
+    def as_range(self):
+        if not self.ranged:
+            return f'{str(self.limit)}'
+        return f'{str(self.limit)}:{str(self.start)}:{str(self.start + self.limit - 1)}'
+
+
+class SegmentScheduler:
+    """
+    Hands out the segments of a download to the workers from a shared queue.  Once the queue is empty an idle worker
+    steals the end of the in-flight segment expected to finish last, judged by the throughput of its connection.  The
+    segment is split in proportion to the throughput of both connections, so that both finish at about the same time,
+    unless the stolen part would be smaller than min_segment_size.
+    """
+
+    def __init__(self, config: DownloadConfig, min_segment_size=1024 * 1024) -> None:
+        self.config = config
+        self.min_segment_size = min_segment_size
+        self.segments = []
+        for n in range(len(config.segments)):
+            segment_size, start_offset, _ = config.segment(n)
+            self.segments.append(DownloadSegment(start_offset, segment_size, config.segment_progress[n],
+                                                 ranged=len(config.segments[n].split(':')) > 1))
+        self.__pending = deque(segment for segment in self.segments if not segment.is_complete())
+        self.__lock = threading.Lock()
+
+    def next_segment(self, worker):
+        """Assigns the next segment to worker, returning None when nothing is left worth taking."""
+        with self.__lock:
+            while len(self.__pending) > 0:
+                segment = self.__pending.popleft()
+                if not segment.is_complete():
+                    segment.owner = worker
+                    return segment
+            return self.__steal(worker)
+
+    def __steal(self, worker):
+        in_flight = [segment for segment in self.segments if segment.owner is not None and segment.owner is not worker
+                     and segment.ranged and segment.remaining() > 0]
+        if len(in_flight) == 0:
+            return None
+
+        # Connections without a measured rate yet are assumed to be average
+        rates = [segment.owner.throughput.rate for segment in in_flight if segment.owner.throughput.rate > 0]
+        default_rate = sum(rates) / len(rates) if len(rates) > 0 else 1.0
+
+        def rate(owner):
+            return owner.throughput.rate or default_rate
+
+        victim = max(in_flight, key=lambda segment: segment.remaining() / rate(segment.owner))
+        remaining = victim.remaining()
+        stolen = int(remaining * rate(worker) / (rate(victim.owner) + rate(worker)))
+        if stolen < self.min_segment_size:
+            return None
+
+        rest = victim.split(remaining - stolen)
+        if rest is None:
+            return None
+        segment = DownloadSegment(rest[0], rest[1])
+        segment.owner = worker
+        self.segments.append(segment)
+        logging.info(f'Split {bytes.bytes_to_readable_unit(rest[1])} from the segment at offset {victim.start} for worker {worker.worker_number}')
+        return segment
+
+    def release(self, segment):
+        with self.__lock:
+            segment.owner = None
+            if not segment.is_complete() and segment.limit >= 0:
+                self.__pending.append(segment)
+
+    def is_complete(self):
+        with self.__lock:
+            return all(segment.is_complete() for segment in self.segments)
+
+    def update_config(self):
+        """Stores the current segments and their high-water marks in the config, to be saved for resuming."""
+        with self.__lock:
+            self.config.segments = [segment.as_range() for segment in self.segments]
+            self.config.segment_progress = [segment.high_water_mark for segment in self.segments]
+
+
+class DownloadWorker(threading.Thread):
+    """
+    Downloads segments handed out by the SegmentScheduler until none are left, writing each at its own offset of the
+    partial file.  downloaded and throughput are only updated by the worker itself, so they are read without a lock.
+    Requests are made with the requester of the job, shared by all of its workers, so that connections are reused
+    across segments and retries.
+    """
+
+    def __init__(self, config: DownloadConfig, worker_number, requester, continue_retrying_on_interruption,
+                 download_progress: DownloadProgress, scheduler: SegmentScheduler, chunk_size=1024 * 512, buffer_size=0,
+                 connection_limiter: ConnectionLimiter = None, bandwidth: TokenBucket = None) -> None:
+        threading.Thread.__init__(self, name=f'DownloadWorker:{str(worker_number)}:[{config.partial_name}]')
+        self.name = f'DownloadWorker:{str(worker_number)}:[{config.partial_name}]'
+        self.config = config
+        self.source_url = config.source_url
+        self.partial_name = config.partial_name
+        self.range_supported = config.supports_range
         self.worker_number = worker_number
         self.abort = False
         self.complete = False
         self.error = False
-        self.tor_proxy = tor_proxy
-        self.internet_proxy = internet_proxy
+        self.requester = requester
         self.download_progress = download_progress
+        self.scheduler = scheduler
         self.continue_retrying_on_interruption = continue_retrying_on_interruption
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.connection_limiter = connection_limiter or ConnectionLimiter()
+        self.bandwidth = bandwidth
+        self.downloaded = 0
+        self.throughput = ThroughputTracker()
 
     def abort_download(self):
         logging.warning(self.name)
         self.abort = True
 
-    def run(self) -> None:
-        try:
-            segment_partial_name = f'{self.partial_name}.{str(self.worker_number)}'
-            if os.path.exists(segment_partial_name):
-                self.download_progress.data_on_commencement(pathlib.Path(segment_partial_name).stat().st_size)
-
-            while not self.complete:
-                try:
-                    resume_headers = {}
-                    segment_size = int(self.segment_range.split(':')[0])
-                    logging.info(f'Segment expected size: {bytes.bytes_to_readable_unit(segment_size)}')
-
-                    if len(self.segment_range.split(':')) > 1:
-                        start_range = self.segment_range.split(':')[1]
-                        if os.path.exists(segment_partial_name):
-                            start_range = int(start_range) + pathlib.Path(segment_partial_name).stat().st_size
-                            logging.info(f'Existing segment file size is: {bytes.bytes_to_readable_unit(pathlib.Path(segment_partial_name).stat().st_size)}')
-
-                            if segment_size == pathlib.Path(segment_partial_name).stat().st_size:
-                                logging.info(f'Segment {segment_partial_name} is already complete')
-                                self.complete = True
+    def __write(self, out_file, buffer, segment):
+        _write_at(out_file, buffer, segment.start + segment.high_water_mark)
+        segment.high_water_mark += len(buffer)
+        self.downloaded += len(buffer)
+
+    def __download(self, segment):
+        resume_headers = {}
+        if segment.ranged:
+            logging.info(f'Requested start_range: {segment.start + segment.high_water_mark}, original start_range: {segment.start}, '
+                         f'end_range: {segment.start + segment.limit - 1}. '
+                         f'Estimated size of segment remaining to download: {bytes.bytes_to_readable_unit(segment.limit - segment.high_water_mark)}')
+            resume_headers = {'Range': f'bytes={segment.start + segment.high_water_mark}-{segment.start + segment.limit - 1}'}
+        elif segment.high_water_mark > 0:
+            logging.warning('Source does not support ranges, restarting the download from the beginning')
+            segment.restart()
+
+        with self.connection_limiter.connection(self.source_url, lambda: self.abort) as allowed:
+            if not allowed:
+                return
+
+            with self.requester.get(self.source_url, stream=True, timeout=120, headers=resume_headers, allow_redirects=True) as resp_stream:
+                if 'Range' in resume_headers and resp_stream.status_code != 206:
+                    raise internet.IncompleteDownload(f'Requested range was not returned, status code: {resp_stream.status_code}')
+
+                self.throughput.start()
+                with open(self.partial_name, 'r+b') as out_file:
+                    # With a buffer_size, chunks are gathered into larger writes.  Anything buffered is written even when interrupted
+                    buffered = []
+                    buffered_size = 0
+                    try:
+                        for chunk in resp_stream.iter_content(chunk_size=self.chunk_size):
+                            self.throughput.record(len(chunk))
+                            if self.bandwidth is not None:
+                                self.bandwidth.consume(len(chunk))
+                            size = segment.reserve(len(chunk))
+                            if size < len(chunk) and not segment.ranged:
+                                self.continue_retrying_on_interruption = False
+                                message = f'Expected segment to be {bytes.bytes_to_readable_unit(segment.limit)}, but downloaded data is greater.  Aborting download.'
+                                logging.error(message)
+                                raise internet.IncompleteDownload(message)
+
+                            if size > 0:
+                                buffered.append(chunk if size == len(chunk) else chunk[:size])
+                                buffered_size += size
+                            if buffered_size >= self.buffer_size:
+                                self.__write(out_file, buffered[0] if len(buffered) == 1 else b''.join(buffered), segment)
+                                buffered = []
+                                buffered_size = 0
+
+                            # The end of the segment has been reached, or split off for another worker
+                            if self.abort or size < len(chunk):
                                 break
+                    finally:
+                        if buffered_size > 0:
+                            self.__write(out_file, b''.join(buffered), segment)
 
-                        end_range = ''
-                        if len(self.segment_range.split(':')) > 2:
-                            end_range = self.segment_range.split(':')[2]
-
-                        size_remaining = (int(self.segment_range.split(':')[1]) + segment_size) - int(start_range)
-                        logging.info(f'Requested start_range: {start_range}, original start_range: {self.segment_range.split(":")[1]}, end_range: {end_range}. '
-                                     f'Estimated size of segment remaining to download: {bytes.bytes_to_readable_unit(size_remaining)}')
-                        resume_headers = {'Range': f'bytes={start_range}-{end_range}'}
-
-                    try:
-                        with internet.new_requester(tor_proxy=self.tor_proxy, internet_proxy=self.internet_proxy) as requester:
-                            with requester.get(self.source_url, stream=True, timeout=120, headers=resume_headers, allow_redirects=True) as resp_stream:
-                                with open(segment_partial_name, 'ab') as out_file:
-                                    for chunk in resp_stream.iter_content(chunk_size=1024 * 512):
-                                        out_file.write(chunk)
-                                        out_file.flush()
-                                        self.download_progress.update_amount_downloaded(len(chunk))
-
-                                        if self.abort:
-                                            break
-                    except Exception as ex:
-                        logging.exception(str(ex))
-                        logging.warning(f'Interrupted while downloading chunks from stream to: {segment_partial_name}')
-                        continue
-
-                    if pathlib.Path(segment_partial_name).stat().st_size < segment_size:
-                        raise internet.IncompleteDownload(f'Destination file is {bytes.bytes_to_readable_unit(pathlib.Path(segment_partial_name).stat().st_size)}, '
-                                                          f'expected {bytes.bytes_to_readable_unit(segment_size)}.')
-                    elif 0 < segment_size < pathlib.Path(segment_partial_name).stat().st_size:
-                        self.continue_retrying_on_interruption = False
-                        message = f'Expected segment to be {bytes.bytes_to_readable_unit(segment_size)}, but downloaded data is greater: ' \
-                                  f'{bytes.bytes_to_readable_unit(pathlib.Path(segment_partial_name).stat().st_size)}.  Aborting download.'
-                        logging.error(message)
-                        raise internet.IncompleteDownload(message)
-                    else:
-                        self.complete = True
-                        logging.info(f'Completed downloading of segment: {segment_partial_name}. '
-                                     f'Size: {bytes.bytes_to_readable_unit(pathlib.Path(segment_partial_name).stat().st_size)}')
+    def __download_segment(self, segment):
+        while not self.abort:
+            try:
+                if segment.is_complete():
+                    return
 
+                try:
+                    self.__download(segment)
+                except internet.IncompleteDownload:
+                    raise
                 except Exception as ex:
                     logging.exception(str(ex))
-                    if not self.continue_retrying_on_interruption or not self.range_supported:
-                        self.complete = True
-                        self.error = True
-                        raise internet.IncompleteDownload(str(ex))
-                    else:
-                        logging.warning('Attempting to resume download from last point')
-                        self.download_progress.increment_restarts_after_interruption()
+                    logging.warning(f'Interrupted while downloading chunks from stream to segment at offset {segment.start} of: {self.partial_name}')
+                    continue
+
+                if self.abort:
+                    return
+                elif segment.high_water_mark < segment.limit:
+                    raise internet.IncompleteDownload(f'Segment is {bytes.bytes_to_readable_unit(segment.high_water_mark)}, '
+                                                      f'expected {bytes.bytes_to_readable_unit(segment.limit)}.')
+                else:
+                    logging.info(f'Completed downloading of segment at offset {segment.start} of: {self.partial_name}. '
+                                 f'Size: {bytes.bytes_to_readable_unit(segment.high_water_mark)}')
+                    if segment.limit < 0:
+                        # Length unknown, the end of the stream is the end of the download
+                        segment.limit = segment.high_water_mark
+                    return
+
+            except Exception as ex:
+                logging.exception(str(ex))
+                if not self.continue_retrying_on_interruption or not self.range_supported:
+                    self.error = True
+                    raise internet.IncompleteDownload(str(ex))
+                else:
+                    logging.warning('Attempting to resume download from last point')
+                    self.download_progress.increment_restarts_after_interruption()
+
+    def run(self) -> None:
+        try:
+            while not self.abort:
+                segment = self.scheduler.next_segment(self)
+                if segment is None:
+                    break
+                try:
+                    self.__download_segment(segment)
+                finally:
+                    # Returned to the queue if unfinished, rather than left with a worker that failed or was aborted
+                    self.scheduler.release(segment)
+            self.complete = not self.abort
         except Exception as ex:
             logging.exception(str(ex))
 
 
 class DownloadJob(threading.Thread):
 
-    def __init__(self, config: DownloadConfig, tor_proxy, internet_proxy, continue_retrying_on_interruption) -> None:
+    def __init__(self, config: DownloadConfig, tor_proxy, internet_proxy, continue_retrying_on_interruption, chunk_size=1024 * 512,
+                 buffer_size=0, checkpoint_interval=5, fsync_on_checkpoint=False, min_segment_size=1024 * 1024,
+                 connection_limiter: ConnectionLimiter = None, bandwidth: TokenBucket = None, on_complete=None,
+                 requester=None) -> None:
+        """
+        The workers share requester, or a new one with a connection pool for each of them, which the job closes once
+        the download is finished.
+        """
         threading.Thread.__init__(self, name=f'DownloadJob:{config.full_destination_name}')
         self.config = config
         self.errors = False
@@ -256,54 +623,73 @@ class DownloadJob(threading.Thread):
         self.tor_proxy = tor_proxy
         self.internet_proxy = internet_proxy
         self.continue_retrying_on_interruption = continue_retrying_on_interruption
-        self.download_progress = DownloadProgress(config)
-        self.__lock = threading.Lock()
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.download_progress = DownloadProgress(config, checkpoint_interval=checkpoint_interval, fsync_on_checkpoint=fsync_on_checkpoint)
+        self.scheduler = SegmentScheduler(config, min_segment_size=min_segment_size)
+        self.connection_limiter = connection_limiter
+        self.bandwidth = bandwidth
+        self.on_complete = on_complete
+        self.requester = requester
+        self.__done = threading.Event()
         self.__workers = []
 
-    def __merge_completed(self):
-        with open(self.config.partial_name, 'wb') as fout:
-            for n in range(self.config.worker_count):
-                with open(f'{self.config.partial_name}.{str(n)}', 'rb') as fin:
-                    fin.seek(0)
-                    while True:
-                        read_bytes = fin.read(1024 * 1024 * 10)
-                        if read_bytes:
-                            fout.write(read_bytes)
-                        else:
-                            break
-                os.remove(f'{self.config.partial_name}.{str(n)}')
-        os.rename(self.config.partial_name, self.config.full_destination_name)
+    def __complete(self):
+        if self.config.file_length < 0:
+            # Length was unknown, so nothing was preallocated beyond what was written
+            os.truncate(self.config.partial_name, self.config.segment_progress[0])
+        os.replace(self.config.partial_name, self.config.full_destination_name)
+        os.remove(self.config.state_name)
         logging.info(f'Completed download of {self.config.full_destination_name} from {self.config.source_url}. '
                      f'Total size: {bytes.bytes_to_readable_unit(pathlib.Path(self.config.full_destination_name).stat().st_size)}')
 
     def run(self) -> None:
         logging.info(f'Staring download of {self.config.source_url}. Size is: {bytes.bytes_to_readable_unit(self.config.file_length)}')
-        self.__lock.acquire()
-        for n in range(self.config.worker_count):
-            logging.info(f'Starting download worker: {str(n)}.')
-            self.__workers.append(DownloadWorker(source_url=self.config.source_url, partial_name=self.config.partial_name, segment_range=self.config.segments[n], worker_number=n,
-                                                 tor_proxy=self.tor_proxy, internet_proxy=self.internet_proxy,
-                                                 continue_retrying_on_interruption=self.continue_retrying_on_interruption,
-                                                 range_supported=self.config.supports_range, download_progress=self.download_progress))
-
-            self.__workers[n].start()
-
-        for worker in self.__workers:
-            worker.join()
-            self.errors = self.errors or worker.error
-
-        self.complete = True
-        if not self.errors:
-            self.__merge_completed()
-        else:
-            logging.error(f'Unable to complete download of {self.config.source_url} as a worker encountered an error')
-        self.__lock.release()
-
-    def wait_to_complete(self):
+        try:
+            _preallocate(self.config.partial_name, self.config.file_length)
+            self.download_progress.data_on_commencement(sum(self.config.segment_progress))
+            if self.requester is None:
+                self.requester = internet.new_requester(tor_proxy=self.tor_proxy, internet_proxy=self.internet_proxy,
+                                                        pool_maxsize=self.config.worker_count)
+            for n in range(self.config.worker_count):
+                logging.info(f'Creating download worker: {str(n)}.')
+                self.__workers.append(DownloadWorker(config=self.config, worker_number=n, requester=self.requester,
+                                                     continue_retrying_on_interruption=self.continue_retrying_on_interruption,
+                                                     download_progress=self.download_progress, scheduler=self.scheduler,
+                                                     chunk_size=self.chunk_size, buffer_size=self.buffer_size,
+                                                     connection_limiter=self.connection_limiter, bandwidth=self.bandwidth))
+
+            self.download_progress.start_sampler(self.__workers, self.scheduler)
+            for worker in self.__workers:
+                worker.start()
+
+            for worker in self.__workers:
+                worker.join()
+                self.errors = self.errors or worker.error or not worker.complete
+
+            self.download_progress.stop_sampler()
+            self.errors = self.errors or not self.scheduler.is_complete()
+            if not self.errors:
+                self.__complete()
+            else:
+                logging.error(f'Unable to complete download of {self.config.source_url} as a worker encountered an error or was aborted')
+        except Exception as ex:
+            logging.exception(f'Download of {self.config.source_url} failed: {str(ex)}')
+            self.errors = True
+        finally:
+            if self.requester is not None:
+                self.requester.close()
+            self.complete = True
+            self.__done.set()
+            if self.on_complete is not None:
+                self.on_complete(self)
+
+    def wait_to_complete(self, timeout=None):
+        """Waits for the download to finish, returning False if timeout seconds passed first."""
         logging.info("Waiting until complete...")
-        self.__lock.acquire()
+        finished = self.__done.wait(timeout)
         logging.info("Wait to complete, reached")
-        self.__lock.release()
+        return finished
 
     def abort(self):
         logging.info('Aborting download workers...')
@@ -316,78 +702,232 @@ class DownloadJob(threading.Thread):
 
 class DownloadManager:
 
-    def __init__(self, tor_proxy=None, internet_proxy=None, continue_retrying_on_interruption=True, attempt_resume_partial=True) -> None:
+    def __init__(self, tor_proxy=None, internet_proxy=None, continue_retrying_on_interruption=True, attempt_resume_partial=True,
+                 chunk_size=1024 * 512, buffer_size=0, checkpoint_interval=5, fsync_on_checkpoint=False, segments_per_worker=4,
+                 min_segment_size=1024 * 1024, max_connections=None, max_connections_per_host=None, max_bandwidth=None,
+                 max_concurrent_downloads=4) -> None:
+        """
+        Every download of the manager shares max_connections open connections, max_connections_per_host to any one
+        host, and max_bandwidth bytes per second.  Downloads queued with submit or download_many run up to
+        max_concurrent_downloads at a time.
+
+        Downloads that support ranges are split into segments_per_worker segments per worker, of at least
+        min_segment_size bytes, which the workers take in turn.  Idle workers split the remaining segments with the
+        slowest ones, see SegmentScheduler.
+
+        chunk_size is the size of the reads from each response stream, which are written to disk as they arrive or, with
+        a buffer_size, gathered into writes of at least buffer_size bytes.  The progress of a download is saved every
+        checkpoint_interval seconds so that it resumes after the process is interrupted, fsync_on_checkpoint makes the
+        saved progress durable across a crash of the system too, at the cost of waiting for the disk.
+        """
         self.tor_proxy = tor_proxy
         self.internet_proxy = internet_proxy
         self.continue_retrying_on_interruption = continue_retrying_on_interruption
         self.attempt_resume_partial = attempt_resume_partial
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.checkpoint_interval = checkpoint_interval
+        self.fsync_on_checkpoint = fsync_on_checkpoint
+        self.segments_per_worker = segments_per_worker
+        self.min_segment_size = min_segment_size
+        self.max_connections = max_connections
+        self.max_connections_per_host = max_connections_per_host
+        self.max_concurrent_downloads = max_concurrent_downloads
+        self.connection_limiter = ConnectionLimiter(max_connections=max_connections, max_connections_per_host=max_connections_per_host)
+        self.bandwidth = TokenBucket(max_bandwidth) if max_bandwidth else None
         self.start_time = 0
+        self.__executor = None
+        self.__futures = set()
+        self.__lock = threading.Lock()
+        self.__active_destinations = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self, wait=True):
+        """Stops accepting downloads, by default waiting for those queued to finish, otherwise cancelling them."""
+        with self.__lock:
+            executor = self.__executor
+            self.__executor = None
+            futures = list(self.__futures)
+        if executor is None:
+            return
+        if not wait:
+            # Downloads already started carry on, only those still queued are cancelled
+            for future in futures:
+                future.cancel()
+        # Shut down outside the lock, which the queued downloads take when they start
+        executor.shutdown(wait=wait)
 
     @staticmethod
-    def __define_segments(file_length, worker_count):
+    def __define_segments(file_length, segment_count):
         segments = []
-        segment_size = round(file_length / worker_count)
-        while len(segments) < worker_count - 1:
-            start_offset = len(segments) * segment_size
-            end_offset = ((len(segments) + 1) * segment_size) - 1
-            segments.append(f'{str(segment_size)}:{str(start_offset)}:{str(end_offset)}')
-
-        start_offset = len(segments) * segment_size
-        segments.append(f'{str(file_length - start_offset)}:{str(start_offset)}:')
+        segment_size = file_length // segment_count
+        for n in range(segment_count):
+            start_offset = n * segment_size
+            size = segment_size if n < segment_count - 1 else file_length - start_offset
+            segments.append(f'{str(size)}:{str(start_offset)}:{str(start_offset + size - 1)}')
         return segments
 
-    def __determine_config(self, url, dest_dir, override_worker_count) -> DownloadConfig:
-        with internet.new_requester(tor_proxy=self.tor_proxy, internet_proxy=self.internet_proxy) as requester:
-            source_name, file_length = internet.source_details(requester_session=requester, source_url=url)
-            supports_range = internet.check_supports_range(requester_session=requester, source_url=url)
-            worker_count = 1 if file_length == -1 or not supports_range else (multiprocessing.cpu_count() if override_worker_count is None else override_worker_count)
-            segments = self.__define_segments(file_length=file_length, worker_count=worker_count) if worker_count > 1 else [f'{file_length}']
+    def __max_worker_count(self, override_worker_count):
+        if override_worker_count is not None:
+            return override_worker_count
+        # More workers than connections allowed would only wait for one another
+        return min([multiprocessing.cpu_count()] + [limit for limit in [self.max_connections, self.max_connections_per_host] if limit])
+
+    def __determine_config(self, requester, url, dest_dir, override_worker_count) -> DownloadConfig:
+        source_name, file_length = internet.source_details(requester_session=requester, source_url=url)
+        supports_range = internet.check_supports_range(requester_session=requester, source_url=url)
+        worker_count = 1 if file_length == -1 or not supports_range else self.__max_worker_count(override_worker_count)
+        if file_length > 0 and supports_range:
+            segment_count = max(1, min(worker_count * self.segments_per_worker, file_length // self.min_segment_size))
+            segments = self.__define_segments(file_length=file_length, segment_count=segment_count)
+        else:
+            segments = [f'{file_length}']
+
+        full_destination_name = f'{dest_dir}/{source_name}'
+        partial_name = f'{full_destination_name}.partial'
 
-            full_destination_name = f'{dest_dir}/{source_name}'
-            partial_name = f'{full_destination_name}.partial'
+        return DownloadConfig(source_url=url, worker_count=worker_count, source_name=source_name, file_length=file_length,
+                              supports_range=supports_range, segments=segments, dest_dir=dest_dir, full_destination_name=full_destination_name, partial_name=partial_name)
 
-            return DownloadConfig(source_url=url, worker_count=worker_count, source_name=source_name, file_length=file_length,
-                                  supports_range=supports_range, segments=segments, dest_dir=dest_dir, full_destination_name=full_destination_name, partial_name=partial_name)
+    @staticmethod
+    def __load_segmented_partial(partial_name):
+        """Loads the config of a partial download made by earlier versions, which kept it in the partial file itself."""
+        try:
+            return DownloadConfig.load_from(partial_name)
+        except ValueError:
+            logging.warning(f'Partial download {partial_name} has no download state.  Starting again.')
+            os.remove(partial_name)
+            return None
+
+    @staticmethod
+    def __move_segments(config):
+        """Moves the partial_name.N segment files of earlier versions into a single preallocated partial file."""
+        logging.info(f'Moving the segments of {config.partial_name} into a single partial file')
+        os.remove(config.partial_name)
+        _preallocate(config.partial_name, config.file_length)
+        config.segment_progress = [0] * len(config.segments)
+        with open(config.partial_name, 'r+b') as out_file:
+            for n in range(len(config.segments)):
+                segment_name = f'{config.partial_name}.{str(n)}'
+                if not os.path.exists(segment_name):
+                    continue
+                segment_size, start_offset, _ = config.segment(n)
+                with open(segment_name, 'rb') as segment_file:
+                    while True:
+                        read_size = 1024 * 1024 * 10
+                        if segment_size >= 0:
+                            read_size = min(read_size, segment_size - config.segment_progress[n])
+                        read_bytes = segment_file.read(read_size)
+                        if not read_bytes:
+                            break
+                        _write_at(out_file, read_bytes, start_offset + config.segment_progress[n])
+                        config.segment_progress[n] += len(read_bytes)
+                os.remove(segment_name)
 
     def download(self, url, dest_dir, async_download=False, override_worker_count=None) -> DownloadJob:
         logging.info(f'Downloading {url} to {dest_dir}')
         os.makedirs(dest_dir, exist_ok=True)
 
-        config = self.__determine_config(url=url, dest_dir=dest_dir, override_worker_count=override_worker_count)
-
-        if os.path.exists(config.full_destination_name):
-            raise internet.DownloadException(f'Destination file {config.full_destination_name} already exists')
-
-        partial_exists = os.path.exists(config.partial_name)
-
-        if partial_exists:
-            config = DownloadConfig.load_from(config.partial_name)
+        # One pool of connections for the probes and then all the workers of the job, which closes it when finished
+        requester = internet.new_requester(tor_proxy=self.tor_proxy, internet_proxy=self.internet_proxy,
+                                           pool_maxsize=self.__max_worker_count(override_worker_count))
+        try:
+            config = self.__determine_config(requester=requester, url=url, dest_dir=dest_dir, override_worker_count=override_worker_count)
+
+            if os.path.exists(config.full_destination_name):
+                raise internet.DownloadException(f'Destination file {config.full_destination_name} already exists')
+            with self.__lock:
+                if config.full_destination_name in self.__active_destinations:
+                    raise internet.DownloadException(f'Destination file {config.full_destination_name} is already being downloaded')
+                self.__active_destinations.add(config.full_destination_name)
+        except Exception:
+            requester.close()
+            raise
 
-        if partial_exists and (not config.supports_range or not self.attempt_resume_partial):
-            if not config.supports_range:
+        try:
+            return self.__start(url, config, async_download, requester)
+        except Exception:
+            requester.close()
+            self.__release_destination(config.full_destination_name)
+            raise
+
+    def __release_destination(self, full_destination_name):
+        with self.__lock:
+            self.__active_destinations.discard(full_destination_name)
+
+    def __start(self, url, config, async_download, requester) -> DownloadJob:
+        prior_config = None
+        segmented_partial = False
+        if os.path.exists(config.state_name):
+            prior_config = DownloadConfig.load_from(config.state_name)
+            if not os.path.exists(prior_config.partial_name):
+                prior_config.segment_progress = [0] * len(prior_config.segments)
+        elif os.path.exists(config.partial_name):
+            prior_config = self.__load_segmented_partial(config.partial_name)
+            segmented_partial = prior_config is not None
+
+        if prior_config is not None and (not prior_config.supports_range or not self.attempt_resume_partial):
+            if not prior_config.supports_range:
                 logging.warning(f'Source server for URL {url} does not support ranges.  Deleting partial download and starting again.')
 
             logging.warning(f'Removing prior partial download: {config.partial_name}.')
-            os.remove(config.partial_name)
-
-            for n in range(config.worker_count):
-                if os.path.exists(f'{config.partial_name}.{str(n)}'):
-                    logging.warning(f'Deleting partial segment: {config.partial_name}.{str(n)}')
-                    os.remove(f'{config.partial_name}.{str(n)}')
+            for file_name in [config.partial_name, config.state_name] + [f'{config.partial_name}.{str(n)}' for n in range(prior_config.worker_count)]:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
 
-        elif partial_exists:
+        elif prior_config is not None:
             logging.info(f'Resuming a partially completed download of {url}')
+            config = prior_config
+            if segmented_partial:
+                self.__move_segments(config)
 
-        config.write_to(config.partial_name)
+        config.write_to(config.state_name)
 
         download_job = DownloadJob(config=config, tor_proxy=self.tor_proxy, internet_proxy=self.internet_proxy,
-                                   continue_retrying_on_interruption=self.continue_retrying_on_interruption)
+                                   continue_retrying_on_interruption=self.continue_retrying_on_interruption, chunk_size=self.chunk_size,
+                                   buffer_size=self.buffer_size, checkpoint_interval=self.checkpoint_interval,
+                                   fsync_on_checkpoint=self.fsync_on_checkpoint, min_segment_size=self.min_segment_size,
+                                   connection_limiter=self.connection_limiter, bandwidth=self.bandwidth,
+                                   on_complete=lambda job: self.__release_destination(job.config.full_destination_name),
+                                   requester=requester)
 
         if async_download:
             download_job.start()
-            # Give it a moment to start before passing the job back
-            time.sleep(5)
         else:
             download_job.run()
 
         return download_job
+
+    def __download_job(self, url, dest_dir, override_worker_count):
+        download_job = self.download(url, dest_dir, override_worker_count=override_worker_count)
+        if download_job.errors:
+            raise internet.IncompleteDownload(f'Download of {url} to {download_job.downloaded_file()} did not complete')
+        return download_job
+
+    def submit(self, url, dest_dir, override_worker_count=None, callback=None) -> Future:
+        """
+        Queues the download of url to dest_dir, returning a Future of its DownloadJob, which raises IncompleteDownload
+        or the error of the download if it failed.  callback, if given, is called with the Future once it is done.
+        """
+        with self.__lock:
+            if self.__executor is None:
+                self.__executor = ThreadPoolExecutor(max_workers=self.max_concurrent_downloads, thread_name_prefix='DownloadManager')
+            future = self.__executor.submit(self.__download_job, url, dest_dir, override_worker_count)
+            self.__futures.add(future)
+        future.add_done_callback(self.__discard_future)
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def __discard_future(self, future):
+        with self.__lock:
+            self.__futures.discard(future)
+
+    def download_many(self, urls, dest_dir, override_worker_count=None, callback=None):
+        """Queues the download of each of urls to dest_dir, returning their Futures in the same order."""
+        return [self.submit(url, dest_dir, override_worker_count=override_worker_count, callback=callback) for url in urls]
@@ -1,4 +1,5 @@
 import logging
+import threading
 
 from requests import Response
 from requests.sessions import Session
@@ -8,16 +9,37 @@ from digital_thought_commons import internet
 
 
 class RequesterSession(Session):
+    """
+    Sends requests for .onion hosts through the Tor proxy and all others through the internet proxy, each with its own
+    pooled session.  The sessions are only created when first needed, and keep up to pool_maxsize connections to each
+    host open for reuse, so one RequesterSession can be shared by threads making requests to the same hosts.
+    """
 
-    def __init__(self, tor_proxy=None, internet_proxy=None) -> None:
+    def __init__(self, tor_proxy=None, internet_proxy=None, pool_maxsize=10) -> None:
         super().__init__()
 
         if tor_proxy is None:
             tor_proxy = {"http": 'socks5h://127.0.0.1:9150'}
         self.tor_proxy = tor_proxy
         self.internet_proxy = internet_proxy
-        self.tor_requester = internet.retry_request_session(proxy=self.tor_proxy)
-        self.internet_requester = internet.retry_request_session(proxy=self.internet_proxy)
+        self.pool_maxsize = pool_maxsize
+        self.__tor_requester = None
+        self.__internet_requester = None
+        self.__lock = threading.Lock()
+
+    @property
+    def tor_requester(self) -> Session:
+        with self.__lock:
+            if self.__tor_requester is None:
+                self.__tor_requester = internet.retry_request_session(proxy=self.tor_proxy, pool_maxsize=self.pool_maxsize)
+            return self.__tor_requester
+
+    @property
+    def internet_requester(self) -> Session:
+        with self.__lock:
+            if self.__internet_requester is None:
+                self.__internet_requester = internet.retry_request_session(proxy=self.internet_proxy, pool_maxsize=self.pool_maxsize)
+            return self.__internet_requester
 
     def __enter__(self):
         return self
@@ -57,5 +79,9 @@ class RequesterSession(Session):
         return self.requester(url).delete(url, **kwargs)
 
     def close(self) -> None:
-        self.tor_requester.close()
-        self.internet_requester.close()
+        with self.__lock:
+            for session in [self.__tor_requester, self.__internet_requester]:
+                if session is not None:
+                    session.close()
+            self.__tor_requester = None
+            self.__internet_requester = None
@@ -14,7 +14,7 @@ class ElasticsearchLogHandler(logging.Handler):
         self.port = port
         self.api_key = api_key
 
-        self.elastic = elasticsearch.ElasticsearchConnection(server=self.server, port=self.port, api_key=self.api_key)
+        self.elastic = elasticsearch.get_connection(server=self.server, port=self.port, api_key=self.api_key)
         self.__initialise_index()
         self.bulk_indexer = self.elastic.bulk_processor(batch_size=2)
 
@@ -29,6 +29,7 @@ class ElasticsearchLogHandler(logging.Handler):
     def close(self) -> None:
         super().close()
         self.bulk_indexer.close()
+        self.elastic.close()
 
     def emit(self, record: LogRecord) -> None:
         self.bulk_indexer.index(index='{}-event-logs'.format(self.prefix), entry=self.__build_record(record))
@@ -0,0 +1,17 @@
+class CachedLookup:
+    """
+    Base of the lookups that answer through an APICache held as self.cache.  Closing the lookup, or leaving a "with"
+    block, writes the entries still queued by the cache.
+    """
+
+    def cache_stats(self):
+        return self.cache.stats()
+
+    def close(self):
+        self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -2,9 +2,10 @@ import logging
 
 from digital_thought_commons import internet
 from digital_thought_commons.cache import APICache
+from digital_thought_commons.restful_lookups import CachedLookup
 
 
-class APICentral:
+class APICentral(CachedLookup):
 
     def __init__(self, base_url, api_key):
         self.api_key = api_key
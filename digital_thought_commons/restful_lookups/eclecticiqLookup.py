@@ -2,6 +2,7 @@ import logging
 
 from digital_thought_commons import internet
 from digital_thought_commons.cache import APICache
+from digital_thought_commons.restful_lookups import CachedLookup
 
 
 class EclecticIQDomain:
@@ -61,7 +62,7 @@ class EclecticIQIPAddress:
 #         return self.cache.lookup(self.lookup_method, query_payload=query_payload)
 
 
-class EclecticIQ:
+class EclecticIQ(CachedLookup):
     
     api_url = '"https://{}.eiq-platform.com/private/search-all/"'
 
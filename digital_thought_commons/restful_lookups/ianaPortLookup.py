@@ -6,9 +6,10 @@ from datetime import datetime
 
 from digital_thought_commons import date_utils, internet
 from digital_thought_commons.cache import APICache
+from digital_thought_commons.restful_lookups import CachedLookup
 
 
-class IanaPortServiceNames:
+class IanaPortServiceNames(CachedLookup):
     api_url = 'https://www.iana.org/assignments/service-names-port-numbers/service-names-port-numbers.csv'
     refresh_period = 86400000  # 24 hours
 
@@ -139,4 +140,4 @@ class IanaPortServiceNames:
         return response
 
     def lookup_unauthorised_use(self):
-        return self.cache.lookup(self.__lookup_unauthorised_use)
\ No newline at end of file
+        return self.cache.lookup(self.__lookup_unauthorised_use)
@@ -4,9 +4,10 @@ import logging
 
 from digital_thought_commons import internet
 from digital_thought_commons.cache import APICache
+from digital_thought_commons.restful_lookups import CachedLookup
 
 
-class IPAbuseDB:
+class IPAbuseDB(CachedLookup):
     categories = {'1': 'DNS Compromise', '3': 'Fraud Orders', '4': 'DDoS Attack', '5': 'FTP Brute-Force', '6': 'Ping of Death',
                   '7': 'Phishing', '8': 'Fraud VoIP', '9': 'Open Proxy', '10': 'Web Spam', '11': 'Email Spam',
                   '12': 'Blog Spam', '13': 'VPN IP', '14': 'Port Scan', '15': 'Hacking', '16': 'SQL Injection',
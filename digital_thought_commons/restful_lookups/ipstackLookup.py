@@ -2,9 +2,10 @@ import logging
 
 from digital_thought_commons import internet
 from digital_thought_commons.cache import APICache
+from digital_thought_commons.restful_lookups import CachedLookup
 
 
-class IPStack:
+class IPStack(CachedLookup):
     api_url = 'http://api.ipstack.com/{}?access_key={}&hostname=1&security=1'
 
     def __init__(self, api_key):
@@ -11,9 +11,10 @@ from shutil import copyfile
 
 from digital_thought_commons import date_utils, internet
 from digital_thought_commons.cache import APICache
+from digital_thought_commons.restful_lookups import CachedLookup
 
 
-class MaxMind:
+class MaxMind(CachedLookup):
     api_url = 'https://download.maxmind.com/app/geoip_download?'
     refresh_period = 86400000  # 24 hours
 
@@ -151,4 +152,4 @@ class MaxMind:
         return None
 
     def lookup_ip(self, ip_address):
-        return self.cache.lookup(self.__lookup_ip, ip_address=ip_address)
\ No newline at end of file
+        return self.cache.lookup(self.__lookup_ip, ip_address=ip_address)
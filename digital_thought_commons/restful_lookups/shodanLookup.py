@@ -2,9 +2,10 @@ import logging
 
 from digital_thought_commons import internet
 from digital_thought_commons.cache import APICache
+from digital_thought_commons.restful_lookups import CachedLookup
 
 
-class Shodan:
+class Shodan(CachedLookup):
     api_url = 'https://api.shodan.io/{}'
 
     def __init__(self, api_key):
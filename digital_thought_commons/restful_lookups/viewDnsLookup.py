@@ -2,9 +2,10 @@ import logging
 
 from digital_thought_commons import internet
 from digital_thought_commons.cache import APICache
+from digital_thought_commons.restful_lookups import CachedLookup
 
 
-class ViewDNS:
+class ViewDNS(CachedLookup):
     api_url = 'https://api.viewdns.info/{}'
 
     def __init__(self, api_key):
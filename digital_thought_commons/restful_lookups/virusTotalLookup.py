@@ -2,6 +2,7 @@ import logging
 
 from digital_thought_commons import internet
 from digital_thought_commons.cache import APICache
+from digital_thought_commons.restful_lookups import CachedLookup
 
 
 class VirusTotalDomain:
@@ -94,7 +95,7 @@ class VirusTotalIPAddress:
 #         return self.cache.lookup(self.lookup_method, query_url=query_url)
 
 
-class VirusTotal:
+class VirusTotal(CachedLookup):
     api_url = 'https://www.virustotal.com/api/v3/{}'
 
     def __init__(self, api_key):
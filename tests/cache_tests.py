@@ -0,0 +1,653 @@
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import yaml
+
+from digital_thought_commons.cache import APICache
+from digital_thought_commons.cache.backends import ElasticCacheBackend, FileCacheBackend
+from digital_thought_commons.cache import backends as backends_module, codecs, keys, metrics
+from digital_thought_commons.cache.codecs import Codec
+from digital_thought_commons.cache.keys import SignatureGenerator
+from digital_thought_commons.cache.memory_cache import MemoryCache
+from digital_thought_commons.cache.policy import CachePolicy
+
+
+def _file_cache_config(directory, **overrides):
+    config = {'cache_type': 'file', 'memory_cache_size': 60, 'default_max_age': 345600000,
+              'cache_error_responses': False, 'file': {'cache_location': directory}}
+    config.update(overrides)
+    config_file = os.path.join(directory, 'cache_config.yaml')
+    with open(config_file, 'w') as out_file:
+        yaml.safe_dump(config, out_file)
+    return config_file
+
+
+class TestMemoryCache(unittest.TestCase):
+
+    def test_hit_keeps_entry_resident(self):
+        cache = MemoryCache(size=2, name='test')
+        cache.put('a', 'value-a')
+        self.assertEqual(cache.lookup('a'), 'value-a')
+        self.assertEqual(cache.lookup('a'), 'value-a')
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = MemoryCache(size=2, name='test')
+        cache.put('a', 'value-a')
+        cache.put('b', 'value-b')
+        cache.lookup('a')
+        cache.put('c', 'value-c')
+        self.assertIsNone(cache.lookup('b'))
+        self.assertEqual(cache.lookup('a'), 'value-a')
+        self.assertEqual(cache.lookup('c'), 'value-c')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_byte_bound(self):
+        cache = MemoryCache(size=100, name='test', max_bytes=10)
+        cache.put('a', '12345')
+        cache.put('b', '12345')
+        cache.put('c', '12345')
+        self.assertEqual(cache.keys(), ['b', 'c'])
+        self.assertEqual(cache.stats()['bytes'], 10)
+        cache.put('d', '12345678901')
+        self.assertNotIn('d', cache)
+
+    def test_entries_expire(self):
+        cache = MemoryCache(size=10, name='test', max_age=50)
+        cache.put('a', 'value-a')
+        cache.put('b', 'value-b', timestamp=int(round(time.time() * 1000)) - 100)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.lookup('a'), 'value-a')
+        time.sleep(0.1)
+        self.assertIsNone(cache.lookup('a'))
+        self.assertEqual(cache.stats()['expirations'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+
+class TestFileCacheBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = {'file': {'cache_location': self.directory.name, 'write_batch_size': 10}}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _row_count(self, backend):
+        return backend.connection.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def test_keeps_newest_entry_per_signature(self):
+        backend = FileCacheBackend('test', self.config, max_age=1000)
+        backend.store('a', 100, 'first', 'user')
+        backend.store('a', 300, 'third', 'user')
+        backend.store('a', 200, 'second', 'user')
+        self.assertEqual(backend.lookup('a', 0), ('third', 300))
+        backend.flush()
+        backend.store_many([('a', 250, 'older', 'user'), ('b', 100, 'other', 'user')])
+        self.assertEqual(backend.lookup('a', 0), ('third', 300))
+        self.assertEqual(self._row_count(backend), 2)
+        backend.close()
+
+    def test_upgrades_legacy_cache_file(self):
+        legacy = sqlite3.connect(os.path.join(self.directory.name, 'test.cache'))
+        legacy.execute('CREATE TABLE cache (id integer PRIMARY KEY, signature_hash text, lookup_timestamp integer, '
+                       'encoded_response text, username text, cache_name text)')
+        legacy.executemany('INSERT INTO cache(signature_hash, lookup_timestamp, encoded_response, username, cache_name) '
+                           'VALUES(?,?,?,?,?)', [('a', 100, 'first', 'user', 'test'), ('a', 200, 'second', 'user', 'test'),
+                                                 ('b', 100, 'other', 'user', 'test')])
+        legacy.commit()
+        legacy.close()
+
+        backend = FileCacheBackend('test', self.config, max_age=1000)
+        self.assertEqual(self._row_count(backend), 2)
+        self.assertEqual(backend.lookup('a', 0), ('second', 200))
+        self.assertEqual(backend.connection.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+        backend.close()
+
+    def test_group_commit(self):
+        backend = FileCacheBackend('test', self.config, max_age=1000)
+        for i in range(9):
+            backend.store(str(i), 100, 'value', 'user')
+        self.assertEqual(self._row_count(backend), 0)
+        self.assertEqual(backend.lookup('0', 0), ('value', 100))
+        backend.store('9', 100, 'value', 'user')
+        self.assertEqual(self._row_count(backend), 10)
+        backend.close()
+
+    def test_queued_entries_are_committed_at_exit(self):
+        script = ('from digital_thought_commons.cache.backends import FileCacheBackend\n'
+                  'backend = FileCacheBackend("test", {"file": {"cache_location": %r}}, max_age=1000)\n'
+                  'for i in range(20):\n'
+                  '    backend.store(str(i), 100, "value", "user")\n') % self.directory.name
+        subprocess.run([sys.executable, '-c', script], check=True, timeout=60,
+                       cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+        backend = FileCacheBackend('test', self.config, max_age=1000)
+        self.assertEqual(self._row_count(backend), 20)
+        backend.close()
+        backend.close()
+
+    def test_compaction_removes_expired_entries(self):
+        backend = FileCacheBackend('test', self.config, max_age=60000)
+        now = int(round(time.time() * 1000))
+        backend.store_many([('old', now - 120000, 'value', 'user'), ('new', now, 'value', 'user')])
+        self.assertEqual(backend.compact(), 1)
+        self.assertEqual(backend.lookup('old', 0), (None, 0))
+        self.assertEqual(backend.lookup('new', 0), ('value', now))
+        backend.close()
+
+
+class _FakeBulkProcessor:
+
+    def __init__(self, documents, rejected, failure_callback):
+        self.documents = documents
+        self.rejected = rejected
+        self.failure_callback = failure_callback
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def index(self, index, entry, _id=None):
+        if _id in self.rejected:
+            self.failure_callback({'action': {'index': {'_index': index, '_id': _id}}, 'document': entry,
+                                   'status': 400, 'error': {'type': 'mapper_parsing_exception'}})
+        else:
+            self.documents[_id] = entry
+
+
+class _FakeDocumentSession:
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    def delete(self, url):
+        found = self.documents.pop(url.rsplit('/', 1)[1], None) is not None
+        return mock.Mock(status_code=200 if found else 404, text='')
+
+
+class _FakeElasticsearchConnection:
+
+    def __init__(self, server, port, api_key):
+        self.documents = {}
+        self.rejected = set()
+        self.bulk_requests = 0
+        self.searches = 0
+        self.root_url = 'https://{}:{}/'.format(server, port)
+        self.request_session = _FakeDocumentSession(self.documents)
+
+    def bulk_processor(self, batch_size=1000, batch_max_size_bytes=5000000, failure_callback=None):
+        self.bulk_requests += 1
+        return _FakeBulkProcessor(self.documents, self.rejected, failure_callback)
+
+    def search(self, index, query):
+        self.searches += 1
+        signature_hashes = query['query']['bool']['filter'][0]['terms']['signature_hash']
+        hits = [{'_source': document} for document in self.documents.values()
+                if document['signature_hash'] in signature_hashes]
+        return {'hits': {'total': {'value': len(hits)}, 'hits': hits[:query['size']]}}
+
+    def close(self):
+        pass
+
+
+@mock.patch('digital_thought_commons.cache.backends.elasticsearch.get_connection', _FakeElasticsearchConnection)
+class TestElasticCacheBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config = {'elastic': {'server': 'localhost', 'port': 9200, 'api_key': 'key', 'write_batch_size': 3,
+                                   'write_flush_interval': 60}}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_writes_are_batched_behind_lookups(self):
+        backend = ElasticCacheBackend('test', self.config, max_age=1000)
+        backend.store('a', 100, b'payload-a', 'user')
+        backend.store('b', 100, b'payload-b', 'user')
+        self.assertEqual(backend.lookup('a', 0), (b'payload-a', 100))
+        self.assertEqual(backend.elastic_connection.bulk_requests, 0)
+        self.assertEqual(backend.elastic_connection.searches, 0)
+        backend.store('c', 100, b'payload-c', 'user')
+        time.sleep(0.2)
+        self.assertEqual(backend.elastic_connection.bulk_requests, 1)
+        self.assertEqual(sorted(backend.elastic_connection.documents.keys()), ['a', 'b', 'c'])
+        self.assertEqual(backend.lookup('a', 0), (base64.b64encode(b'payload-a').decode('utf-8'), 100))
+        backend.close()
+
+    def test_queued_entries_are_sent_at_exit(self):
+        with mock.patch.object(backends_module.atexit, 'register') as register:
+            backend = ElasticCacheBackend('test', self.config, max_age=1000)
+        backend.store('a', 100, b'payload-a', 'user')
+        # As called when the interpreter exits
+        register.call_args[0][0]()
+        self.assertEqual(backend.elastic_connection.bulk_requests, 1)
+        self.assertEqual(list(backend.elastic_connection.documents.keys()), ['a'])
+        backend.close()
+        self.assertEqual(backend.elastic_connection.bulk_requests, 1)
+
+    def test_failed_items_are_requeued(self):
+        backend = ElasticCacheBackend('test', self.config, max_age=1000)
+        backend.elastic_connection.rejected.add('b')
+        backend.store_many([('a', 100, b'payload-a', 'user'), ('b', 100, b'payload-b', 'user')])
+        backend.flush()
+        self.assertEqual(list(backend.elastic_connection.documents.keys()), ['a'])
+        self.assertEqual(backend.lookup('b', 0), (b'payload-b', 100))
+
+        backend.elastic_connection.rejected.clear()
+        backend.flush()
+        self.assertEqual(sorted(backend.elastic_connection.documents.keys()), ['a', 'b'])
+        backend.close()
+
+    def test_delete(self):
+        backend = ElasticCacheBackend('test', self.config, max_age=1000)
+        backend.store('a', 100, b'payload-a', 'user')
+        backend.flush()
+        backend.delete('a')
+        self.assertEqual(backend.elastic_connection.documents, {})
+        # Never sent to the cluster
+        backend.delete('missing')
+        backend.close()
+
+    def test_local_cache_reads_through(self):
+        self.config['elastic']['local_cache'] = {'cache_location': os.path.join(self.directory.name, 'elastic')}
+        backend = ElasticCacheBackend('test', self.config, max_age=1000)
+        backend.elastic_connection.documents['a'] = {'signature_hash': 'a', 'encoded_response': 'cGF5bG9hZC1h',
+                                                     'lookup_timestamp': 100}
+        self.assertEqual(backend.lookup('a', 0), ('cGF5bG9hZC1h', 100))
+        self.assertEqual(backend.lookup('a', 0), ('cGF5bG9hZC1h', 100))
+        self.assertEqual(backend.lookup('b', 0), (None, 0))
+        self.assertEqual(backend.elastic_connection.searches, 2)
+        backend.close()
+
+
+class TestCodec(unittest.TestCase):
+    response = {'ip_address': '10.0.0.1', 'tags': ['a', 'b'] * 50, 'score': 1.5, 'seen': None}
+
+    @unittest.skipIf(None in (codecs.orjson, codecs.msgpack, codecs.zstandard), 'optional codec packages not installed')
+    def test_round_trip(self):
+        for serializer in ('json', 'orjson', 'msgpack'):
+            for compression in ('none', 'zlib', 'zstd'):
+                codec = Codec(serializer=serializer, compression=compression)
+                payload = codec.encode(codec.dumps(self.response))
+                self.assertEqual(codec.loads(codec.decode(payload)), self.response)
+
+    @unittest.skipIf(None in (codecs.msgpack, codecs.zstandard), 'optional codec packages not installed')
+    def test_reads_entries_written_with_other_codecs(self):
+        writer = Codec(serializer='msgpack', compression='zstd')
+        payload = writer.encode(writer.dumps(self.response))
+        reader = Codec(serializer='json', compression='zlib')
+        self.assertEqual(reader.loads(reader.decode(payload)), self.response)
+        self.assertEqual(reader.loads(reader.decode(base64.b64encode(payload).decode('utf-8'))), self.response)
+
+    def test_reads_legacy_base64_entries(self):
+        legacy = base64.b64encode(json.dumps(self.response).encode('utf-8')).decode('utf-8')
+        for serializer in ('json', 'msgpack') if codecs.msgpack is not None else ('json',):
+            codec = Codec(serializer=serializer)
+            self.assertEqual(codec.loads(codec.decode(legacy)), self.response)
+
+    @unittest.skipIf(codecs.zstandard is None, 'zstandard not installed')
+    def test_zstd_dictionary(self):
+        samples = [json.dumps(dict(self.response, ip_address='10.0.{}.{}'.format(i // 250, i % 250))).encode('utf-8')
+                   for i in range(1000)]
+        dictionary = codecs.train_zstd_dictionary(samples, dictionary_size=4096)
+        codec = Codec(compression='zstd', dictionary=dictionary)
+        payload = codec.encode(samples[0])
+        self.assertLess(len(payload), len(Codec(compression='zstd').encode(samples[0])))
+        self.assertEqual(codec.decode(payload), samples[0])
+
+
+class TestSignatureGenerator(unittest.TestCase):
+
+    def test_argument_order_does_not_matter(self):
+        generator = SignatureGenerator('test')
+        self.assertEqual(generator.signature({'a': 1, 'b': {'x': 1, 'y': [1, 2]}}),
+                         generator.signature({'b': {'y': [1, 2], 'x': 1}, 'a': 1}))
+        self.assertEqual(generator.signature({'a': {3, 1, 2}}), generator.signature({'a': {2, 3, 1}}))
+
+    def test_dicts_with_mixed_key_types(self):
+        generator = SignatureGenerator('test')
+        for value in ({1: 'a', 'b': 2}, {None: 1, 2: 3}, {1: 'a', (1, 2): 'b'}):
+            self.assertEqual(generator.signature({'a': value}),
+                             generator.signature({'a': dict(reversed(list(value.items())))}))
+        self.assertNotEqual(generator.signature({'a': {1: 'a'}}), generator.signature({'a': {'1': 'a'}}))
+
+    def test_plain_arguments_serialized_as_canonical(self):
+        values = [[1, 'x', None, True, 1.5, float('inf')], ('a', 'é"\n'), {'b': [1, (2,)], 'a': {'"': 1, 'A': None}}]
+        for value in values:
+            self.assertEqual(keys._plain_dumps(value), keys._dumps(keys._canonical(value)))
+        for value in ([1, {2}], {'a': {1: 2}}, (b'x',)):
+            self.assertIsNone(keys._plain_dumps(value))
+
+    def test_types_are_distinguished(self):
+        generator = SignatureGenerator('test')
+        signatures = {generator.signature({'a': value}) for value in (1, '1', 1.0, True, [1], (1,), {1}, b'1', None)}
+        self.assertEqual(len(signatures), 9)
+        self.assertNotEqual(generator.signature({'a': 1}), generator.signature({'a': '1'}))
+        self.assertNotEqual(generator.signature({'a': [1]}), generator.signature({'a': (1,)}))
+
+    def test_cache_name_and_version_change_signature(self):
+        signature = SignatureGenerator('test').signature({'a': 1})
+        self.assertNotEqual(signature, SignatureGenerator('other').signature({'a': 1}))
+        self.assertNotEqual(signature, SignatureGenerator('test', version=2).signature({'a': 1}))
+
+    def test_legacy_version(self):
+        self.assertEqual(SignatureGenerator('test', version=0).signature({'ip_address': '10.0.0.1'}),
+                         hashlib.sha256(b'testip_address=10.0.0.1').hexdigest())
+
+
+class TestCachePolicy(unittest.TestCase):
+
+    def test_per_cache_policy(self):
+        config = {'default_max_age': 1000, 'test_max_age': 2000, 'cache_error_responses': False,
+                  'stale_while_revalidate': 100, 'cache_policies': {'other': {'max_age': 3000, 'error_max_age': 10}}}
+        policy = CachePolicy.from_config(config, 'test')
+        self.assertEqual((policy.max_age, policy.stale_while_revalidate, policy.error_max_age), (2000, 100, None))
+        self.assertFalse(policy.caches_errors())
+        policy = CachePolicy.from_config(config, 'other')
+        self.assertEqual((policy.max_age, policy.stale_while_revalidate, policy.error_max_age), (3000, 100, 10))
+        self.assertEqual(policy.retention, 3100)
+
+    def test_cache_error_responses_uses_max_age(self):
+        policy = CachePolicy.from_config({'default_max_age': 1000, 'cache_error_responses': True}, 'test')
+        self.assertEqual(policy.entry_max_age('ffffffff', negative=True), 1000)
+
+    def test_expiry_jitter(self):
+        policy = CachePolicy(max_age=1000, expiry_jitter=0.2)
+        self.assertEqual(policy.entry_max_age('00000000'), 1000)
+        self.assertEqual(policy.entry_max_age('ffffffff'), 800)
+        max_ages = {policy.entry_max_age('{:08x}'.format(n * 0x1000000)) for n in range(256)}
+        self.assertGreater(len(max_ages), 100)
+        self.assertTrue(all(800 <= max_age <= 1000 for max_age in max_ages))
+
+
+class TestAPICache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.config_file = _file_cache_config(self.directory.name)
+        self.live_calls = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _lookup_ip(self, ip_address):
+        self.live_calls.append(ip_address)
+        return {'ip_address': ip_address}
+
+    def test_lookup_uses_file_cache(self):
+        cache = APICache('test', custom_config_file=self.config_file)
+        self.assertEqual(cache.lookup(self._lookup_ip, ip_address='10.0.0.1'), {'ip_address': '10.0.0.1'})
+        cache.close()
+
+        cache = APICache('test', custom_config_file=self.config_file)
+        self.assertEqual(cache.lookup(self._lookup_ip, ip_address='10.0.0.1'), {'ip_address': '10.0.0.1'})
+        self.assertEqual(self.live_calls, ['10.0.0.1'])
+        cache.close()
+
+    def test_default_signatures_match_earlier_releases(self):
+        cache = APICache('test', custom_config_file=self.config_file)
+        cache.lookup(self._lookup_ip, ip_address='10.0.0.1')
+        self.assertEqual(list(cache.memory_cache.keys()), [hashlib.sha256(b'testip_address=10.0.0.1').hexdigest()])
+        cache.close()
+
+    def test_reads_legacy_entries(self):
+        backend = FileCacheBackend('test', {'file': {'cache_location': self.directory.name}}, max_age=345600000)
+        legacy_response = base64.b64encode(json.dumps({'ip_address': 'legacy'}).encode('utf-8')).decode('utf-8')
+        cache = APICache('test', custom_config_file=self.config_file)
+        cache.lookup(self._lookup_ip, ip_address='10.0.0.1')
+        signature_hash = list(cache.memory_cache.keys())[0]
+        cache.close()
+        backend.store(signature_hash, int(round(time.time() * 1000)), legacy_response, 'user')
+        backend.close()
+
+        cache = APICache('test', custom_config_file=self.config_file)
+        self.assertEqual(cache.lookup(self._lookup_ip, ip_address='10.0.0.1'), {'ip_address': 'legacy'})
+        cache.close()
+
+    def test_lookup_many(self):
+        cache = APICache('test', custom_config_file=self.config_file)
+        cache.lookup(self._lookup_ip, ip_address='10.0.0.1')
+        cache.close()
+
+        cache = APICache('test', custom_config_file=self.config_file)
+        cache.lookup(self._lookup_ip, ip_address='10.0.0.2')
+        ips = ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.1', '10.0.0.4']
+        results = cache.lookup_many(self._lookup_ip, [{'ip_address': ip} for ip in ips])
+        self.assertEqual(results, [{'ip_address': ip} for ip in ips])
+        self.assertEqual(self.live_calls, ['10.0.0.1', '10.0.0.2', '10.0.0.3', '10.0.0.4'])
+        cache.close()
+
+    def test_lookup_many_with_batch_lookup_method(self):
+        batches = []
+
+        def batch_lookup(kwargs_list):
+            batches.append(kwargs_list)
+            return [{'ip_address': kwargs['ip_address']} for kwargs in kwargs_list]
+
+        cache = APICache('test', custom_config_file=self.config_file)
+        ips = ['10.0.0.{}'.format(i) for i in range(2000)]
+        results = cache.lookup_many(self._lookup_ip, [{'ip_address': ip} for ip in ips], batch_lookup_method=batch_lookup)
+        self.assertEqual(results, [{'ip_address': ip} for ip in ips])
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(self.live_calls, [])
+        cache.close()
+
+        cache = APICache('test', custom_config_file=self.config_file)
+        results = cache.lookup_many(self._lookup_ip, [{'ip_address': ip} for ip in ips], batch_lookup_method=batch_lookup)
+        self.assertEqual(results, [{'ip_address': ip} for ip in ips])
+        self.assertEqual(len(batches), 1)
+        cache.close()
+
+    def test_batch_lookup_method_must_answer_every_lookup(self):
+        def short_batch_lookup(kwargs_list):
+            return [{'ip_address': kwargs['ip_address']} for kwargs in kwargs_list[1:]]
+
+        cache = APICache('test', custom_config_file=self.config_file)
+        with self.assertRaisesRegex(ValueError, 'short_batch_lookup returned 1 responses for 2 lookups'):
+            cache.lookup_many(self._lookup_ip, [{'ip_address': '10.0.0.1'}, {'ip_address': '10.0.0.2'}],
+                              batch_lookup_method=short_batch_lookup)
+        self.assertEqual(list(cache.memory_cache.keys()), [])
+        cache.close()
+
+    def test_concurrent_identical_lookups_call_live_source_once(self):
+        cache = APICache('test', custom_config_file=self.config_file)
+        thread_count = 32
+        barrier = threading.Barrier(thread_count)
+        lock = threading.Lock()
+        results = []
+
+        def slow_lookup(ip_address):
+            time.sleep(0.2)
+            return self._lookup_ip(ip_address)
+
+        def worker():
+            barrier.wait()
+            result = cache.lookup(slow_lookup, ip_address='10.0.0.1')
+            with lock:
+                results.append(result)
+
+        threads = [threading.Thread(target=worker) for _ in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.live_calls, ['10.0.0.1'])
+        self.assertEqual(results, [{'ip_address': '10.0.0.1'}] * thread_count)
+        cache.close()
+
+    def test_concurrent_lookups_share_live_source_errors(self):
+        cache = APICache('test', custom_config_file=self.config_file)
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def failing_lookup(ip_address):
+            self.live_calls.append(ip_address)
+            time.sleep(0.2)
+            raise ValueError('upstream failure')
+
+        def worker():
+            barrier.wait()
+            try:
+                cache.lookup(failing_lookup, ip_address='10.0.0.1')
+            except ValueError as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.live_calls, ['10.0.0.1'])
+        self.assertEqual(len(errors), 8)
+        cache.close()
+
+    def test_stale_entries_served_while_refreshed(self):
+        config_file = _file_cache_config(self.directory.name, default_max_age=200, stale_while_revalidate=60000,
+                                         memory_cache_size=0)
+        cache = APICache('test', custom_config_file=config_file)
+        cache.lookup(self._lookup_ip, ip_address='10.0.0.1')
+        time.sleep(0.3)
+
+        def updated_lookup(ip_address):
+            self.live_calls.append(ip_address)
+            time.sleep(0.1)
+            return {'ip_address': ip_address, 'updated': True}
+
+        self.assertEqual(cache.lookup(updated_lookup, ip_address='10.0.0.1'), {'ip_address': '10.0.0.1'})
+        time.sleep(0.3)
+        self.assertEqual(cache.lookup(updated_lookup, ip_address='10.0.0.1'), {'ip_address': '10.0.0.1', 'updated': True})
+        self.assertEqual(self.live_calls, ['10.0.0.1', '10.0.0.1'])
+        cache.close()
+
+    def test_error_responses_use_error_max_age(self):
+        config_file = _file_cache_config(self.directory.name, error_max_age=200)
+        cache = APICache('test', custom_config_file=config_file)
+
+        def failing_lookup(ip_address):
+            self.live_calls.append(ip_address)
+            return {'error': 'quota exceeded'}
+
+        cache.lookup(failing_lookup, ip_address='10.0.0.1')
+        cache.lookup(failing_lookup, ip_address='10.0.0.1')
+        cache.close()
+        cache = APICache('test', custom_config_file=config_file)
+        cache.lookup(failing_lookup, ip_address='10.0.0.1')
+        self.assertEqual(self.live_calls, ['10.0.0.1'])
+        time.sleep(0.3)
+        self.assertEqual(cache.lookup(self._lookup_ip, ip_address='10.0.0.1'), {'ip_address': '10.0.0.1'})
+        self.assertEqual(self.live_calls, ['10.0.0.1', '10.0.0.1'])
+        cache.close()
+
+    def test_cached_errors_ignored_once_no_longer_cached(self):
+        config_file = _file_cache_config(self.directory.name, error_max_age=60000)
+        cache = APICache('test', custom_config_file=config_file)
+        cache.lookup(lambda ip_address: {'error': 'quota exceeded'}, ip_address='10.0.0.1')
+        cache.close()
+
+        cache = APICache('test', custom_config_file=_file_cache_config(self.directory.name))
+        self.assertEqual(cache.warm(), 0)
+        self.assertEqual(cache.lookup(self._lookup_ip, ip_address='10.0.0.1'), {'ip_address': '10.0.0.1'})
+        self.assertEqual(self.live_calls, ['10.0.0.1'])
+        cache.close()
+
+    def test_error_responses_not_cached_by_default(self):
+        cache = APICache('test', custom_config_file=self.config_file)
+
+        def failing_lookup(ip_address):
+            self.live_calls.append(ip_address)
+            return {'error': 'quota exceeded'}
+
+        cache.lookup(failing_lookup, ip_address='10.0.0.1')
+        cache.lookup(failing_lookup, ip_address='10.0.0.1')
+        self.assertEqual(self.live_calls, ['10.0.0.1', '10.0.0.1'])
+        cache.close()
+
+    def test_metrics_count_resolution_tiers(self):
+        cache = APICache('metrics test', custom_config_file=self.config_file)
+        cache.metrics.reset()
+        cache.lookup(self._lookup_ip, ip_address='10.0.0.1')
+        cache.lookup(self._lookup_ip, ip_address='10.0.0.1')
+        cache.close()
+
+        cache = APICache('metrics test', custom_config_file=self.config_file)
+        cache.lookup_many(self._lookup_ip, [{'ip_address': '10.0.0.1'}, {'ip_address': '10.0.0.2'}])
+        stats = cache.stats()
+        self.assertEqual(stats['lookups'], 4)
+        self.assertEqual(stats['resolutions'], {'memory': 1, 'stale': 0, 'file': 1, 'elastic': 0, 'live': 2})
+        self.assertEqual(stats['upstream_calls'], 2)
+        self.assertEqual(stats['upstream_bytes'], 2 * len(json.dumps({'ip_address': '10.0.0.1'})))
+        self.assertEqual(stats['stored_entries'], 2)
+        self.assertEqual(stats['latency']['live']['count'], 2)
+        self.assertEqual(stats['memory_cache']['entries'], 2)
+        cache.close()
+
+    def test_metrics_profile(self):
+        cache = APICache('profile test', custom_config_file=self.config_file)
+        cache.lookup(self._lookup_ip, ip_address='10.0.0.1')
+        with metrics.profile('enrichment') as result:
+            cache.lookup(self._lookup_ip, ip_address='10.0.0.1')
+            cache.lookup(self._lookup_ip, ip_address='10.0.0.2')
+        self.assertEqual(result.caches['profile test']['lookups'], 2)
+        self.assertEqual(result.caches['profile test']['resolutions']['memory'], 1)
+        self.assertEqual(result.caches['profile test']['upstream_calls'], 1)
+        self.assertGreater(result.elapsed_seconds, 0)
+        cache.close()
+
+    def test_warm_loads_most_recent_entries(self):
+        cache = APICache('test', custom_config_file=self.config_file)
+        for i in range(5):
+            cache.lookup(self._lookup_ip, ip_address='10.0.0.{}'.format(i))
+        cache.close()
+
+        config_file = _file_cache_config(self.directory.name, memory_cache_warm_entries=3)
+        cache = APICache('test', custom_config_file=config_file)
+        self.assertEqual(len(cache.memory_cache), 3)
+        cache.lookup(self._lookup_ip, ip_address='10.0.0.4')
+        self.assertEqual(cache.stats()['memory_cache']['hits'], 1)
+        cache.close()
+
+    def test_export_and_import_snapshots(self):
+        cache = APICache('test', custom_config_file=self.config_file)
+        for i in range(3):
+            cache.lookup(self._lookup_ip, ip_address='10.0.0.{}'.format(i))
+
+        for snapshot_name in ['snapshot.ndjson.gz', 'snapshot.sqlite']:
+            with tempfile.TemporaryDirectory() as target_directory:
+                snapshot_file = os.path.join(self.directory.name, snapshot_name)
+                self.assertEqual(cache.export_snapshot(snapshot_file), 3)
+
+                target = APICache('test', custom_config_file=_file_cache_config(target_directory))
+                self.assertEqual(target.import_snapshot(snapshot_file), 3)
+                results = target.lookup_many(self._lookup_ip, [{'ip_address': '10.0.0.{}'.format(i)} for i in range(3)])
+                self.assertEqual(results, [{'ip_address': '10.0.0.{}'.format(i)} for i in range(3)])
+                target.close()
+        self.assertEqual(len(self.live_calls), 3)
+        cache.close()
+
+    def test_migrate_to_another_backend(self):
+        cache = APICache('test', custom_config_file=self.config_file)
+        cache.lookup(self._lookup_ip, ip_address='10.0.0.1')
+        with tempfile.TemporaryDirectory() as target_directory:
+            target_config_file = _file_cache_config(target_directory)
+            self.assertEqual(cache.migrate_to(target_config_file), 1)
+            target = APICache('test', custom_config_file=target_config_file)
+            self.assertEqual(target.lookup(self._lookup_ip, ip_address='10.0.0.1'), {'ip_address': '10.0.0.1'})
+            target.close()
+        self.assertEqual(self.live_calls, ['10.0.0.1'])
+        cache.close()
@@ -0,0 +1,276 @@
+import os
+import re
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from digital_thought_commons import internet
+from digital_thought_commons.internet.download_manager import DownloadConfig, DownloadManager, DownloadProgress, DownloadWorker, \
+    SegmentScheduler, TokenBucket
+
+CONTENT = bytes(i * 7 % 251 for i in range(3 * 1024 * 1024 + 123))
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves CONTENT at any path but /missing.bin, honouring single byte ranges, and records the ranges requested and the
+    connections opened.  Responses to ranges starting at slow_offset are sent at about 1MB/s.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    ranges = []
+    connections = 0
+    slow_offset = None
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with _RangeHandler.lock:
+            _RangeHandler.connections += 1
+
+    def __not_found(self):
+        self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def __send_headers(self):
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match is None:
+            start, end = 0, len(CONTENT) - 1
+            self.send_response(200)
+        else:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(CONTENT) - 1
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(CONTENT)}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        return start, end
+
+    def do_HEAD(self):
+        if self.path.endswith('/missing.bin'):
+            self.__not_found()
+            return
+        self.__send_headers()
+
+    def do_GET(self):
+        if self.path.endswith('/missing.bin'):
+            self.__not_found()
+            return
+
+        with _RangeHandler.lock:
+            _RangeHandler.ranges.append(self.headers.get('Range'))
+            _RangeHandler.in_flight += 1
+            _RangeHandler.max_in_flight = max(_RangeHandler.max_in_flight, _RangeHandler.in_flight)
+        try:
+            start, end = self.__send_headers()
+            if start != _RangeHandler.slow_offset:
+                self.wfile.write(CONTENT[start:end + 1])
+                return
+            for offset in range(start, end + 1, 64 * 1024):
+                self.wfile.write(CONTENT[offset:min(offset + 64 * 1024, end + 1)])
+                time.sleep(0.06)
+        finally:
+            with _RangeHandler.lock:
+                _RangeHandler.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestDownloadManager(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), _RangeHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.root_url = 'http://127.0.0.1:{}/'.format(cls.server.server_address[1])
+        cls.url = cls.root_url + 'sample.bin'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.destination = os.path.join(self.directory.name, 'sample.bin')
+        _RangeHandler.ranges = []
+        _RangeHandler.slow_offset = None
+        _RangeHandler.max_in_flight = 0
+        _RangeHandler.connections = 0
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def __read_destination(self):
+        with open(self.destination, 'rb') as in_file:
+            return in_file.read()
+
+    def test_segments_are_written_in_place(self):
+        job = DownloadManager().download(self.url, self.directory.name, override_worker_count=4)
+        self.assertFalse(job.errors)
+        self.assertEqual(self.__read_destination(), CONTENT)
+        self.assertEqual(os.listdir(self.directory.name), ['sample.bin'])
+        # One segment per min_segment_size, as the file is too small for segments_per_worker per worker
+        self.assertEqual(len(_RangeHandler.ranges), 3)
+
+    def test_chunk_and_buffer_sizes(self):
+        DownloadManager(chunk_size=1000, buffer_size=4096, fsync_on_checkpoint=False).download(
+            self.url, self.directory.name, override_worker_count=3)
+        self.assertEqual(self.__read_destination(), CONTENT)
+
+    def test_checkpoint_saves_segment_high_water_marks(self):
+        config = DownloadConfig(source_url=self.url, worker_count=2, file_length=20, supports_range=True,
+                                segments=['10:0:9', '10:10:19'], partial_name=self.destination + '.partial')
+        scheduler = SegmentScheduler(config)
+        scheduler.segments[0].high_water_mark = 4
+        scheduler.segments[1].high_water_mark = 5
+        progress = DownloadProgress(config, checkpoint_interval=0)
+        progress.start_sampler([], scheduler)
+        progress.stop_sampler()
+        self.assertEqual(DownloadConfig.load_from(config.state_name).segment_progress, [4, 5])
+
+    def test_idle_workers_split_the_slowest_segment(self):
+        config = DownloadConfig(source_url=self.url, worker_count=3, file_length=3000, supports_range=True,
+                                segments=['1000:0:999', '2000:1000:2999'], partial_name=self.destination + '.partial')
+        scheduler = SegmentScheduler(config, min_segment_size=100)
+        workers = [type('Worker', (), {'worker_number': n, 'throughput': type('Tracker', (), {'rate': rate})()})()
+                   for n, rate in enumerate([100.0, 300.0, 0.0])]
+        first, second = scheduler.next_segment(workers[0]), scheduler.next_segment(workers[1])
+        first.reserve(200)
+        second.reserve(500)
+
+        # The first segment has 800 bytes left at 100/s, the second 1500 at 300/s.  The third worker has no rate yet,
+        # so is taken as average (200/s) and gets two thirds of the remaining bytes of the first
+        stolen = scheduler.next_segment(workers[2])
+        self.assertEqual((stolen.start, stolen.limit), (467, 533))
+        self.assertEqual(first.limit, 467)
+        self.assertEqual(first.reserve(500), 267)
+
+        # Too little is left to be worth splitting again
+        scheduler.min_segment_size = 1000
+        self.assertIsNone(scheduler.next_segment(workers[0]))
+        scheduler.update_config()
+        self.assertEqual(config.segments, ['467:0:466', '2000:1000:2999', '533:467:999'])
+        self.assertEqual(config.segment_progress, [0, 0, 0])
+
+    def test_segment_of_failed_worker_is_requeued(self):
+        class FailingRequester:
+            def get(self, *args, **kwargs):
+                raise internet.IncompleteDownload('Connection refused')
+
+        config = DownloadConfig(source_url=self.url, worker_count=2, file_length=2000, supports_range=True,
+                                segments=['1000:0:999', '1000:1000:1999'], partial_name=self.destination + '.partial')
+        scheduler = SegmentScheduler(config)
+        worker = DownloadWorker(config, 0, FailingRequester(), False, DownloadProgress(config), scheduler)
+        worker.run()
+        self.assertTrue(worker.error)
+        self.assertFalse(worker.complete)
+
+        failed = scheduler.segments[0]
+        self.assertIsNone(failed.owner)
+        other = type('Worker', (), {'worker_number': 1, 'throughput': type('Tracker', (), {'rate': 0.0})()})()
+        self.assertEqual([scheduler.next_segment(other), scheduler.next_segment(other)], [scheduler.segments[1], failed])
+
+    def test_slow_connection_is_split(self):
+        _RangeHandler.slow_offset = 0
+        DownloadManager(segments_per_worker=1, min_segment_size=64 * 1024).download(self.url, self.directory.name,
+                                                                                    override_worker_count=2)
+        self.assertEqual(self.__read_destination(), CONTENT)
+        self.assertGreater(len(_RangeHandler.ranges), 2)
+        self.assertEqual(os.listdir(self.directory.name), ['sample.bin'])
+
+    def test_resume_from_high_water_marks(self):
+        half = len(CONTENT) // 2
+        config = DownloadConfig(source_url=self.url, worker_count=2, source_name='sample.bin', file_length=len(CONTENT),
+                                supports_range=True, segments=[f'{half}:0:{half - 1}', f'{len(CONTENT) - half}:{half}:'],
+                                dest_dir=self.directory.name, full_destination_name=self.destination,
+                                partial_name=self.destination + '.partial', segment_progress=[1000, half - 10])
+        with open(config.partial_name, 'wb') as out_file:
+            out_file.write(CONTENT[:1000] + bytes(half - 1000) + CONTENT[half:2 * half - 10])
+        config.write_to(config.state_name)
+
+        DownloadManager().download(self.url, self.directory.name, override_worker_count=2)
+        self.assertEqual(self.__read_destination(), CONTENT)
+        self.assertEqual(sorted(_RangeHandler.ranges), [f'bytes=1000-{half - 1}', f'bytes={2 * half - 10}-{len(CONTENT) - 1}'])
+        self.assertEqual(os.listdir(self.directory.name), ['sample.bin'])
+
+    def test_resume_segment_files_of_earlier_versions(self):
+        half = len(CONTENT) // 2
+        config = DownloadConfig(source_url=self.url, worker_count=2, source_name='sample.bin', file_length=len(CONTENT),
+                                supports_range=True, segments=[f'{half}:0:{half - 1}', f'{len(CONTENT) - half}:{half}:'],
+                                dest_dir=self.directory.name, full_destination_name=self.destination,
+                                partial_name=self.destination + '.partial')
+        # Earlier versions kept the config in the partial file and each segment in its own file
+        config.write_to(config.partial_name)
+        with open(config.partial_name + '.0', 'wb') as out_file:
+            out_file.write(CONTENT[:5000])
+        with open(config.partial_name + '.1', 'wb') as out_file:
+            out_file.write(CONTENT[half:])
+
+        DownloadManager().download(self.url, self.directory.name, override_worker_count=2)
+        self.assertEqual(self.__read_destination(), CONTENT)
+        self.assertEqual(_RangeHandler.ranges, [f'bytes=5000-{half - 1}'])
+        self.assertEqual(os.listdir(self.directory.name), ['sample.bin'])
+
+    def test_download_many_within_connection_limits(self):
+        done = []
+        with DownloadManager(max_connections=2, max_concurrent_downloads=3, min_segment_size=256 * 1024) as manager:
+            futures = manager.download_many([self.root_url + name for name in ['a.bin', 'b.bin', 'c.bin', 'missing.bin']],
+                                            self.directory.name, override_worker_count=3, callback=done.append)
+            jobs = [future.result() for future in futures[:3]]
+            with self.assertRaises(internet.DownloadNotFound):
+                futures[3].result()
+
+        self.assertEqual(len(done), 4)
+        self.assertLessEqual(_RangeHandler.max_in_flight, 2)
+        for job in jobs:
+            with open(job.downloaded_file(), 'rb') as in_file:
+                self.assertEqual(in_file.read(), CONTENT)
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ['a.bin', 'b.bin', 'c.bin'])
+
+    def test_close_without_waiting_cancels_queued_downloads(self):
+        _RangeHandler.slow_offset = 0
+        manager = DownloadManager(max_concurrent_downloads=1)
+        futures = manager.download_many([self.root_url + name for name in ['a.bin', 'b.bin', 'c.bin']],
+                                        self.directory.name, override_worker_count=1)
+        deadline = time.time() + 5
+        while not futures[0].running() and time.time() < deadline:
+            time.sleep(0.01)
+        manager.close(wait=False)
+        self.assertTrue(all(future.cancelled() for future in futures[1:]))
+        self.assertEqual(futures[0].result().config.source_name, 'a.bin')
+
+    def test_connections_per_host_limit_worker_count(self):
+        job = DownloadManager(max_connections_per_host=1).download(self.url, self.directory.name, async_download=True)
+        self.assertTrue(job.wait_to_complete(timeout=30))
+        self.assertEqual(job.config.worker_count, 1)
+        self.assertEqual(_RangeHandler.max_in_flight, 1)
+        self.assertEqual(self.__read_destination(), CONTENT)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=1000000, capacity=100000)
+        started = time.monotonic()
+        for _ in range(5):
+            bucket.consume(100000)
+        # The first 100000 bytes are the initial burst, the rest take 0.4s at the rate
+        self.assertGreaterEqual(time.monotonic() - started, 0.35)
+
+    def test_workers_reuse_connections(self):
+        DownloadManager(min_segment_size=384 * 1024).download(self.url, self.directory.name, override_worker_count=2)
+        self.assertEqual(self.__read_destination(), CONTENT)
+        # Eight segments, and the probes before them, over no more connections than there are workers
+        self.assertEqual(len(_RangeHandler.ranges), 8)
+        self.assertLessEqual(_RangeHandler.connections, 2)
+
+    def test_tor_session_is_created_when_needed(self):
+        with internet.new_requester() as requester:
+            self.assertEqual(requester.get(self.url).content, CONTENT)
+            self.assertIsNone(requester._RequesterSession__tor_requester)
+            self.assertIs(requester.requester('http://example.onion/sample.bin'), requester.tor_requester)
+        self.assertIsNone(requester._RequesterSession__tor_requester)
@@ -0,0 +1,731 @@
+import gzip
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+from digital_thought_commons import elasticsearch
+from digital_thought_commons.elasticsearch import ElasticsearchConnection, bulkProcessor, columnar
+from digital_thought_commons.elasticsearch.bulkProcessor import BulkProcessor
+from digital_thought_commons.elasticsearch.scrollQuery import ScrollQuery
+
+
+class _FakeResponse:
+
+    def __init__(self, status_code, json_body):
+        self.status_code = status_code
+        self.content = json.dumps(json_body).encode('utf-8')
+        self.__json_body = json_body
+
+    def json(self):
+        return self.__json_body
+
+
+class _FakeSession:
+
+    def __init__(self, delay=0):
+        self.headers = {}
+        self.requests = []
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.__lock = threading.Lock()
+
+    def post(self, url, data, headers):
+        if headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        with self.__lock:
+            self.requests.append(data)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.__lock:
+            self.in_flight -= 1
+        actions = [json.loads(line) for line in data.decode('utf-8').splitlines()]
+        items = [{action: {'_index': value['_index'], '_id': value.get('_id', 'generated'), 'result': 'created',
+                           'status': 201}}
+                 for entry in actions for action, value in entry.items() if action in ('index', 'create', 'delete',
+                                                                                       'update')]
+        return _FakeResponse(200, {'took': 1, 'errors': False, 'items': items})
+
+
+class _RejectingSession(_FakeSession):
+    """Fails the documents named in failures with the given statuses, once per entry in the list."""
+
+    def __init__(self, failures, batch_status=None):
+        super().__init__()
+        self.failures = failures
+        self.batch_status = batch_status or []
+
+    def post(self, url, data, headers):
+        self.requests.append(data)
+        if len(self.batch_status) > 0:
+            return _FakeResponse(self.batch_status.pop(0), {'error': 'unavailable'})
+
+        lines = data.decode('utf-8').splitlines()
+        items = []
+        for action_line, document_line in zip(lines[0::2], lines[1::2]):
+            name = json.loads(document_line)['name']
+            statuses = self.failures.get(name, [])
+            if len(statuses) > 0:
+                status = statuses.pop(0)
+                items.append({'index': {'_index': 'test', '_id': name, 'status': status,
+                                        'error': {'type': 'error_{}'.format(status), 'reason': 'failed'}}})
+            else:
+                items.append({'index': {'_index': 'test', '_id': name, 'result': 'created', 'status': 201}})
+        return _FakeResponse(200, {'took': 1, 'errors': any('error' in item['index'] for item in items),
+                                   'items': items})
+
+
+class TestBulkProcessor(unittest.TestCase):
+
+    def test_payload_is_ndjson(self):
+        session = _FakeSession()
+        with BulkProcessor(session, 'http://localhost:9200/', batch_size=10, batch_max_size_bytes=5000000) as processor:
+            processor.index('test', {'name': 'café'}, _id='1')
+            processor.create('test', {'name': 'b'})
+            processor.update('test', {'name': 'c'}, _id='3')
+            processor.delete('test', _id='4')
+            self.assertEqual(processor.current_batch_bytes, len(processor.entries.encode('utf-8')))
+
+        self.assertEqual(len(session.requests), 1)
+        self.assertEqual(session.requests[0].decode('utf-8').splitlines(), [
+            json.dumps({'index': {'_index': 'test', '_id': '1'}}), json.dumps({'name': 'café'}),
+            json.dumps({'create': {'_index': 'test'}}), json.dumps({'name': 'b'}),
+            json.dumps({'update': {'_index': 'test', '_id': '3'}}), json.dumps({'doc': {'name': 'c'}}),
+            json.dumps({'delete': {'_index': 'test', '_id': '4'}})])
+
+    def test_batches_by_count_and_size(self):
+        session = _FakeSession()
+        with BulkProcessor(session, 'http://localhost:9200/', batch_size=3, batch_max_size_bytes=5000000) as processor:
+            for i in range(7):
+                processor.index('test', {'id': i})
+        self.assertEqual([request.count(b'\n') // 2 for request in session.requests], [3, 3, 1])
+
+        session = _FakeSession()
+        with BulkProcessor(session, 'http://localhost:9200/', batch_size=1000, batch_max_size_bytes=200) as processor:
+            for i in range(10):
+                processor.index('test', {'id': i, 'padding': 'x' * 40})
+        self.assertGreater(len(session.requests), 1)
+        self.assertTrue(all(len(request) <= 200 + 100 for request in session.requests))
+        self.assertEqual(sum(request.count(b'\n') // 2 for request in session.requests), 10)
+
+    def test_concurrent_requests(self):
+        session = _FakeSession(delay=0.05)
+        processor = BulkProcessor(session, 'http://localhost:9200/', batch_size=10, batch_max_size_bytes=5000000,
+                                  concurrent_requests=4, queue_size=2)
+        for i in range(200):
+            processor.index('test', {'id': i})
+        results = processor.close()
+
+        self.assertEqual(results['created'], 200)
+        self.assertEqual(results['errors'], 0)
+        self.assertEqual(len(session.requests), 20)
+        self.assertGreater(session.max_in_flight, 1)
+        self.assertLessEqual(session.max_in_flight, 4)
+
+    def test_flush_interval_sends_partial_batch(self):
+        session = _FakeSession()
+        processor = BulkProcessor(session, 'http://localhost:9200/', batch_size=1000, batch_max_size_bytes=5000000,
+                                  concurrent_requests=1, flush_interval=0.1)
+        processor.index('test', {'id': 1})
+        deadline = time.time() + 5
+        while len(session.requests) == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(session.requests), 1)
+        self.assertEqual(processor.close()['created'], 1)
+
+    def test_flush_interval_continues_after_failed_batch(self):
+        session = _RejectingSession({}, batch_status=[503])
+        processor = BulkProcessor(session, 'http://localhost:9200/', batch_size=1000, batch_max_size_bytes=5000000,
+                                  flush_interval=0.2, max_retries=0)
+        processor.index('test', {'name': 'a'})
+        deadline = time.time() + 5
+        while len(session.requests) < 1 and time.time() < deadline:
+            time.sleep(0.05)
+        processor.index('test', {'name': 'b'})
+        while len(session.requests) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+
+        self.assertEqual(len(session.requests), 2)
+        self.assertEqual(processor.results['created'], 1)
+        with self.assertRaises(bulkProcessor.BulkRequestRejected):
+            processor.close()
+
+    def test_rejected_items_are_retried(self):
+        session = _RejectingSession({'b': [429, 503]})
+        processor = BulkProcessor(session, 'http://localhost:9200/', batch_size=10, batch_max_size_bytes=5000000,
+                                  initial_backoff=0.01)
+        for name in ['a', 'b', 'c']:
+            processor.index('test', {'name': name})
+        results = processor.close()
+
+        self.assertEqual(results['created'], 3)
+        self.assertEqual(results['error_entries'], [])
+        self.assertEqual([request.count(b'\n') // 2 for request in session.requests], [3, 1, 1])
+
+    def test_permanent_failures_are_reported(self):
+        failures = []
+        session = _RejectingSession({'a': [400], 'b': [429, 429, 429]}, batch_status=[503])
+        processor = BulkProcessor(session, 'http://localhost:9200/', batch_size=10, batch_max_size_bytes=5000000,
+                                  initial_backoff=0.01, max_retries=2, failure_callback=failures.append)
+        for name in ['a', 'b', 'c']:
+            processor.index('test', {'name': name})
+        results = processor.close()
+
+        self.assertEqual(results['created'], 1)
+        self.assertEqual(results['errors'], 2)
+        self.assertEqual([(entry['document']['name'], entry['status']) for entry in results['error_entries']],
+                         [('a', 400), ('b', 429)])
+        self.assertEqual(failures, results['error_entries'])
+        self.assertEqual(results['error_entries'][0]['action'], {'index': {'_index': 'test'}})
+
+    def test_batch_failures_raise_after_retries(self):
+        session = _RejectingSession({}, batch_status=[503, 503])
+        processor = BulkProcessor(session, 'http://localhost:9200/', batch_size=10, batch_max_size_bytes=5000000,
+                                  initial_backoff=0.01, max_retries=1)
+        processor.index('test', {'name': 'a'})
+        with self.assertRaises(Exception):
+            processor.close()
+        self.assertEqual(len(session.requests), 2)
+
+    def test_batch_failures_are_reported(self):
+        for concurrent_requests in (0, 2):
+            failures = []
+            session = _RejectingSession({}, batch_status=[503] * 10)
+            processor = BulkProcessor(session, 'http://localhost:9200/', batch_size=10, batch_max_size_bytes=5000000,
+                                      initial_backoff=0.01, max_retries=1, failure_callback=failures.append,
+                                      concurrent_requests=concurrent_requests)
+            for name in ['a', 'b']:
+                processor.index('test', {'name': name})
+            with self.assertRaises(bulkProcessor.BulkRequestRejected):
+                processor.close()
+
+            self.assertEqual(processor.results['errors'], 2)
+            self.assertEqual([(entry['document']['name'], entry['status'], entry['error']['type']) for entry in failures],
+                             [('a', 503, 'BulkRequestRejected'), ('b', 503, 'BulkRequestRejected')])
+            self.assertEqual(failures, processor.results['error_entries'])
+
+    def test_refused_batches_are_reported_without_retrying(self):
+        failures = []
+        session = _RejectingSession({}, batch_status=[413])
+        processor = BulkProcessor(session, 'http://localhost:9200/', batch_size=10, batch_max_size_bytes=5000000,
+                                  initial_backoff=0.01, max_retries=3, failure_callback=failures.append)
+        for name in ['a', 'b']:
+            processor.index('test', {'name': name})
+        with self.assertRaises(bulkProcessor.BulkRequestRejected):
+            processor.close()
+
+        self.assertEqual(len(session.requests), 1)
+        self.assertEqual(processor.results['errors'], 2)
+        self.assertEqual([(entry['document']['name'], entry['status']) for entry in failures], [('a', 413), ('b', 413)])
+        self.assertIn('unavailable', failures[0]['error']['reason'])
+
+    def test_close_errors_do_not_mask_errors_of_with_block(self):
+        session = _RejectingSession({}, batch_status=[503])
+        with self.assertRaises(ValueError):
+            with BulkProcessor(session, 'http://localhost:9200/', batch_size=10, batch_max_size_bytes=5000000,
+                               max_retries=0) as processor:
+                processor.index('test', {'name': 'a'})
+                raise ValueError('failed while indexing')
+        self.assertEqual(processor.results['errors'], 1)
+
+    def test_adaptive_batch_size(self):
+        session = _RejectingSession({'a': [429]})
+        processor = BulkProcessor(session, 'http://localhost:9200/', batch_size=16, batch_max_size_bytes=5000000,
+                                  initial_backoff=0.01, adaptive=True)
+        processor.index('test', {'name': 'a'})
+        processor.process_batch()
+        # Halved for the rejection, then grown by a quarter after the fast retry
+        self.assertEqual(processor.batch_size, 10)
+        for i in range(20):
+            processor.index('test', {'name': str(i)})
+            processor.process_batch()
+        self.assertEqual(processor.batch_size, 64)
+        self.assertEqual(processor.batch_max_size_bytes, 20000000)
+        processor.close()
+
+    def test_gzip_request_bodies(self):
+        session = _FakeSession()
+        with BulkProcessor(session, 'http://localhost:9200/', batch_size=10, batch_max_size_bytes=5000000,
+                           compression_level=6) as processor:
+            processor.index('test', {'name': 'a'}, _id='1')
+        self.assertEqual(session.requests[0].decode('utf-8').splitlines(),
+                         [json.dumps({'index': {'_index': 'test', '_id': '1'}}), json.dumps({'name': 'a'})])
+        self.assertEqual(processor.results['created'], 1)
+
+    def test_parse_response(self):
+        content = b'{"took":5,"errors":false,"items":[{"index":{"_id":"1","result":"created","status":201}},' \
+                  b'{"index":{"_id":"2","result":"updated","status":200}}]}'
+        took, errors, items = bulkProcessor._parse_response(content)
+        self.assertEqual((took, errors, items), (5, False, None))
+        self.assertEqual(bulkProcessor._count_results(content), {'created': 1, 'updated': 1})
+
+        content = b'{"took":7,"errors":true,"items":[{"index":{"_id":"1","result":"created","status":201}}, ' \
+                  b'{"index":{"_id":"2","status":429,"error":{"type":"es_rejected_execution_exception"}}}]}'
+        took, errors, items = bulkProcessor._parse_response(content)
+        self.assertEqual((took, errors), (7, True))
+        self.assertEqual([item['index']['_id'] for item in items], ['1', '2'])
+
+        took, errors, items = bulkProcessor._parse_response(b'{\n  "errors" : false, "took" : 3, "items" : [] }')
+        self.assertEqual((took, errors, items), (3, False, None))
+
+
+class _FakeSearchSession:
+    """Answers scroll and point in time searches over documents with a numeric id, sorted on id (desc on request)."""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.cursors = {}
+        self.deleted = []
+        self.requests = []
+        self.__lock = threading.Lock()
+
+    def __page(self, body, start):
+        hits = self.documents
+        descending = body.get('sort') == [{'id': 'desc'}]
+        if descending:
+            hits = list(reversed(hits))
+        if 'slice' in body:
+            hits = [hit for hit in hits if hit['id'] % body['slice']['max'] == body['slice']['id']]
+        if 'search_after' in body:
+            after = body['search_after'][0]
+            hits = [hit for hit in hits if (hit['id'] < after if descending else hit['id'] > after)]
+        page = hits[start:start + body.get('size', 10)]
+        source_fields = body.get('_source')
+        return [{'_id': str(hit['id']), 'sort': [hit.get('missing', hit['id'])],
+                 '_source': {key: value for key, value in hit.items() if source_fields is None or key in source_fields}}
+                for hit in page]
+
+    def post(self, url, json=None):
+        with self.__lock:
+            self.requests.append((url, json))
+            if '/_pit?' in url:
+                return _FakeResponse(200, {'id': 'pit'})
+            elif '_search?scroll=' in url:
+                scroll_id = 'scroll-{}'.format(len(self.cursors))
+                self.cursors[scroll_id] = (json, 0)
+            elif url.endswith('_search/scroll'):
+                scroll_id = json['scroll_id']
+            else:
+                return _FakeResponse(200, {'pit_id': 'pit', 'hits': {'hits': self.__page(json, 0)}})
+
+            body, start = self.cursors[scroll_id]
+            hits = self.__page(body, start)
+            self.cursors[scroll_id] = (body, start + len(hits))
+            return _FakeResponse(200, {'_scroll_id': scroll_id, 'hits': {'hits': hits}})
+
+    def delete(self, url, json=None):
+        self.deleted.append(json)
+        return _FakeResponse(200, {})
+
+
+class TestScrollQuery(unittest.TestCase):
+
+    def setUp(self):
+        self.session = _FakeSearchSession([{'id': i, 'url': 'http://{}.example.com'.format(i), 'status': 'bad'}
+                                           for i in range(95)])
+
+    def test_scroll(self):
+        with ScrollQuery(self.session, 'http://localhost:9200/') as scroll_query:
+            hits = list(scroll_query.query('test', {'query': {'match_all': {}}}, page_size=10, source=['url']))
+        self.assertEqual([int(hit['_id']) for hit in hits], list(range(95)))
+        self.assertEqual(hits[0]['_source'], {'url': 'http://0.example.com'})
+        self.assertEqual(self.session.deleted, [{'scroll_id': ['scroll-0']}])
+
+    def test_sliced_scroll(self):
+        scroll_query = ScrollQuery(self.session, 'http://localhost:9200/', page_size=7)
+        hits = list(scroll_query.query('test', {}, slices=4))
+        self.assertEqual(sorted(int(hit['_id']) for hit in hits), list(range(95)))
+
+        hits = list(scroll_query.query('test', {'sort': ['id']}, slices=4, ordered=True))
+        self.assertEqual([int(hit['_id']) for hit in hits], list(range(95)))
+        scroll_query.close()
+        self.assertEqual([len(deleted['scroll_id']) for deleted in self.session.deleted], [4, 4])
+        self.assertEqual(scroll_query.scroll_ids, [])
+
+    def test_search_after(self):
+        scroll_query = ScrollQuery(self.session, 'http://localhost:9200/')
+        hits = list(scroll_query.search_after('test', {}, page_size=10))
+        self.assertEqual([int(hit['_id']) for hit in hits], list(range(95)))
+        self.assertEqual(self.session.requests[1][1]['sort'], [{'_shard_doc': 'asc'}])
+
+        hits = list(scroll_query.search_after('test', {}, page_size=10, slices=3))
+        self.assertEqual([int(hit['_id']) for hit in hits], list(range(95)))
+        scroll_query.close()
+        self.assertEqual(self.session.deleted, [{'id': 'pit'}, {'id': 'pit'}])
+
+    def test_descending_sort_across_slices(self):
+        scroll_query = ScrollQuery(self.session, 'http://localhost:9200/', page_size=7)
+        hits = list(scroll_query.search_after('test', {'sort': [{'id': 'desc'}]}, slices=3))
+        self.assertEqual([int(hit['_id']) for hit in hits], list(reversed(range(95))))
+
+        hits = list(scroll_query.query('test', {'sort': [{'id': 'desc'}]}, slices=4, ordered=True))
+        self.assertEqual([int(hit['_id']) for hit in hits], list(reversed(range(95))))
+
+        with self.assertRaises(Exception):
+            scroll_query.search_after('test', {'sort': [{'id': 'desc'}, {'url': {'order': 'asc'}}]}, slices=3)
+
+    def test_missing_sort_values_are_rejected(self):
+        self.session.documents[50]['missing'] = None
+        with self.assertRaisesRegex(Exception, 'no sort value'):
+            list(ScrollQuery(self.session, 'http://localhost:9200/').query('test', {'sort': ['id']}, slices=2,
+                                                                           ordered=True))
+
+    def test_prefetch(self):
+        scroll_query = ScrollQuery(self.session, 'http://localhost:9200/', page_size=10, prefetch=2)
+        self.assertEqual([int(hit['_id']) for hit in scroll_query.query('test', {})], list(range(95)))
+        self.assertEqual([int(hit['_id']) for hit in scroll_query.search_after('test', {})], list(range(95)))
+
+    def test_early_close_clears_contexts(self):
+        for prefetch in [0, 2]:
+            self.session.deleted.clear()
+            scroll_query = ScrollQuery(self.session, 'http://localhost:9200/', page_size=10, prefetch=prefetch)
+            hits = scroll_query.query('test', {}, slices=2)
+            next(hits)
+            opened = list(scroll_query.scroll_ids)
+            hits.close()
+            self.assertEqual(len(self.session.deleted), 1)
+            self.assertEqual(sorted(self.session.deleted[0]['scroll_id']), sorted(set(opened)))
+            self.assertEqual(scroll_query.scroll_ids, [])
+
+        self.session.deleted.clear()
+        hits = ScrollQuery(self.session, 'http://localhost:9200/', page_size=10, prefetch=1).search_after('test', {})
+        next(hits)
+        hits.close()
+        self.assertEqual(self.session.deleted, [{'id': 'pit'}])
+
+
+class TestColumnar(unittest.TestCase):
+
+    hits = [{'_id': str(i), '_source': {'url': 'http://{}.example.com'.format(i), 'score': i / 2,
+                                         'geo': {'country': 'AU' if i % 2 == 0 else 'NZ'}},
+             'fields': {'status': ['bad' if i % 3 == 0 else 'good']}} for i in range(25)]
+
+    def test_column_batches(self):
+        batches = list(columnar.column_batches(iter(self.hits), ['url', 'geo.country', 'missing'], batch_size=10,
+                                               include_id=True))
+        self.assertEqual([len(batch['url']) for batch in batches], [10, 10, 5])
+        self.assertEqual(batches[0]['_id'][:2], ['0', '1'])
+        self.assertEqual(batches[0]['geo.country'][:2], ['AU', 'NZ'])
+        self.assertEqual(batches[2]['missing'], [None] * 5)
+
+        docvalues = next(columnar.column_batches(iter(self.hits), ['status'], use_docvalues=True))
+        self.assertEqual(docvalues['status'][:4], ['bad', 'good', 'good', 'bad'])
+
+    def test_memory_budget_limits_batch_rows(self):
+        batches = list(columnar.column_batches(iter(self.hits), ['url', 'score'], batch_size=1000, memory_budget=1000))
+        self.assertGreater(len(batches), 1)
+        self.assertEqual(sum(len(batch['url']) for batch in batches), 25)
+
+    def test_convert(self):
+        columns = next(columnar.column_batches(iter(self.hits), ['url', 'score']))
+        frame = columnar.convert(columns, 'pandas')
+        self.assertEqual(list(frame.columns), ['url', 'score'])
+        self.assertEqual(len(frame), 25)
+        arrays = columnar.convert(columns, 'numpy')
+        self.assertEqual(arrays['score'].dtype.kind, 'f')
+        with self.assertRaises(Exception):
+            columnar.convert(columns, 'parquet')
+
+    def test_query_dataframe(self):
+        connection = ElasticsearchConnection.__new__(ElasticsearchConnection)
+        connection.request_session = _FakeSearchSession([{'id': i, 'url': 'http://{}.example.com'.format(i),
+                                                          'status': 'bad'} for i in range(95)])
+        connection.root_url = 'http://localhost:9200/'
+
+        frame = connection.query_dataframe('test', {}, ['url', 'status'], batch_size=20, page_size=10)
+        self.assertEqual(len(frame), 95)
+        self.assertEqual(frame['url'][94], 'http://94.example.com')
+        self.assertEqual(connection.request_session.requests[0][1]['_source'], ['url', 'status'])
+        self.assertEqual(len(connection.request_session.deleted), 1)
+
+
+class _FakeClusterSession:
+    """Keeps the templates and policies put to it, and answers the requests made when connecting."""
+
+    def __init__(self, component_templates=(), index_templates=(), lifecycle_policies=()):
+        self.component_templates = list(component_templates)
+        self.index_templates = list(index_templates)
+        self.lifecycle_policies = list(lifecycle_policies)
+        self.gets = []
+        self.puts = []
+        self.closed = False
+
+    def get(self, url):
+        path = url.split('/', 3)[3]
+        self.gets.append(path)
+        if path == '_component_template':
+            return _FakeResponse(200, {'component_templates': [{'name': name} for name in self.component_templates]})
+        elif path == '_index_template':
+            return _FakeResponse(200, {'index_templates': [{'name': name} for name in self.index_templates]})
+        elif path == '_ilm/policy':
+            return _FakeResponse(200, {name: {} for name in self.lifecycle_policies})
+        elif path == '_cluster/health':
+            return _FakeResponse(200, {'status': 'green'})
+        return _FakeResponse(200, {})
+
+    def put(self, url, json):
+        path = url.split('/', 3)[3]
+        self.puts.append(path)
+        kind, _, name = path.rpartition('/')
+        {'_component_template': self.component_templates, '_index_template': self.index_templates,
+         '_ilm/policy': self.lifecycle_policies}.get(kind, []).append(name)
+        return _FakeResponse(200, {'acknowledged': True})
+
+    def close(self):
+        self.closed = True
+
+
+class TestTemplates(unittest.TestCase):
+
+    def connect(self, session):
+        with mock.patch.object(elasticsearch.internet, 'retry_request_session', return_value=session), \
+                mock.patch.object(elasticsearch, 'Elasticsearch'):
+            return ElasticsearchConnection('localhost', 9200, 'aWQ6c2VjcmV0')
+
+    def test_default_resources_are_loaded_once(self):
+        connection = self.connect(_FakeClusterSession())
+        self.assertEqual((connection.api_key_id, connection.api_key_instance), ('id', 'secret'))
+        templates = connection.default_index_templates()
+        templates['api-cache-v1']['index_patterns'].append('changed')
+        self.assertNotIn('changed', connection.default_index_templates()['api-cache-v1']['index_patterns'])
+
+        connection.default_lifecycle_policies()
+        with mock.patch.object(elasticsearch.glob, 'glob') as glob:
+            self.assertIn('logs', connection.default_lifecycle_policies())
+            glob.assert_not_called()
+
+    def test_ensure_templates_fetches_metadata_once(self):
+        session = _FakeClusterSession(component_templates=['user-agent-v1'])
+        connection = self.connect(session)
+        session.gets.clear()
+
+        statuses = connection.ensure_templates(['exfiltrated-data-v1', 'o365-e3-audit-logs-v1', 'api-cache-v1'],
+                                               prefix='test')
+        self.assertEqual(statuses, {'exfiltrated-data-v1': {'status': 'created'},
+                                    'o365-e3-audit-logs-v1': {'status': 'created'},
+                                    'api-cache-v1': {'status': 'created'}})
+        self.assertEqual(sorted(session.gets), ['_component_template', '_ilm/policy', '_index_template'])
+        self.assertEqual(session.puts.count('_component_template/custom-metadata-v2'), 1)
+        self.assertNotIn('_component_template/user-agent-v1', session.puts)
+        self.assertEqual(len([put for put in session.puts if put.startswith('_ilm/policy/')]), 2)
+        self.assertIn('_index_template/test-o365-e3-audit-logs-v1', session.puts)
+        self.assertIn('test-exfiltrated-data-v1-000001', session.puts)
+
+        session.gets.clear()
+        session.puts.clear()
+        statuses = connection.ensure_templates(['exfiltrated-data-v1', 'api-cache-v1'], prefix='test')
+        self.assertEqual(set(status['status'] for status in statuses.values()), {'already_present'})
+        self.assertEqual(session.gets, ['_index_template'])
+        self.assertEqual(session.puts, [])
+
+    def test_invalidate_metadata(self):
+        session = _FakeClusterSession()
+        connection = self.connect(session)
+        with connection.install_pass():
+            self.assertEqual(connection.loaded_index_templates(), [])
+            session.index_templates.append('external')
+            self.assertEqual(connection.loaded_index_templates(), [])
+            connection.invalidate_metadata()
+            self.assertEqual(connection.loaded_index_templates(), ['external'])
+
+    def test_install_pass_is_not_shared_across_threads(self):
+        session = _FakeClusterSession()
+        connection = self.connect(session)
+        other = []
+        with connection.install_pass():
+            self.assertEqual(connection.loaded_index_templates(), [])
+            session.index_templates.append('external')
+            thread = threading.Thread(target=lambda: other.append(connection.loaded_index_templates()))
+            thread.start()
+            thread.join(timeout=0.2)
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(connection.loaded_index_templates(), [])
+        thread.join(timeout=5)
+        self.assertEqual(other, [['external']])
+
+
+class TestConnectionRegistry(unittest.TestCase):
+
+    def test_connections_are_shared(self):
+        session = _FakeClusterSession()
+        with mock.patch.object(elasticsearch.internet, 'retry_request_session', return_value=session) as new_session, \
+                mock.patch.object(elasticsearch, 'Elasticsearch') as client:
+            first = elasticsearch.get_connection('localhost', 9200, 'aWQ6c2VjcmV0')
+            second = elasticsearch.get_connection('localhost', '9200', 'aWQ6c2VjcmV0')
+            other = elasticsearch.get_connection('localhost', 9200, 'aWQ6b3RoZXI=')
+
+            self.assertIs(first, second)
+            self.assertIsNot(first, other)
+            self.assertEqual(new_session.call_count, 2)
+            self.assertEqual(new_session.call_args.kwargs['pool_maxsize'], elasticsearch.DEFAULT_POOL_MAXSIZE)
+            self.assertEqual(session.gets, ['_cluster/health', '_cluster/health'])
+            client.assert_not_called()
+            self.assertIs(first.get_client(), first.get_client())
+            client.assert_called_once()
+
+            first.close()
+            self.assertFalse(session.closed)
+            self.assertIs(elasticsearch.get_connection('localhost', 9200, 'aWQ6c2VjcmV0'), first)
+            first.close()
+            second.close()
+            self.assertTrue(session.closed)
+            other.close()
+            reconnected = elasticsearch.get_connection('localhost', 9200, 'aWQ6c2VjcmV0')
+            self.assertIsNot(reconnected, first)
+            reconnected.close()
+
+    def test_slow_cluster_does_not_block_other_connections(self):
+        checking, release = threading.Event(), threading.Event()
+
+        class SlowClusterSession(_FakeClusterSession):
+            def get(self, url):
+                if url.startswith('https://slow:'):
+                    checking.set()
+                    release.wait(5)
+                return super().get(url)
+
+        with mock.patch.object(elasticsearch.internet, 'retry_request_session',
+                               side_effect=lambda **kwargs: SlowClusterSession()):
+            connections = []
+            slow = [threading.Thread(target=lambda: connections.append(elasticsearch.get_connection('slow', 9200,
+                                                                                                    'aWQ6c2VjcmV0')))
+                    for _ in range(2)]
+            for thread in slow:
+                thread.start()
+            self.assertTrue(checking.wait(5))
+            started = time.time()
+            fast = elasticsearch.get_connection('fast', 9200, 'aWQ6c2VjcmV0')
+            self.assertLess(time.time() - started, 1)
+            release.set()
+            for thread in slow:
+                thread.join()
+
+        self.assertIs(connections[0], connections[1])
+        self.assertEqual(connections[0]._references, 2)
+        for connection in connections + [fast]:
+            connection.close()
+        self.assertNotIn(('slow', '9200', 'aWQ6c2VjcmV0'), elasticsearch._connections)
+
+    def test_unhealthy_cluster_is_not_registered(self):
+        session = _FakeClusterSession()
+        session.get = lambda url: _FakeResponse(200, {'status': 'red'})
+        with mock.patch.object(elasticsearch.internet, 'retry_request_session', return_value=session):
+            with self.assertRaises(Exception):
+                elasticsearch.get_connection('unhealthy', 9200, 'aWQ6c2VjcmV0')
+        self.assertNotIn(('unhealthy', '9200', 'aWQ6c2VjcmV0'), elasticsearch._connections)
+
+
+def _ndjson(data):
+    return [json.loads(line) for line in data.decode('utf-8').splitlines()]
+
+
+class _FakeDocumentSession:
+    """Answers _mget, ids searches and _msearch of terms queries over documents, held as id: [(index, source)]."""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.requests = []
+
+    def __hits(self, ids):
+        return [{'_index': index, '_id': _id, '_source': source}
+                for _id in ids for index, source in self.documents.get(_id, [])]
+
+    def get(self, url, json):
+        self.requests.append(('search', json))
+        hits = self.__hits(json['query']['bool']['filter']['ids']['values'])
+        return _FakeResponse(200, {'hits': {'total': {'value': len(hits)}, 'hits': hits[:json['size']]}})
+
+    def post(self, url, json=None, data=None, headers=None):
+        if url.endswith('/_mget'):
+            self.requests.append(('mget', json))
+            docs = []
+            for _id in json['ids']:
+                hits = self.__hits([_id])
+                docs.append(dict(hits[0], found=True) if hits else {'_index': 'test', '_id': _id, 'found': False})
+            return _FakeResponse(200, {'docs': docs})
+
+        lines = _ndjson(data)
+        self.requests.append(('msearch', lines))
+        responses = []
+        for query in lines[1::2]:
+            if 'bad' in query:
+                responses.append({'status': 400, 'error': {'type': 'parsing_exception'}})
+                continue
+            values = query['query']['terms']['name']
+            hits = [{'_index': index, '_id': _id, '_source': source} for _id, entries in self.documents.items()
+                    for index, source in entries if source['name'] in values]
+            responses.append({'status': 200, 'hits': {'total': {'value': len(hits)}, 'hits': hits},
+                              'aggregations': {'names': {'buckets': [{'key': hit['_source']['name']}
+                                                                     for hit in hits]}}})
+        return _FakeResponse(200, {'responses': responses})
+
+
+class TestBatchedLookups(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = ElasticsearchConnection.__new__(ElasticsearchConnection)
+        self.connection.request_session = _FakeDocumentSession(
+            {str(i): [('test-00000{}'.format(i % 2), {'name': 'doc{}'.format(i % 10)})] for i in range(12000)})
+        self.connection.root_url = 'http://localhost:9200/'
+
+    def test_find_by_ids(self):
+        results = self.connection.find_by_ids('test', ['5', 'missing', '11999', '5'])
+        self.assertEqual(results[0], {'_index': 'test-000001', '_type': '_doc', '_id': '5', 'found': True,
+                                      '_source': {'name': 'doc5'}})
+        self.assertEqual(results[1], {'_index': 'test', '_type': '_doc', '_id': 'missing', 'found': False})
+        self.assertEqual(results[2]['_source'], {'name': 'doc9'})
+        self.assertEqual(results[3], results[0])
+
+        results = self.connection.find_by_ids('test', [str(i) for i in range(12000)])
+        self.assertEqual(len(results), 12000)
+        self.assertTrue(all(result['found'] for result in results))
+        self.assertEqual(len(self.connection.request_session.requests), 4)
+
+        self.connection.request_session.documents['7'].append(('test-000002', {'name': 'doc7'}))
+        with self.assertRaisesRegex(Exception, r"IDs: \['7'\] have returned more than 1 result"):
+            self.connection.find_by_ids('test', ['6', '7'])
+
+    def test_find_by_ids_with_truncated_hits(self):
+        # As when fewer hits are returned than were asked for, e.g. with a smaller max_result_window
+        search = self.connection.request_session.get
+
+        def truncated_search(url, json):
+            hits = search(url, json).json()['hits']
+            return _FakeResponse(200, {'hits': {'total': hits['total'], 'hits': hits['hits'][:1]}})
+
+        self.connection.request_session.get = truncated_search
+        with self.assertRaisesRegex(Exception, 'Only 1 of 2 results were returned for 2 IDs in test'):
+            self.connection.find_by_ids('test', ['6', '7'])
+
+    def test_find_by_ids_with_mget(self):
+        results = self.connection.find_by_ids('test-000000', [str(i) for i in range(2500)] + ['missing'],
+                                              alias_index=False)
+        self.assertEqual(len(results), 2501)
+        self.assertEqual(results[2]['_source'], {'name': 'doc2'})
+        self.assertFalse(results[-1]['found'])
+        self.assertEqual([kind for kind, _ in self.connection.request_session.requests], ['mget'] * 3)
+
+    def test_msearch(self):
+        self.connection.request_session.documents = {str(i): [('test-000000', {'name': 'doc{}'.format(i % 10)})]
+                                                     for i in range(20)}
+        queries = [{'query': {'terms': {'name': ['doc{}'.format(i % 10)]}}} for i in range(450)]
+        responses = self.connection.msearch('test', queries)
+        self.assertEqual(len(responses), 450)
+        self.assertEqual(responses[3]['hits']['hits'][0]['_source']['name'], 'doc3')
+        self.assertEqual(len(self.connection.request_session.requests), 3)
+        self.assertEqual(self.connection.request_session.requests[0][1][0], {'index': 'test'})
+
+        with self.assertRaises(Exception):
+            self.connection.msearch('test', [queries[0], {'bad': True}])
+
+        results = self.connection.find_by_term_many('test', 'name', [['doc1'], ['none']])
+        self.assertEqual([result['status_code'] for result in results], [200, 200])
+        self.assertEqual(results[0]['elastic']['hits']['total']['value'], 2)
+        self.assertEqual(results[1]['elastic']['hits']['total']['value'], 0)
+
+        buckets = self.connection.aggregation_many('test', queries[:2], 'names')
+        self.assertEqual(buckets[1][0], {'key': 'doc1'})
+        self.assertEqual(self.connection.aggregation_many('test', queries[:1], 'missing'), [[]])